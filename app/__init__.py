@@ -2,7 +2,8 @@ import os
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
-from app.models import db, cache
+from app.models import (db, cache, access_log, compressor, http,
+                        request_metrics, response_cache, swr)
 
 
 def create_app(testing=False):
@@ -14,8 +15,15 @@ def create_app(testing=False):
     app.testing = testing
     app.url_map.strict_slashes = False
     load_env_vars(app)
+    # First, so that its after_request hook sees the final response
+    access_log.init_app(app)
+    request_metrics.init_app(app)
     db.init_app(app)
     db.register_containers()
+    http.init_app(app)
+    response_cache.init_app(app)
+    swr.init_app(app)
+    compressor.init_app(app)
     register_blueprints(app)
 
     # FS cache
@@ -32,6 +40,8 @@ def create_app(testing=False):
         "CACHE_MEMCACHED_SERVERS": [app.config["MEMCACHED_ADDR"]],
         "CACHE_MEMCACHED_USERNAME": app.config["MEMCACHED_USERNAME"],
         "CACHE_MEMCACHED_PASSWORD": app.config["MEMCACHED_PASSWORD"],
+        "CACHE_L1_THRESHOLD": app.config["CACHE_L1_THRESHOLD"],
+        "CACHE_L1_TIMEOUT": app.config["CACHE_L1_TIMEOUT"],
     })
     return app
 
@@ -44,6 +54,68 @@ def load_env_vars(app):
     app.config["MEMCACHED_ADDR"] = os.environ["MEMCACHED_ADDR"]
     app.config["MEMCACHED_USERNAME"] = os.environ["MEMCACHED_USERNAME"]
     app.config["MEMCACHED_PASSWORD"] = os.environ["MEMCACHED_PASSWORD"]
+    app.config["BATCH_MAX_WORKERS"] = int(
+        os.environ.get("BATCH_MAX_WORKERS", 8))
+    app.config["CACHE_L1_THRESHOLD"] = int(
+        os.environ.get("CACHE_L1_THRESHOLD", 1024))
+    app.config["CACHE_L1_TIMEOUT"] = int(os.environ.get("CACHE_L1_TIMEOUT", 5))
+    app.config["RESPONSE_CACHE"] = os.environ.get(
+        "RESPONSE_CACHE", "true").lower() == "true"
+    app.config["COMPRESSION"] = os.environ.get(
+        "COMPRESSION", "true").lower() == "true"
+    app.config["COMPRESSION_MIN_SIZE"] = int(
+        os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+    app.config["COMPRESSION_LEVEL"] = int(
+        os.environ.get("COMPRESSION_LEVEL", 6))
+    app.config["SWR_MAX_STALENESS"] = int(
+        os.environ.get("SWR_MAX_STALENESS", 30))
+    app.config["SWR_MAX_WORKERS"] = int(os.environ.get("SWR_MAX_WORKERS", 2))
+    app.config["TRAFFIC_STREAM_INTERVAL"] = float(
+        os.environ.get("TRAFFIC_STREAM_INTERVAL", 5))
+    app.config["TRAFFIC_STREAM_HEARTBEAT"] = float(
+        os.environ.get("TRAFFIC_STREAM_HEARTBEAT", 15))
+    app.config["TRAFFIC_STREAM_QUEUE_SIZE"] = int(
+        os.environ.get("TRAFFIC_STREAM_QUEUE_SIZE", 16))
+    app.config["TRAFFIC_TIME_RESOLUTION"] = int(
+        os.environ.get("TRAFFIC_TIME_RESOLUTION", 10))
+    app.config["TRAFFIC_HISTORY_BUCKET"] = int(
+        os.environ.get("TRAFFIC_HISTORY_BUCKET", 3600))
+    app.config["TRAFFIC_HISTORY_TIMEOUT"] = int(
+        os.environ.get("TRAFFIC_HISTORY_TIMEOUT", 24 * 3600))
+    app.config["TRAFFIC_HISTORY_CURRENT_TIMEOUT"] = int(
+        os.environ.get("TRAFFIC_HISTORY_CURRENT_TIMEOUT", 10))
+    app.config["TRAFFIC_HISTORY_MAX_BUCKETS"] = int(
+        os.environ.get("TRAFFIC_HISTORY_MAX_BUCKETS", 24 * 7))
+    app.config["WORKER_MODE"] = os.environ.get("WORKER_MODE", "sync").lower()
+    # gevent workers keep many upstream calls in flight at once, so they
+    # need a deeper pool for those connections to be reused
+    default_pool_size = 100 if app.config["WORKER_MODE"] == "async" else 10
+    app.config["HTTP_POOL_SIZE"] = int(
+        os.environ.get("HTTP_POOL_SIZE", default_pool_size))
+    app.config["HTTP_CONNECT_TIMEOUT"] = float(
+        os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05))
+    app.config["HTTP_READ_TIMEOUT"] = float(
+        os.environ.get("HTTP_READ_TIMEOUT", 10))
+    app.config["HTTP_MAX_RETRIES"] = int(os.environ.get("HTTP_MAX_RETRIES", 2))
+    app.config["HTTP_BACKOFF_FACTOR"] = float(
+        os.environ.get("HTTP_BACKOFF_FACTOR", 0.1))
+    app.config["HTTP_BREAKER_FAILURE_RATE"] = float(
+        os.environ.get("HTTP_BREAKER_FAILURE_RATE", 0.5))
+    app.config["HTTP_BREAKER_MIN_CALLS"] = int(
+        os.environ.get("HTTP_BREAKER_MIN_CALLS", 10))
+    app.config["HTTP_BREAKER_WINDOW"] = int(
+        os.environ.get("HTTP_BREAKER_WINDOW", 50))
+    app.config["HTTP_BREAKER_SLOW_CALL"] = float(
+        os.environ.get("HTTP_BREAKER_SLOW_CALL", 2))
+    app.config["HTTP_BREAKER_RESET_TIMEOUT"] = float(
+        os.environ.get("HTTP_BREAKER_RESET_TIMEOUT", 30))
+    app.config["HTTP_HEDGE"] = os.environ.get(
+        "HTTP_HEDGE", "false").lower() == "true"
+    app.config["HTTP_HEDGE_MIN_DELAY"] = float(
+        os.environ.get("HTTP_HEDGE_MIN_DELAY", 0.05))
+    app.config["DATA_STORE_LAST_GOOD_TIMEOUT"] = int(
+        os.environ.get("DATA_STORE_LAST_GOOD_TIMEOUT", 3600))
+    app.config["ACCESS_LOG_PATH"] = os.environ.get("ACCESS_LOG_PATH")
 
 
 def register_blueprints(app):
@@ -52,7 +124,12 @@ def register_blueprints(app):
     """
     from app.routes.locations.routes import locations_bp
     from app.routes.sensors.routes import sensors_bp
-    from app.routes.traffic.routes import traffic_bp
+    from app.routes.traffic.routes import traffic_bp, batch_traffic_bp
+    from app.routes.stats.routes import stats_bp
+    from app.routes.metrics.routes import metrics_bp
     app.register_blueprint(locations_bp)
     app.register_blueprint(sensors_bp)
     app.register_blueprint(traffic_bp)
+    app.register_blueprint(batch_traffic_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(metrics_bp)
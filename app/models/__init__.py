@@ -1,6 +1,27 @@
 from .utils import setup_db
+from .http_client import HttpClient
+from .response_cache import ResponseCache
+from .compression import Compressor
+from .metrics import RequestMetrics
+from .access_log import AccessLog
+from .stale_cache import StaleWhileRevalidate
+# Import the cache backend before binding `cache` below, otherwise a later
+# `import app.models.cache` would shadow the Cache instance with the module
+from . import cache as cache_backend  # noqa: F401
 from flask_caching import Cache
 
 
 db = setup_db()
 cache = Cache()
+http = HttpClient()
+response_cache = ResponseCache(cache)
+compressor = Compressor(response_cache)
+request_metrics = RequestMetrics()
+access_log = AccessLog()
+swr = StaleWhileRevalidate(cache)
+
+
+def invalidate(*keys):
+    """Drops cached documents along with any responses built from them"""
+    cache.delete_many(*keys)
+    response_cache.delete_many(*keys)
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+import time
+
+from flask import g, request
+
+
+class AccessLog:
+    """
+    Appends one compact JSON line per request to ACCESS_LOG_PATH, in the
+    format benchmarks/replay.py reads:
+
+        {"t": start (unix seconds), "m": method, "p": path, "q": query,
+         "r": route rule, "s": status, "ms": duration, "x": X-Cache}
+
+    Empty fields are left out. Disabled when ACCESS_LOG_PATH is not set.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self.path = None
+
+    def init_app(self, app):
+        self.path = app.config["ACCESS_LOG_PATH"]
+        if not self.path:
+            return
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.access_log_started = (time.time(), time.perf_counter())
+
+    def after_request(self, response):
+        started = g.get("access_log_started")
+        if started is None:
+            return response
+        started_at, started_counter = started
+        entry = {
+            "t": round(started_at, 3),
+            "m": request.method,
+            "p": request.path,
+            "q": request.query_string.decode("latin-1"),
+            "r": request.url_rule.rule if request.url_rule else None,
+            "s": response.status_code,
+            "ms": round((time.perf_counter() - started_counter) * 1000, 2),
+            "x": response.headers.get("X-Cache"),
+        }
+        self.write({key: value for key, value in entry.items() if value})
+        return response
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            # Every gunicorn worker appends to the same file through its
+            # own handle, one whole line per write
+            if self._pid != os.getpid():
+                self._file = open(self.path, "a", buffering=1)
+                self._pid = os.getpid()
+            self._file.write(line)
@@ -1,8 +1,71 @@
+from collections import OrderedDict
+import pickle
+import threading
+import time
+
 from flask_caching.backends import MemcachedCache
+from flask_caching.backends.base import BaseCache
 import bmemcached
 
+from .metrics import CACHE_REQUESTS, MEMCACHED_LATENCY, timed
+
+CACHE_RESULTS = {"hits": "hit", "misses": "miss"}
+
+
+class LRUCache:
+    """
+    Bounded, TTL-limited in-process cache
+
+    Values are stored pickled so callers get their own copy on every hit,
+    exactly as they would from memcached.
+    """
+    def __init__(self, threshold=1024, default_timeout=5):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None or timeout <= 0 or timeout > self.default_timeout:
+            timeout = self.default_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._items[key] = (time.monotonic() + timeout, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.threshold:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
 
 class BMemcachedCache(MemcachedCache):
+    """
+    Memcached (L2) backend with a short-lived per-worker LRU (L1) in front
+
+    Writes and deletes go through both tiers. Other workers may serve an L1
+    value for up to l1_timeout seconds after it changed.
+    """
     def __init__(
         self,
         servers=None,
@@ -10,6 +73,8 @@ class BMemcachedCache(MemcachedCache):
         key_prefix=None,
         username=None,
         password=None,
+        l1_threshold=1024,
+        l1_timeout=5,
         **kwargs
     ):
         super(BMemcachedCache, self).__init__(default_timeout)
@@ -22,11 +87,120 @@ class BMemcachedCache(MemcachedCache):
         )
 
         self.key_prefix = key_prefix
+        self._l1 = LRUCache(l1_threshold, l1_timeout) if l1_threshold else None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "l1_hits": 0, "l1_misses": 0, "l2_hits": 0, "l2_misses": 0,
+        }
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+        for name, count in counts.items():
+            if count:
+                tier, result = name.split("_")
+                CACHE_REQUESTS.labels(
+                    tier=tier, result=CACHE_RESULTS[result]).inc(count)
+
+    def _l1_timeout(self, timeout):
+        return BaseCache._normalize_timeout(self, timeout)
+
+    def get(self, key):
+        if self._l1 is not None:
+            value = self._l1.get(key)
+            if value is not None:
+                self._count(l1_hits=1)
+                return value
+            self._count(l1_misses=1)
+        with timed(MEMCACHED_LATENCY, operation="get"):
+            value = super(BMemcachedCache, self).get(key)
+        if value is None:
+            self._count(l2_misses=1)
+            return None
+        self._count(l2_hits=1)
+        if self._l1 is not None:
+            self._l1.set(key, value)
+        return value
+
+    def get_dict(self, *keys):
+        found = {}
+        missing = list(keys)
+        if self._l1 is not None:
+            missing = []
+            for key in keys:
+                value = self._l1.get(key)
+                if value is None:
+                    missing.append(key)
+                else:
+                    found[key] = value
+            self._count(l1_hits=len(found), l1_misses=len(missing))
+        if missing:
+            with timed(MEMCACHED_LATENCY, operation="get_multi"):
+                fetched = super(BMemcachedCache, self).get_dict(*missing)
+            hits = {k: v for k, v in fetched.items() if v is not None}
+            self._count(l2_hits=len(hits), l2_misses=len(missing) - len(hits))
+            if self._l1 is not None:
+                for key, value in hits.items():
+                    self._l1.set(key, value)
+            found.update(fetched)
+        return {key: found.get(key) for key in keys}
 
     def set(self, key, value, timeout=None):
+        if self._l1 is not None:
+            self._l1.set(key, value, self._l1_timeout(timeout))
         key = self._normalize_key(key)
         timeout = self._normalize_timeout(timeout)
-        return self._client.set(key, value, time=timeout)
+        with timed(MEMCACHED_LATENCY, operation="set"):
+            return self._client.set(key, value, time=timeout)
+
+    def add(self, key, value, timeout=None):
+        with timed(MEMCACHED_LATENCY, operation="add"):
+            added = super(BMemcachedCache, self).add(key, value, timeout)
+        if added and self._l1 is not None:
+            self._l1.set(key, value, self._l1_timeout(timeout))
+        return added
+
+    def set_many(self, mapping, timeout=None):
+        if self._l1 is not None:
+            for key, value in mapping.items():
+                self._l1.set(key, value, self._l1_timeout(timeout))
+        with timed(MEMCACHED_LATENCY, operation="set_multi"):
+            return super(BMemcachedCache, self).set_many(mapping, timeout)
+
+    def delete(self, key):
+        if self._l1 is not None:
+            self._l1.delete(key)
+        with timed(MEMCACHED_LATENCY, operation="delete"):
+            return super(BMemcachedCache, self).delete(key)
+
+    def delete_many(self, *keys):
+        if self._l1 is not None:
+            for key in keys:
+                self._l1.delete(key)
+        with timed(MEMCACHED_LATENCY, operation="delete_multi"):
+            return super(BMemcachedCache, self).delete_many(*keys)
+
+    def clear(self):
+        if self._l1 is not None:
+            self._l1.clear()
+        return super(BMemcachedCache, self).clear()
+
+    def inc(self, key, delta=1):
+        if self._l1 is not None:
+            self._l1.delete(key)
+        return super(BMemcachedCache, self).inc(key, delta)
+
+    def dec(self, key, delta=1):
+        if self._l1 is not None:
+            self._l1.delete(key)
+        return super(BMemcachedCache, self).dec(key, delta)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["l1_size"] = len(self._l1) if self._l1 is not None else 0
+        return stats
 
 
 def cache(app, config, args, kwargs):
@@ -34,5 +208,7 @@ def cache(app, config, args, kwargs):
         servers=config["CACHE_MEMCACHED_SERVERS"],
         username=config["CACHE_MEMCACHED_USERNAME"],
         password=config["CACHE_MEMCACHED_PASSWORD"],
+        l1_threshold=config["CACHE_L1_THRESHOLD"],
+        l1_timeout=config["CACHE_L1_TIMEOUT"],
         *args, **kwargs,
     )
@@ -0,0 +1,116 @@
+from collections import deque
+import threading
+import time
+
+import requests
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of the last `window` calls to one upstream
+
+    Once at least `min_calls` were made and the share of failed calls
+    (errors, 5xx replies or calls slower than `slow_call` seconds) reaches
+    `failure_rate`, the circuit opens and calls fail fast for
+    `reset_timeout` seconds. After that a single trial call is let through:
+    success closes the circuit, failure opens it again.
+    """
+    def __init__(self, failure_rate=0.5, min_calls=10, window=50,
+                 slow_call=2.0, reset_timeout=30):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._trial_running = False
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (
+            self._state == OPEN
+            and time.monotonic() - self._opened_at >= self.reset_timeout
+        ):
+            self._state = HALF_OPEN
+            self._trial_running = False
+        return self._state
+
+    def before_call(self):
+        """Raises CircuitOpenError unless a call may be made now"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self._stats["rejected"] += 1
+        raise CircuitOpenError("Circuit open, upstream call skipped")
+
+    def record(self, latency, failed):
+        failed = failed or latency >= self.slow_call
+        with self._lock:
+            self._stats["calls"] += 1
+            self._latencies.append(latency)
+            if failed:
+                self._stats["failures"] += 1
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._trial_running = False
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if (
+                state == CLOSED
+                and len(self._outcomes) >= self.min_calls
+                and sum(self._outcomes) / len(self._outcomes)
+                >= self.failure_rate
+            ):
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._stats["opened"] += 1
+
+    def latency_percentile(self, percentile):
+        """Latency of recent calls at the given percentile, None if none"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = min(int(len(latencies) * percentile / 100),
+                    len(latencies) - 1)
+        return latencies[index]
+
+    def stats(self):
+        with self._lock:
+            state = self._current_state()
+            outcomes = list(self._outcomes)
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "state": state,
+            "failure_rate": sum(outcomes) / len(outcomes) if outcomes else 0,
+            "p95_latency": self.latency_percentile(95),
+        }
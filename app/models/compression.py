@@ -0,0 +1,76 @@
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip is always available
+    brotli = None
+
+# Preferred first when the client accepts several equally
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/html"}
+
+
+def compress(body, encoding, level):
+    if encoding == "br":
+        # Brotli's top qualities are far too slow for per-request use
+        return brotli.compress(body, quality=min(level, 5))
+    return gzip.compress(body, compresslevel=level)
+
+
+def encoded_etag(etag, encoding):
+    """Each encoding of a representation needs its own strong ETag"""
+    return "{}-{}".format(etag, encoding)
+
+
+class Compressor:
+    """
+    Compresses responses of at least COMPRESSION_MIN_SIZE bytes with the
+    best encoding the client accepts. Responses replayed from (or stored
+    in) the response cache keep their compressed variants in the same
+    cache entry, so a popular payload is only compressed once.
+    """
+    def __init__(self, response_cache):
+        self.response_cache = response_cache
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        config = self.app.config
+        if (
+            not config["COMPRESSION"]
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code != 200
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.content_length is None
+            or response.content_length < config["COMPRESSION_MIN_SIZE"]
+        ):
+            return response
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding is None:
+            return response
+
+        variants = getattr(response, "compressed_variants", {})
+        body = variants.get(encoding)
+        if body is None:
+            body = compress(
+                response.get_data(), encoding, config["COMPRESSION_LEVEL"])
+            cache_key = getattr(response, "cache_key", None)
+            if cache_key is not None:
+                self.response_cache.add_variant(
+                    cache_key, response.get_etag()[0], encoding, body)
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
@@ -0,0 +1,197 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .metrics import UPSTREAM_LATENCY, UPSTREAM_RESPONSES
+
+
+class HttpClient:
+    """
+    Barebones pooled wrapper for requests.Session
+
+    One keep-alive session is kept per worker process so that proxied calls
+    to the data store and simulator reuse TCP/TLS connections instead of
+    paying a handshake on every request.
+
+    Every upstream host gets a CircuitBreaker, so a failing or slow
+    upstream fails fast instead of tying up workers. With HTTP_HEDGE set,
+    a GET that takes longer than the host's recent p95 latency is sent a
+    second time and the first reply wins.
+    """
+    def __init__(self):
+        self.app = None
+        self._session = None
+        self._executor = None
+        self._pid = None
+        self._executor_pid = None
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._hedges = 0
+
+    def init_app(self, app):
+        self.app = app
+        self._session = None
+        self._executor = None
+        self._breakers = {}
+
+    @property
+    def session(self):
+        # gunicorn forks workers after import, so never share a pool
+        # (and its open sockets) with a parent process
+        if self._session is None or self._pid != os.getpid():
+            self._session = self._make_session()
+            self._pid = os.getpid()
+        return self._session
+
+    @property
+    def executor(self):
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.app.config["HTTP_POOL_SIZE"])
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def breaker(self, url):
+        host = urlparse(url).netloc
+        with self._breakers_lock:
+            if host not in self._breakers:
+                config = self.app.config
+                self._breakers[host] = CircuitBreaker(
+                    failure_rate=config["HTTP_BREAKER_FAILURE_RATE"],
+                    min_calls=config["HTTP_BREAKER_MIN_CALLS"],
+                    window=config["HTTP_BREAKER_WINDOW"],
+                    slow_call=config["HTTP_BREAKER_SLOW_CALL"],
+                    reset_timeout=config["HTTP_BREAKER_RESET_TIMEOUT"],
+                )
+            return self._breakers[host]
+
+    def _make_session(self):
+        config = self.app.config
+        retries = Retry(
+            total=config["HTTP_MAX_RETRIES"],
+            backoff_factor=config["HTTP_BACKOFF_FACTOR"],
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config["HTTP_POOL_SIZE"],
+            pool_maxsize=config["HTTP_POOL_SIZE"],
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def timeout(self):
+        return (
+            self.app.config["HTTP_CONNECT_TIMEOUT"],
+            self.app.config["HTTP_READ_TIMEOUT"],
+        )
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes one call through the host's circuit breaker. Raises
+        CircuitOpenError without calling the upstream while it is open
+        """
+        kwargs.setdefault("timeout", self.timeout())
+        upstream = urlparse(url).netloc
+        breaker = self.breaker(url)
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            UPSTREAM_RESPONSES.labels(
+                upstream=upstream, method=method, status="circuit_open",
+            ).inc()
+            raise
+        started = time.monotonic()
+        try:
+            response = getattr(self.session, method)(url, **kwargs)
+        except requests.RequestException:
+            latency = time.monotonic() - started
+            breaker.record(latency, failed=True)
+            UPSTREAM_LATENCY.labels(
+                upstream=upstream, method=method).observe(latency)
+            UPSTREAM_RESPONSES.labels(
+                upstream=upstream, method=method, status="error").inc()
+            raise
+        latency = time.monotonic() - started
+        breaker.record(latency, failed=response.status_code >= 500)
+        UPSTREAM_LATENCY.labels(
+            upstream=upstream, method=method).observe(latency)
+        UPSTREAM_RESPONSES.labels(
+            upstream=upstream, method=method, status=response.status_code,
+        ).inc()
+        return response
+
+    def hedge_delay(self, url):
+        """Seconds to wait before hedging a GET, None to not hedge"""
+        p95 = self.breaker(url).latency_percentile(95)
+        if p95 is None:
+            return None
+        return max(p95, self.app.config["HTTP_HEDGE_MIN_DELAY"])
+
+    def get(self, url, **kwargs):
+        delay = None
+        if self.app.config["HTTP_HEDGE"]:
+            delay = self.hedge_delay(url)
+        if delay is None:
+            return self.request("get", url, **kwargs)
+        pending = {self.executor.submit(self.request, "get", url, **kwargs)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            with self._breakers_lock:
+                self._hedges += 1
+            pending.add(
+                self.executor.submit(self.request, "get", url, **kwargs))
+        error = None
+        while True:
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as err:
+                    error = err
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+    def stats(self):
+        """Connection reuse counters summed over every pooled host"""
+        stats = {"pools": 0, "connections": 0, "requests": 0}
+        if self._session is None or self._pid != os.getpid():
+            return {**stats, "reused": 0}
+        # the same adapter is mounted for both http:// and https://
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats["pools"] += 1
+                stats["connections"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+        stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+        return stats
+
+    def breaker_stats(self):
+        """Circuit breaker state and counters per upstream host"""
+        with self._breakers_lock:
+            breakers = dict(self._breakers)
+            hedges = self._hedges
+        return {
+            "hedged_requests": hedges,
+            "upstreams": {
+                host: breaker.stats() for host, breaker in breakers.items()
+            },
+        }
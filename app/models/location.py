@@ -4,7 +4,9 @@ import uuid
 
 from .base_model import BaseModel
 from .utils import DatabaseContainerEnum
-from . import db, cache
+from . import db, cache, invalidate, swr
+
+ALL_LOCATIONS_TIMEOUT = 300
 
 
 class Location(BaseModel):
@@ -41,12 +43,31 @@ class Location(BaseModel):
         return location
 
     @staticmethod
-    @cache.cached(key_prefix="all_locations")
     def all():
-        return db.query_all_items(Location.container_name)
+        return swr.get_or_set(
+            "all_locations",
+            lambda: db.query_all_items(Location.container_name),
+            ALL_LOCATIONS_TIMEOUT,
+        )
+
+    @staticmethod
+    def page(limit, continuation_token=None):
+        query = "SELECT * FROM {}".format(Location.container_name)
+        return db.query_page(
+            Location.container_name, query,
+            page_size=limit, continuation_token=continuation_token,
+        )
+
+    @staticmethod
+    def stream():
+        query = "SELECT * FROM {}".format(Location.container_name)
+        return db.iter_items(Location.container_name, query)
 
     @staticmethod
     def delete(location_id):
-        cache.delete(Location.cache_prefix+location_id)
-        cache.delete("all_locations")
+        invalidate(
+            Location.cache_prefix+location_id,
+            "all_locations",
+            "sensorsFor:"+location_id,
+        )
         return db.delete_item(location_id, location_id, Location.container_name)
@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+import functools
+import inspect
+import os
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Histogram, generate_latest,
+                               multiprocess)
+
+# NOTE: under gunicorn, prometheus_multiproc_dir must point to an empty
+# directory before the app is imported, so that every worker writes its
+# samples there and /metrics can add them up (see gunicorn.conf.py)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests",
+    ["method", "route", "status"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by tier (l1 is per worker, l2 is memcached) and result",
+    ["tier", "result"],
+)
+MEMCACHED_LATENCY = Histogram(
+    "memcached_operation_duration_seconds",
+    "Time spent in memcached calls",
+    ["operation"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+COSMOS_LATENCY = Histogram(
+    "cosmos_operation_duration_seconds",
+    "Time spent in Cosmos DB calls",
+    ["method", "container"],
+)
+COSMOS_ERRORS = Counter(
+    "cosmos_operation_errors_total",
+    "Failed Cosmos DB calls",
+    ["method", "container", "status"],
+)
+COSMOS_REQUEST_UNITS = Counter(
+    "cosmos_request_units_total",
+    "Request units charged by Cosmos DB",
+    ["method", "container"],
+)
+REQUEST_UNITS = Counter(
+    "http_request_units_total",
+    "Cosmos DB request units charged while handling requests",
+    ["method", "route"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Time spent calling the data store and simulator",
+    ["upstream", "method"],
+)
+UPSTREAM_RESPONSES = Counter(
+    "upstream_responses_total",
+    "Data store and simulator replies by status ('error' if none)",
+    ["upstream", "method", "status"],
+)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+# The DatabaseClient operation in flight, per thread (per greenlet once
+# gevent has patched threading) so that concurrent calls are told apart
+_operation = threading.local()
+
+
+class RequestCharge:
+    """Request units consumed while handling one Flask request"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0.0
+        self.operations = {}
+
+    def add(self, operation, charge):
+        # map_concurrently shares this across its worker threads
+        with self._lock:
+            self.total += charge
+            self.operations[operation] = (
+                self.operations.get(operation, 0.0) + charge)
+
+
+@contextmanager
+def charged_to(method, container):
+    """Attributes the Cosmos calls made in this block to method/container"""
+    previous = getattr(_operation, "labels", None)
+    _operation.labels = (method, container)
+    try:
+        yield
+    finally:
+        _operation.labels = previous
+
+
+def record_request_charge(response):
+    """
+    raw_response_hook for the CosmosClient: called with every HTTP response,
+    including each page of a query
+    """
+    charge = response.http_response.headers.get(REQUEST_CHARGE_HEADER)
+    if charge is None:
+        return
+    charge = float(charge)
+    method, container = (
+        getattr(_operation, "labels", None) or ("unknown", "unknown"))
+    COSMOS_REQUEST_UNITS.labels(method=method, container=container).inc(charge)
+    if has_app_context():
+        request_charge = g.get("request_charge")
+        if request_charge is not None:
+            request_charge.add(method, charge)
+
+
+def cosmos_operation(method):
+    """
+    Times a DatabaseClient method, labelled with its container_name, and
+    attributes the request units its calls are charged to it
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        container = signature.bind(*args, **kwargs).arguments.get(
+            "container_name", "unknown")
+        started = time.perf_counter()
+        try:
+            with charged_to(method.__name__, container):
+                return method(*args, **kwargs)
+        except Exception as error:
+            COSMOS_ERRORS.labels(
+                method=method.__name__,
+                container=container,
+                status=getattr(error, "status_code", None) or "error",
+            ).inc()
+            raise
+        finally:
+            COSMOS_LATENCY.labels(
+                method=method.__name__, container=container,
+            ).observe(time.perf_counter() - started)
+    return wrapper
+
+
+def collect():
+    """Metrics in the Prometheus text format, summed over all workers"""
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class RequestMetrics:
+    """
+    Observes the latency and Cosmos request units of every request, per
+    route. In debug mode the units are also returned in X-Request-Charge.
+    """
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        g.request_started = time.perf_counter()
+        g.request_charge = RequestCharge()
+
+    def after_request(self, response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        # The rule rather than the path, to keep ids out of the labels
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(
+            method=request.method,
+            route=route,
+            status=response.status_code,
+        ).observe(time.perf_counter() - started)
+        # NOTE: Pages a streamed response fetches after this point are only
+        # counted in cosmos_request_units_total
+        request_charge = g.request_charge
+        REQUEST_UNITS.labels(
+            method=request.method, route=route,
+        ).inc(request_charge.total)
+        if current_app.debug:
+            response.headers["X-Request-Charge"] = "{:.2f}".format(
+                request_charge.total)
+            if request_charge.operations:
+                response.headers["X-Request-Charge-Operations"] = ", ".join(
+                    "{}={:.2f}".format(operation, charge)
+                    for operation, charge
+                    in sorted(request_charge.operations.items()))
+        return response
@@ -0,0 +1,122 @@
+import hashlib
+from http import HTTPStatus
+
+from flask import request, Response
+
+from .compression import ENCODINGS, encoded_etag
+
+
+def document_etag(document):
+    """Strong ETag for a single Cosmos document, from its _etag"""
+    etag = document.get("_etag")
+    return etag.strip('"') if etag else None
+
+
+def list_etag(documents, *extra):
+    """
+    Combined strong ETag for a list of documents: changes whenever any
+    document is added, removed or modified
+    """
+    digest = hashlib.sha1()
+    for document in documents:
+        digest.update("{}:{};".format(
+            document.get("id"), document.get("_etag")).encode())
+    for value in extra:
+        digest.update(str(value).encode())
+    return digest.hexdigest()
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already holds etag, in any
+    encoding
+    """
+    if not etag:
+        return None
+    candidates = [etag] + [
+        encoded_etag(etag, encoding) for encoding in ENCODINGS
+    ]
+    for candidate in candidates:
+        if request.if_none_match.contains(candidate):
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
+            response.set_etag(candidate)
+            return response
+    return None
+
+
+class ResponseCache:
+    """
+    Caches the final encoded body of GET responses, keyed by the same keys
+    as the documents they were built from, and replays it byte for byte.
+    Entries must be dropped whenever those documents change, see
+    app.models.invalidate.
+    """
+    prefix = "response:"
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config["RESPONSE_CACHE"]
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or a 304 straight from the
+        cached ETag when the client's If-None-Match matches it
+        """
+        if not self.enabled:
+            return None
+        entry = self.cache.get(self.prefix+key)
+        if entry is None:
+            return None
+        response = not_modified(entry["etag"])
+        if response is None:
+            response = Response(
+                entry["body"], content_type=entry["content_type"])
+            response.set_etag(entry["etag"])
+            # Lets Compressor reuse or store compressed bodies
+            response.cache_key = key
+            response.compressed_variants = entry.get("variants", {})
+        response.headers["X-Cache"] = "HIT"
+        return response
+
+    def set(self, key, response, etag=None, timeout=None):
+        """
+        Tags response with etag (a hash of the body by default) and caches
+        it. Returns the response
+        """
+        body = response.get_data()
+        if etag is None:
+            etag = hashlib.sha1(body).hexdigest()
+        response.set_etag(etag)
+        if not self.enabled:
+            return response
+        self.cache.set(self.prefix+key, {
+            "body": body,
+            "etag": etag,
+            "content_type": response.content_type,
+            "variants": {},
+            "timeout": timeout,
+        }, timeout=timeout)
+        response.cache_key = key
+        response.headers["X-Cache"] = "MISS"
+        return response
+
+    def add_variant(self, key, etag, encoding, body):
+        """
+        Stores the body compressed with encoding in the entry for key,
+        unless the entry was replaced since etag was served
+        """
+        entry = self.cache.get(self.prefix+key)
+        if entry is None or entry["etag"] != etag:
+            return
+        entry.setdefault("variants", {})[encoding] = body
+        self.cache.set(self.prefix+key, entry, timeout=entry.get("timeout"))
+
+    def delete_many(self, *keys):
+        return self.cache.delete_many(*[self.prefix+key for key in keys])
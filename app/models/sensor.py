@@ -2,8 +2,9 @@ import json
 import uuid
 import datetime as dt
 from .base_model import BaseModel
-from .utils import DatabaseContainerEnum
-from . import db, cache
+from .utils import (DatabaseContainerEnum, BATCH_OPERATION_DELETE,
+                    BATCH_OPERATION_UPSERT)
+from . import db, cache, invalidate
 
 
 class Sensor(BaseModel):
@@ -27,14 +28,35 @@ class Sensor(BaseModel):
             self.updated_at = dt.datetime.utcnow().replace(microsecond=0)
         self.location_id = location_id
 
+    index_prefix = "sensorLocation:"
+
+    @staticmethod
+    def index_location(sensor_id, location_id):
+        # sensor id -> location id (partition key), kept until deleted
+        cache.set(Sensor.index_prefix+sensor_id, location_id, timeout=0)
+
+    @staticmethod
+    def get_location_id(sensor_id):
+        location_id = cache.get(Sensor.index_prefix+sensor_id)
+        if location_id:
+            return location_id
+        # Only sensors missing from the index (e.g. evicted) pay for a
+        # cross-partition query, after which they are re-indexed
+        sensor = db.get_item_with_id(sensor_id, Sensor.container_name)
+        if sensor is None:
+            return None
+        Sensor.index_location(sensor_id, sensor["locationId"])
+        return sensor["locationId"]
+
     @staticmethod
     def get_by_id(sensor_id):
         cached_sensor = cache.get(Sensor.cache_prefix+sensor_id)
         if cached_sensor:
             return cached_sensor
-        sensor = db.get_item_with_id(sensor_id, Sensor.container_name)
-        cache.set(Sensor.cache_prefix+sensor_id, sensor)
-        return sensor
+        location_id = Sensor.get_location_id(sensor_id)
+        if location_id is None:
+            return None
+        return Sensor.get_by_id_and_location_id(sensor_id, location_id)
 
     @staticmethod
     def get_by_id_and_location_id(sensor_id, location_id):
@@ -62,6 +84,25 @@ class Sensor(BaseModel):
         cache.set("sensorsFor:"+location_id, sensors)
         return sensors
 
+    @staticmethod
+    def page_for_location(location_id, limit, continuation_token=None):
+        query = "SELECT * FROM {} c WHERE c.locationId = '{}'".format(
+            Sensor.container_name,
+            location_id,
+        )
+        return db.query_page(
+            Sensor.container_name, query, location_id,
+            page_size=limit, continuation_token=continuation_token,
+        )
+
+    @staticmethod
+    def stream_for_location(location_id):
+        query = "SELECT * FROM {} c WHERE c.locationId = '{}'".format(
+            Sensor.container_name,
+            location_id,
+        )
+        return db.iter_items(Sensor.container_name, query, location_id)
+
     @staticmethod
     def all():
         return db.query_all_items(Sensor.container_name)
@@ -69,6 +110,42 @@ class Sensor(BaseModel):
     @staticmethod
     def delete(sensor_id, location_id):
         # Does not delete ID from parent location
-        cache.delete(Sensor.cache_prefix+sensor_id)
-        cache.delete("sensorsFor:"+location_id)
+        invalidate(
+            Sensor.cache_prefix+sensor_id,
+            Sensor.index_prefix+sensor_id,
+            "sensorsFor:"+location_id,
+        )
         return db.delete_item(sensor_id, location_id, Sensor.container_name)
+
+    @staticmethod
+    def upsert_batch(items, location_id):
+        """Atomically upserts up to BATCH_LIMIT sensors of one location"""
+        upserted = db.execute_partition_batch(
+            Sensor.container_name,
+            location_id,
+            [{
+                "operationType": BATCH_OPERATION_UPSERT,
+                "resourceBody": item,
+            } for item in items],
+        )
+        invalidate("sensorsFor:"+location_id)
+        return upserted
+
+    @staticmethod
+    def delete_batch(sensor_ids, location_id):
+        """Atomically deletes up to BATCH_LIMIT sensors of one location"""
+        # Does not delete IDs from parent location
+        invalidate("sensorsFor:"+location_id, *[
+            key
+            for sensor_id in sensor_ids
+            for key in (Sensor.cache_prefix+sensor_id,
+                        Sensor.index_prefix+sensor_id)
+        ])
+        return db.execute_partition_batch(
+            Sensor.container_name,
+            location_id,
+            [{
+                "operationType": BATCH_OPERATION_DELETE,
+                "id": sensor_id,
+            } for sensor_id in sensor_ids],
+        )
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import threading
+import time
+
+
+class StaleWhileRevalidate:
+    """
+    Serves cached values for up to SWR_MAX_STALENESS seconds past their
+    timeout while one background worker recomputes them
+
+    Refreshes are only triggered by reads, so keys nobody asks for again
+    simply expire. A cache.add lock makes sure only one worker process
+    refreshes a given key at a time.
+    """
+    lock_prefix = "refreshing:"
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.app = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._pending = set()
+        self._stats = {
+            "fresh_hits": 0, "stale_hits": 0, "misses": 0,
+            "refreshes": 0, "refresh_errors": 0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def max_staleness(self):
+        return self.app.config["SWR_MAX_STALENESS"]
+
+    @property
+    def executor(self):
+        # Threads do not survive gunicorn's fork, start a pool per worker
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.app.config["SWR_MAX_WORKERS"])
+            self._pid = os.getpid()
+            self._refreshing = set()
+            self._pending = set()
+        return self._executor
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def set(self, key, value, timeout):
+        """Caches value as fresh for timeout seconds. None is not cached"""
+        if value is not None:
+            self.cache.set(key, {
+                "value": value,
+                "fresh_until": time.time() + timeout,
+            }, timeout=timeout + self.max_staleness)
+        return value
+
+    def get(self, key, refresh_fn, timeout):
+        """
+        Returns the cached value for key, or None on a miss. A stale value
+        is returned as is while refresh_fn recomputes it in the background.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            self._count("misses")
+            return None
+        if time.time() < entry["fresh_until"]:
+            self._count("fresh_hits")
+        else:
+            self._count("stale_hits")
+            self.refresh(key, refresh_fn, timeout)
+        return entry["value"]
+
+    def get_or_set(self, key, fn, timeout):
+        """Like get, but computes and caches the value with fn on a miss"""
+        value = self.get(key, fn, timeout)
+        if value is None:
+            value = self.set(key, fn(), timeout)
+        return value
+
+    def refresh(self, key, fn, timeout):
+        """
+        Recomputes key with fn on the background pool, unless a refresh of
+        key is already running in any worker. If fn returns None the stale
+        value is kept.
+        """
+        executor = self.executor
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        # Expires on its own so a crashed worker cannot block the key
+        lock_timeout = int(self.app.config["HTTP_READ_TIMEOUT"]) + 1
+        if not self.cache.add(self.lock_prefix+key, True,
+                              timeout=lock_timeout):
+            with self._lock:
+                self._refreshing.discard(key)
+            return
+        future = executor.submit(self._refresh, key, fn, timeout)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _refresh(self, key, fn, timeout):
+        try:
+            with self.app.app_context():
+                self.set(key, fn(), timeout)
+            self._count("refreshes")
+        except Exception as error:
+            print("Could not refresh cached value: ", key,
+                  error)  # TODO: Implement logging
+            self._count("refresh_errors")
+        finally:
+            self.cache.delete(self.lock_prefix+key)
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self, timeout=None):
+        """Blocks until the background refreshes started so far finish"""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._refreshing)}
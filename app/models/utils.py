@@ -1,11 +1,64 @@
 from enum import Enum
 import os
 
-from azure.cosmos import CosmosClient
+from azure.core import MatchConditions
+from azure.cosmos import CosmosClient, exceptions
 from dotenv import load_dotenv
 from flask import current_app
 
+from .metrics import charged_to, cosmos_operation, record_request_charge
+
 QUERY_LIMIT = 100
+# Max operations per partition batch, kept well within the time budget a
+# single stored procedure execution is allowed
+BATCH_LIMIT = 100
+BATCH_OPERATION_UPSERT = "Upsert"
+BATCH_OPERATION_DELETE = "Delete"
+BATCH_STORED_PROCEDURE = {
+    "id": "partitionBatch",
+    "body": """
+function partitionBatch(operations) {
+    var collection = getContext().getCollection();
+    var collectionLink = collection.getSelfLink();
+    // Documents are addressed by id, which only the name based link allows
+    var documentsLink = collection.getAltLink() + "/docs/";
+    var results = [];
+    var index = 0;
+    next();
+
+    function next() {
+        if (index >= operations.length) {
+            getContext().getResponse().setBody(results);
+            return;
+        }
+        var operation = operations[index];
+        var accepted;
+        if (operation.operationType === "Upsert") {
+            accepted = collection.upsertDocument(
+                collectionLink, operation.resourceBody, done);
+        } else if (operation.operationType === "Delete") {
+            accepted = collection.deleteDocument(
+                documentsLink + operation.id, done);
+        } else {
+            throw new Error("Unknown operation " + operation.operationType);
+        }
+        // Throwing aborts the script and rolls back every operation
+        if (!accepted) throw new Error("Batch exceeded its time budget");
+    }
+
+    function done(error, resource) {
+        var operation = operations[index];
+        var missing = error && error.number === 404;
+        if (error && !(missing && operation.operationType === "Delete")) {
+            throw error;
+        }
+        results.push(resource || {id: operation.id});
+        index++;
+        next();
+    }
+}
+""",
+}
 
 class DatabaseContainerEnum(Enum):
     LOCATIONS = 'locations'
@@ -28,8 +81,10 @@ class DatabaseClient:
             raise ValueError("Container name: {} not found".format(container_name))
         return self.containers[container_name]
 
+    @cosmos_operation
     def query_items(self, container_name, query, partition_key=None):
-        # TODO: For scaling purposes, look into pagination
+        # NOTE: Loads every result, prefer query_page/iter_items for
+        # queries that can grow with the container
         items = self.get_container(container_name).query_items(
             query,
             partition_key=partition_key,
@@ -37,6 +92,44 @@ class DatabaseClient:
         )
         return [item for item in items]
 
+    @cosmos_operation
+    def query_page(self, container_name, query, partition_key=None,
+                   page_size=QUERY_LIMIT, continuation_token=None):
+        """
+        Returns at most page_size items and the continuation token for the
+        next page (None once the query is exhausted)
+        """
+        items = self.get_container(container_name).query_items(
+            query,
+            partition_key=partition_key,
+            enable_cross_partition_query=(partition_key is None),
+            max_item_count=page_size,
+        )
+        pages = items.by_page(continuation_token)
+        page = [item for item in next(pages, [])]
+        return page, pages.continuation_token
+
+    def iter_items(self, container_name, query, partition_key=None,
+                   page_size=QUERY_LIMIT):
+        """Lazily yields items, holding at most one page in memory"""
+        items = self.get_container(container_name).query_items(
+            query,
+            partition_key=partition_key,
+            enable_cross_partition_query=(partition_key is None),
+            max_item_count=page_size,
+        )
+        pages = items.by_page()
+        while True:
+            # Pages are fetched lazily, outside of any cosmos_operation
+            with charged_to("iter_items", container_name):
+                page = next(pages, None)
+                if page is None:
+                    return
+                page = list(page)
+            for item in page:
+                yield item
+
+    @cosmos_operation
     def query_all_items(self, container_name):
         if container_name not in self.containers:
             raise ValueError("Container name: {} not found".format(container_name))
@@ -47,6 +140,7 @@ class DatabaseClient:
         )
         return [item for item in items]
 
+    @cosmos_operation
     def get_item_with_id(self, item_id, container_name):
         # NOTE:INEFFICIENT DUE TO LACK OF PARTITION KEY
         if container_name not in self.containers:
@@ -56,30 +150,79 @@ class DatabaseClient:
             "SELECT * FROM {} c WHERE c.id = '{}' OFFSET 0 LIMIT 1".format(container_id, item_id),
             enable_cross_partition_query=True,
         )
-        return items[0] if len(items) > 0 else None
+        return next(iter(items), None)
 
+    @cosmos_operation
     def get_item_with_id_and_partition_key(self, item_id, partition_key, container_name):
         if container_name not in self.containers:
             raise ValueError("Container name: {} not found".format(container_name))
         return self.containers[container_name].read_item(item_id, partition_key)
 
+    @cosmos_operation
     def upsert_item(self, item, container_name):
         """Upsert single item into DB. Returns the upserted item"""
         if container_name not in self.containers:
             raise ValueError("Container name: {} not found".format(container_name))
         return self.containers[container_name].upsert_item(item)
 
-    def replace_item(self, old_item, new_item, container_name):
+    @cosmos_operation
+    def replace_item(self, old_item, new_item, container_name, etag=None):
+        """
+        Replaces old_item with new_item. If etag is given the replace only
+        succeeds while the stored item still has that _etag, otherwise
+        CosmosAccessConditionFailedError (412) is raised
+        """
         if container_name not in self.containers:
             raise ValueError("Container name: {} not found".format(container_name))
         new_item["id"] = old_item["id"]
-        return self.containers[container_name].replace_item(old_item, new_item)
+        if etag is None:
+            return self.containers[container_name].replace_item(
+                old_item, new_item)
+        return self.containers[container_name].replace_item(
+            old_item, new_item,
+            etag=etag, match_condition=MatchConditions.IfNotModified,
+        )
 
+    @cosmos_operation
     def delete_item(self, item_id, partition_key, container_name):
         if container_name not in self.containers:
             raise ValueError("Container name: {} not found".format(container_name))
         return self.containers[container_name].delete_item(item_id, partition_key)
 
+    @cosmos_operation
+    def execute_partition_batch(self, container_name, partition_key,
+                                operations):
+        """
+        Applies up to BATCH_LIMIT upserts/deletes to a single logical
+        partition in one round trip. The batch is transactional: either every
+        operation is applied or none are. Deleting a missing item is a no-op.
+        Returns the resulting item for each operation.
+        """
+        if len(operations) > BATCH_LIMIT:
+            raise ValueError(
+                "Partition batches are limited to {} operations".format(
+                    BATCH_LIMIT))
+        if not operations:
+            return []
+        scripts = self.get_container(container_name).scripts
+        try:
+            return scripts.execute_stored_procedure(
+                BATCH_STORED_PROCEDURE["id"],
+                partition_key=partition_key,
+                params=[operations],
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            # Stored procedure not registered on this container yet
+            try:
+                scripts.create_stored_procedure(BATCH_STORED_PROCEDURE)
+            except exceptions.CosmosResourceExistsError:
+                pass
+            return scripts.execute_stored_procedure(
+                BATCH_STORED_PROCEDURE["id"],
+                partition_key=partition_key,
+                params=[operations],
+            )
+
     def init_app(self, app):
         self.app = app
 
@@ -96,7 +239,9 @@ def setup_db():
     load_dotenv(dotenv_path)
     url = os.environ["ACCOUNT_URI"]
     key = os.environ["ACCOUNT_KEY"]
-    client = CosmosClient(url, credential=key)
+    # Called with every response, to account for its request charge
+    client = CosmosClient(
+        url, credential=key, raw_response_hook=record_request_charge)
     database_id = os.environ["DATABASE_ID"]
     db = DatabaseClient(client, database_id)
     return db
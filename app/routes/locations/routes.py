@@ -3,13 +3,18 @@ from flask import request, jsonify, Blueprint
 from marshmallow import ValidationError
 from azure.cosmos import exceptions
 
-from app.models import db, cache
+from app.models import db, cache, invalidate, response_cache
+from app.models.response_cache import document_etag, list_etag, not_modified
 from app.models.location import Location
-from app.models.sensor import Sensor
 
-from .schemas import LocationSchema, CreateLocationSchema, UpdateLocationSchema
+from .schemas import (LocationSchema, CreateLocationSchema,
+                      UpdateLocationSchema, location_serializer)
 
-from app.routes.sensors.utils import delete_sensor_simulation
+from app.routes.schemas import PaginationInputSchema
+from app.routes.sensors.utils import (LOCATION_UPDATE_ATTEMPTS,
+                                      delete_sensors,
+                                      remove_sensors_from_location)
+from app.routes.utils import paginated, stream_json_list
 
 locations_bp = Blueprint("locations", __name__, url_prefix="/api/locations")
 
@@ -17,23 +22,45 @@ locations_bp = Blueprint("locations", __name__, url_prefix="/api/locations")
 @locations_bp.route("", methods=["GET", "POST"])
 def locations():
     if request.method == "GET":
-        items = Location.all()
-        schema = LocationSchema(many=True, unknown="EXCLUDE")
         try:
-            items = schema.load(items)
+            page_args = PaginationInputSchema(unknown="EXCLUDE").load(
+                request.args)
+        except ValidationError as error:
+            print("ValidationError: Invalid pagination arguments: ",
+                  error.messages)  # TODO: Implement logging
             return (
-                jsonify(schema.dump(items)),
-                HTTPStatus.OK,
+                "Cannot return location list. Invalid arguments",
+                HTTPStatus.BAD_REQUEST,
             )
-        except ValidationError as error:
-            print(
-                "ValidationError: Invalid format detected in location list: ",
-                error.messages,
-            )  # TODO: Implement logging
+        if page_args["stream"]:
             return (
-                "Cannot return location list. Invalid results",
-                HTTPStatus.INTERNAL_SERVER_ERROR,
+                stream_json_list(Location.stream(), location_serializer),
+                HTTPStatus.OK,
             )
+        if "limit" in request.args or "cursor" in page_args:
+            items, continuation_token = Location.page(
+                page_args["limit"], page_args.get("cursor"))
+            etag = list_etag(items, continuation_token)
+            response = not_modified(etag)
+            if response is None:
+                # Stored documents were validated on write
+                response = paginated(
+                    location_serializer.dump_many(items), continuation_token)
+                response.set_etag(etag)
+            return response
+        cached_response = response_cache.get("all_locations")
+        if cached_response is not None:
+            return cached_response
+        items = Location.all()
+        etag = list_etag(items)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return response_cache.set(
+            "all_locations",
+            jsonify(location_serializer.dump_many(items)),
+            etag,
+        )
     else:
         data = request.get_json()
         try:
@@ -46,8 +73,8 @@ def locations():
                 serialized_new_loc,
                 new_location.container_name,
             )
+            invalidate(Location.cache_prefix+item["id"], "all_locations")
             cache.set(Location.cache_prefix+item["id"], item)
-            cache.delete("all_locations")
             item = output_schema.load(item)
             return (
                 jsonify(output_schema.dump(item)),
@@ -73,17 +100,20 @@ def locations():
 @locations_bp.route("/<location_id>", methods=["GET", "PUT", "DELETE"])
 def location(location_id):
     if request.method == "GET":
+        cached_response = response_cache.get(
+            Location.cache_prefix+location_id)
+        if cached_response is not None:
+            return cached_response
         try:
             item = Location.get_by_id(location_id)
-            schema = LocationSchema(unknown="EXCLUDE")
-            item = schema.load(item)
-            return (jsonify(schema.dump(item)), HTTPStatus.OK)
-        except ValidationError as error:
-            # TODO: Implement logging
-            print("validationerror: cannot retrieve location: ", error.messages)
-            return (
-                "Cannot retrieve location due to schema error.",
-                HTTPStatus.INTERNAL_ScERVER_ERROR,
+            etag = document_etag(item)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            return response_cache.set(
+                Location.cache_prefix+location_id,
+                jsonify(location_serializer.dump(item)),
+                etag,
             )
         except exceptions.CosmosResourceNotFoundError as error:
             print("Could not find location in container", error)
@@ -99,20 +129,31 @@ def location(location_id):
             errors = input_schema.validate(data)
             if len(errors) != 0:
                 raise ValidationError({"messages": errors})
-            old_location = Location.get_by_id(location_id)
-            merged = {
-                **old_location,
-                **data,
-            }
-            del merged["updatedAt"]
-            updated_location = output_schema.load(merged)
-            updated_item = db.replace_item(
-                old_location,
-                output_schema.dump(updated_location),
-                Location.container_name,
-            )
+            for attempt in range(LOCATION_UPDATE_ATTEMPTS):
+                # Read from the database, not the cache, so the replace is
+                # conditioned on the stored _etag and a concurrent update
+                # (e.g. a sensor being added) is not overwritten
+                old_location = db.get_item_with_id_and_partition_key(
+                    location_id, location_id, Location.container_name)
+                merged = {
+                    **old_location,
+                    **data,
+                }
+                del merged["updatedAt"]
+                updated_location = output_schema.load(merged)
+                try:
+                    updated_item = db.replace_item(
+                        old_location,
+                        output_schema.dump(updated_location),
+                        Location.container_name,
+                        etag=old_location.get("_etag"),
+                    )
+                    break
+                except exceptions.CosmosAccessConditionFailedError:
+                    if attempt == LOCATION_UPDATE_ATTEMPTS - 1:
+                        raise
+            invalidate(Location.cache_prefix+location_id, "all_locations")
             cache.set(Location.cache_prefix+location_id, updated_item)
-            cache.delete("all_locations")
             updated_item = output_schema.load(updated_item)
             return (
                 jsonify(output_schema.dump(updated_item)),
@@ -131,19 +172,35 @@ def location(location_id):
                 "Cannot update location that does not exist",
                 HTTPStatus.NOT_FOUND,
             )
+        except exceptions.CosmosAccessConditionFailedError as error:
+            print("Could not update location: ",
+                  error)  # TODO: Implement logging
+            return (
+                "Location was modified concurrently, try again",
+                HTTPStatus.CONFLICT,
+            )
     else:  # DELETE
         try:
-            item = Location.get_by_id(location_id)
+            old_location = Location.get_by_id(location_id)
             schema = LocationSchema(unknown="EXCLUDE")
-            item = schema.load(item)
-            sensors = item.sensors
-            for sensor_id in sensors:
-                sensor_id = str(sensor_id)
-                delete_sensor_simulation(sensor_id, location_id)
-                Sensor.delete(sensor_id, location_id)
+            item = schema.load(old_location)
+            results = delete_sensors(
+                [str(sensor_id) for sensor_id in item.sensors],
+                location_id,
+            )
+            if not all(result["deleted"] for result in results):
+                # Keep the location (and the sensors that could not be
+                # deleted) so that retrying the DELETE resumes from here
+                remove_sensors_from_location(
+                    [result["id"] for result in results if result["deleted"]],
+                    old_location,
+                )
+                return (
+                    jsonify({"sensors": results}),
+                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                )
             if Location.delete(location_id) is None:
-                cache.delete(Location.cache_prefix+location_id)
-                cache.delete("all_locations")
+                invalidate(Location.cache_prefix+location_id, "all_locations")
                 return ("", HTTPStatus.OK)
             return (
                 "Error occurred when deleting location",
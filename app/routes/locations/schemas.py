@@ -1,6 +1,7 @@
 from marshmallow import fields, post_load, Schema
 
 from app.models.location import Location
+from app.routes.serializers import FastSerializer
 # TODO: Add caching layer
 
 
@@ -29,3 +30,6 @@ class CreateLocationSchema(Schema):
 class UpdateLocationSchema(Schema):
     name = fields.Str()
     capacity = fields.Integer()
+
+
+location_serializer = FastSerializer(LocationSchema)
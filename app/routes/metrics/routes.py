@@ -0,0 +1,16 @@
+from http import HTTPStatus
+from flask import Blueprint
+
+from app.models.metrics import collect
+
+metrics_bp = Blueprint("metrics", __name__, url_prefix="/metrics")
+
+
+@metrics_bp.route("", methods=["GET"])
+def metrics():
+    """
+    GET: Returns request, cache, Cosmos and upstream metrics for all
+    workers in the Prometheus text format
+    """
+    body, content_type = collect()
+    return (body, HTTPStatus.OK, {"Content-Type": content_type})
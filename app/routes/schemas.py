@@ -0,0 +1,27 @@
+import base64
+import binascii
+
+from marshmallow import fields, post_load, validate, Schema, ValidationError
+
+from app.models.utils import QUERY_LIMIT
+
+
+class PaginationInputSchema(Schema):
+    limit = fields.Int(
+        missing=QUERY_LIMIT,
+        validate=validate.Range(min=1, max=1000),
+    )
+    cursor = fields.Str()
+    stream = fields.Bool(missing=False)
+
+    @post_load
+    def decode_cursor(self, data, **kwarg):
+        # Cursors are url-safe encodings of Cosmos continuation tokens
+        if "cursor" in data:
+            try:
+                data["cursor"] = base64.b64decode(
+                    data["cursor"].encode(), altchars=b"-_", validate=True,
+                ).decode()
+            except (binascii.Error, UnicodeDecodeError):
+                raise ValidationError("Invalid cursor", "cursor")
+        return data
@@ -1,14 +1,23 @@
 from app.routes.locations.utils import get_location
 from app.models.sensor import Sensor
-from app.models import db, cache
+from app.models import db, cache, invalidate, response_cache
+from app.models.response_cache import document_etag, list_etag, not_modified
+from app.models.utils import BATCH_LIMIT
 from http import HTTPStatus
-from flask import request, jsonify, Blueprint
+from flask import current_app, request, jsonify, Blueprint
 from marshmallow import ValidationError
 from azure.cosmos import exceptions
 
-from .schemas import SensorSchema, CreateSensorSchema, UpdateSensorSchmea
-from .utils import (add_sensor_to_location, remove_sensor_from_location,
-                    delete_sensor_simulation, register_sensor_simulation)
+from app.routes.schemas import PaginationInputSchema
+from app.routes.utils import (chunked, map_concurrently, paginated,
+                              stream_json_list)
+
+from .schemas import (SensorSchema, BulkCreateSensorSchema,
+                      CreateSensorSchema, UpdateSensorSchmea,
+                      sensor_serializer)
+from .utils import (add_sensor_to_location, add_sensors_to_location,
+                    remove_sensor_from_location, delete_simulation_with_retry,
+                    try_register_sensor_simulation)
 # TODO: Add Caching Layer
 
 
@@ -29,20 +38,48 @@ def sensors(location_id):
                 "Cannot get sensors for location that does not exist.",
                 HTTPStatus.NOT_FOUND,
             )
-        items = Sensor.all_for_location(location_id)
-        schema = SensorSchema(many=True, unknown="EXCLUDE")
         try:
-            items = schema.load(items)
-            return (jsonify(schema.dump(items)), HTTPStatus.OK)
+            page_args = PaginationInputSchema(unknown="EXCLUDE").load(
+                request.args)
         except ValidationError as error:
-            print(
-                "ValidationError: Invalid format detected in sensor list: ",
-                error.messages,
-            )  # TODO: Implement logging
+            print("ValidationError: Invalid pagination arguments: ",
+                  error.messages)  # TODO: Implement logging
             return (
-                "Cannot return sensor list. Invalid results",
-                HTTPStatus.INTERNAL_SERVER_ERROR,
+                "Cannot return sensor list. Invalid arguments",
+                HTTPStatus.BAD_REQUEST,
+            )
+        if page_args["stream"]:
+            return (
+                stream_json_list(
+                    Sensor.stream_for_location(location_id),
+                    sensor_serializer,
+                ),
+                HTTPStatus.OK,
             )
+        if "limit" in request.args or "cursor" in page_args:
+            items, continuation_token = Sensor.page_for_location(
+                location_id, page_args["limit"], page_args.get("cursor"))
+            etag = list_etag(items, continuation_token)
+            response = not_modified(etag)
+            if response is None:
+                # Stored documents were validated on write
+                response = paginated(
+                    sensor_serializer.dump_many(items), continuation_token)
+                response.set_etag(etag)
+            return response
+        cached_response = response_cache.get("sensorsFor:"+location_id)
+        if cached_response is not None:
+            return cached_response
+        items = Sensor.all_for_location(location_id)
+        etag = list_etag(items)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return response_cache.set(
+            "sensorsFor:"+location_id,
+            jsonify(sensor_serializer.dump_many(items)),
+            etag,
+        )
     else:
         location = get_location(location_id)
         if not location:
@@ -61,16 +98,17 @@ def sensors(location_id):
                 Sensor.container_name,
             )
             created_sensor = output_schema.load(item)
+            Sensor.index_location(str(created_sensor.id), location_id)
             # Side-effect: Updates location entry to contain
             # the newly created sensor id
             try:
                 add_sensor_to_location(str(created_sensor.id), location)
-                register_sensor_simulation(
-                    str(created_sensor.id), location_id)
-                return (
-                    jsonify(output_schema.dump(created_sensor)),
-                    HTTPStatus.CREATED
-                )
+                # The sensor is kept when the simulator cannot be reached
+                created = output_schema.dump(created_sensor)
+                created["simulationRegistered"] = \
+                    try_register_sensor_simulation(
+                        str(created_sensor.id), location_id)
+                return (jsonify(created), HTTPStatus.CREATED)
                 # if we failed to add, location may not exist anymore.
                 # Roll back sensor creation
             except exceptions.CosmosHttpResponseError:
@@ -94,6 +132,100 @@ def sensors(location_id):
             )
 
 
+@sensors_bp.route("/bulk", methods=["POST"])
+def bulk_sensors(location_id):
+    """
+    POST: Creates a list of sensors for <location_id>. Sensors are written
+    concurrently, their ids are appended to the location in one replace and
+    their simulations are registered in parallel.
+    """
+    location = get_location(location_id)
+    if not location:
+        return (
+            "Cannot create sensors for location that does not exist.",
+            HTTPStatus.NOT_FOUND,
+        )
+    data = request.get_json()
+    try:
+        if isinstance(data, list):
+            data = [
+                {**sensor_data, "locationId": location_id}
+                for sensor_data in data
+            ]
+        sensors_to_be_created = BulkCreateSensorSchema().load(
+            {"sensors": data})["sensors"]
+    except (TypeError, ValidationError) as error:
+        # TODO: Implement logging
+        print("ValidationError: Could not create sensors: ", error)
+        return (
+            "Cannot create sensors. Invalid arguments",
+            HTTPStatus.BAD_REQUEST,
+        )
+    output_schema = SensorSchema(unknown="EXCLUDE")
+    max_workers = current_app.config["BATCH_MAX_WORKERS"]
+
+    def create(batch):
+        try:
+            return [
+                {"status": HTTPStatus.CREATED, "item": item}
+                for item in Sensor.upsert_batch(batch, location_id)
+            ]
+        except exceptions.CosmosHttpResponseError as error:
+            print("Could not create sensors: ", error)
+            return [{
+                "status": HTTPStatus.INTERNAL_SERVER_ERROR,
+                "error": "Could not create sensor due to an error",
+            } for _ in batch]
+
+    # Sensors of a location share one partition, so they are written as a
+    # few transactional partition batches rather than one upsert each
+    batches = chunked(
+        [output_schema.dump(sensor) for sensor in sensors_to_be_created],
+        BATCH_LIMIT,
+    )
+    results = [
+        result
+        for batch_results in map_concurrently(create, batches, max_workers)
+        for result in batch_results
+    ]
+    created_ids = [
+        result["item"]["id"]
+        for result in results
+        if result["status"] == HTTPStatus.CREATED
+    ]
+    if not created_ids:
+        return (jsonify(results), HTTPStatus.INTERNAL_SERVER_ERROR)
+    try:
+        add_sensors_to_location(created_ids, location)
+    except exceptions.CosmosHttpResponseError:
+        # Location may not exist anymore. Roll back sensor creation
+        map_concurrently(
+            lambda batch: Sensor.delete_batch(batch, location_id),
+            chunked(created_ids, BATCH_LIMIT),
+            max_workers,
+        )
+        return (
+            "Could not register sensors to location, does not exist.",
+            HTTPStatus.NOT_FOUND,
+        )
+
+    def register(sensor_id):
+        Sensor.index_location(sensor_id, location_id)
+        return try_register_sensor_simulation(sensor_id, location_id)
+
+    registered = iter(map_concurrently(register, created_ids, max_workers))
+    for result in results:
+        if result["status"] == HTTPStatus.CREATED:
+            result["sensor"] = output_schema.dump(
+                output_schema.load(result.pop("item")))
+            result["simulationRegistered"] = next(registered)
+    all_created = len(created_ids) == len(results)
+    return (
+        jsonify(results),
+        HTTPStatus.CREATED if all_created else HTTPStatus.MULTI_STATUS,
+    )
+
+
 @sensors_bp.route("/<sensor_id>", methods=["GET", "PUT", "DELETE"])
 def sensor(location_id, sensor_id):
     if request.method == "GET":
@@ -103,15 +235,20 @@ def sensor(location_id, sensor_id):
                 "Cannot get sensor for location that does not exist.",
                 HTTPStatus.NOT_FOUND,
             )
+        cached_response = response_cache.get(Sensor.cache_prefix+sensor_id)
+        if cached_response is not None:
+            return cached_response
         try:
             item = Sensor.get_by_id_and_location_id(sensor_id, location_id)
-            schema = SensorSchema()
-            item = schema.load(item, unknown="EXCLUDE")
-            return (jsonify(schema.dump(item)), HTTPStatus.OK)
-        except ValidationError as error:
-            # TODO: Implement logging
-            print("ValidationError: cannot retrieve sensor: ", error.messages)
-            return ("cannot retrieve sensor", HTTPStatus.INTERNAL_SERVER_ERROR)
+            etag = document_etag(item)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            return response_cache.set(
+                Sensor.cache_prefix+sensor_id,
+                jsonify(sensor_serializer.dump(item)),
+                etag,
+            )
         except exceptions.CosmosResourceNotFoundError as error:
             print("Could not find sensor in container", error)
             return (
@@ -141,8 +278,7 @@ def sensor(location_id, sensor_id):
                 output_schema.dump(updated_sensor),
                 Sensor.container_name,
             )
-            cache.delete("sensorsFor:"+location_id)
-            cache.delete(Sensor.cache_prefix+sensor_id)
+            invalidate("sensorsFor:"+location_id, Sensor.cache_prefix+sensor_id)
             cache.set(Sensor.cache_prefix+sensor_id, updated_item)
             updated_sensor = output_schema.load(
                 updated_item, unknown="EXCLUDE")
@@ -169,10 +305,14 @@ def sensor(location_id, sensor_id):
                 "Cannot delete sensor for location that does not exist.",
                 HTTPStatus.NOT_FOUND,
             )
+        # The simulation goes first, so that nothing is changed when the
+        # simulator cannot be reached
+        error = delete_simulation_with_retry(sensor_id, location_id)
+        if error is not None:
+            return (error, HTTPStatus.BAD_GATEWAY)
         try:
             if (
                 remove_sensor_from_location(sensor_id, location) is not None
-                and delete_sensor_simulation(sensor_id, location_id)
                 and Sensor.delete(sensor_id, location_id) is None
             ):
                 return ("", HTTPStatus.OK)
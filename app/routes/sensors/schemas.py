@@ -1,5 +1,8 @@
-from marshmallow import fields, post_load, Schema
+from marshmallow import fields, post_load, Schema, validate
 from app.models.sensor import Sensor
+from app.routes.serializers import FastSerializer
+
+BULK_SENSOR_LIMIT = 1000
 
 
 class SensorSchema(Schema):
@@ -24,6 +27,17 @@ class CreateSensorSchema(Schema):
         return Sensor(**data)
 
 
+class BulkCreateSensorSchema(Schema):
+    sensors = fields.List(
+        fields.Nested(CreateSensorSchema),
+        required=True,
+        validate=validate.Length(min=1, max=BULK_SENSOR_LIMIT),
+    )
+
+
 class UpdateSensorSchmea(Schema):
     name = fields.Str()
     type = fields.Str()
+
+
+sensor_serializer = FastSerializer(SensorSchema)
@@ -1,53 +1,178 @@
 from app.routes.locations.schemas import LocationSchema
+from app.routes.utils import chunked, map_concurrently
 from app.models.location import Location
-from app.models import db, cache
+from app.models.utils import BATCH_LIMIT
+from app.models.sensor import Sensor
+from app.models import db, http, invalidate
+from app.models.circuit_breaker import CircuitOpenError
 
+from azure.cosmos import exceptions
 from flask import current_app
-import uuid
 import requests
+import uuid
 from http import HTTPStatus
 
+SENSOR_DELETE_ATTEMPTS = 3
+LOCATION_UPDATE_ATTEMPTS = 5
 
-def add_sensor_to_location(sensor_id, old_location):
+
+def update_location_sensors(old_location, update):
+    """
+    Replaces the location's sensor list with update(sensors), a list of
+    UUIDs, conditioned on the location's _etag so that concurrent updates
+    are never lost. On a conflict (412) the location is re-read from the
+    database and update is applied again, up to LOCATION_UPDATE_ATTEMPTS
+    times. Returns the stored location, unchanged if update made no
+    difference.
+    """
     location_schema = LocationSchema(unknown="EXCLUDE")
-    updated_location = location_schema.load(old_location)
-    updated_location.sensors.append(uuid.UUID(sensor_id))
+    location = old_location
     location_id = old_location["id"]
-    cache.delete(Location.cache_prefix+location_id)
-    cache.delete("sensorsFor:"+location_id)
-    cache.delete("all_locations")
-    return db.replace_item(
-        old_location,
-        location_schema.dump(updated_location),
-        updated_location.container_name,
-    )
+    fresh = False
+    for attempt in range(LOCATION_UPDATE_ATTEMPTS):
+        updated_location = location_schema.load(location)
+        sensors = update(list(updated_location.sensors))
+        if sensors == updated_location.sensors and fresh:
+            return location
+        if sensors != updated_location.sensors:
+            updated_location.sensors = sensors
+            try:
+                location = db.replace_item(
+                    location,
+                    location_schema.dump(updated_location),
+                    Location.container_name,
+                    etag=location.get("_etag"),
+                )
+                invalidate(
+                    Location.cache_prefix+location_id,
+                    "sensorsFor:"+location_id,
+                    "all_locations",
+                )
+                return location
+            except exceptions.CosmosAccessConditionFailedError:
+                if attempt == LOCATION_UPDATE_ATTEMPTS - 1:
+                    raise
+        # Either someone else updated the location or old_location may be
+        # a stale cached copy: retry against the stored document
+        location = db.get_item_with_id_and_partition_key(
+            location_id, location_id, Location.container_name)
+        fresh = True
+    return location
+
+
+def add_sensor_to_location(sensor_id, old_location):
+    return add_sensors_to_location([sensor_id], old_location)
+
+
+def add_sensors_to_location(sensor_ids, old_location):
+    """Appends every sensor id to the location in a single replace"""
+    to_add = [uuid.UUID(sensor_id) for sensor_id in sensor_ids]
+
+    def update(sensors):
+        existing = set(sensors)
+        return sensors + [
+            sensor_id for sensor_id in to_add if sensor_id not in existing
+        ]
+    return update_location_sensors(old_location, update)
 
 
 def remove_sensor_from_location(sensor_id, old_location):
-    location_schema = LocationSchema(unknown="EXCLUDE")
-    updated_location = location_schema.load(old_location)
-    if uuid.UUID(sensor_id) in updated_location.sensors:
-        updated_location.sensors.remove(uuid.UUID(sensor_id))
-        location_id = old_location["id"]
-        cache.delete(Location.cache_prefix+location_id)
-        cache.delete("sensorsFor:"+location_id)
-        cache.delete("all_locations")
-        return db.replace_item(
-            old_location,
-            location_schema.dump(updated_location),
-            updated_location.container_name,
-        )
-    return old_location
+    return remove_sensors_from_location([sensor_id], old_location)
+
+
+def remove_sensors_from_location(sensor_ids, old_location):
+    """Removes every sensor id from the location in a single replace"""
+    to_remove = set(uuid.UUID(sensor_id) for sensor_id in sensor_ids)
+    return update_location_sensors(
+        old_location,
+        lambda sensors: [
+            sensor_id for sensor_id in sensors if sensor_id not in to_remove
+        ],
+    )
 
 
 def register_sensor_simulation(sensor_id, location_id):
     url = current_app.config["SIMULATOR_SERVICE_BASE_URL"] + \
         "/api/locations/" + location_id + "/sensors/" + sensor_id
-    return requests.put(url)
+    return http.put(url)
+
+
+def try_register_sensor_simulation(sensor_id, location_id):
+    """Whether the simulator registered the sensor. Never raises"""
+    try:
+        response = register_sensor_simulation(sensor_id, location_id)
+        return response.status_code == HTTPStatus.OK
+    except requests.RequestException as error:
+        print("Could not register sensor simulation: ",
+              error)  # TODO: Implement logging
+        return False
 
 
 def delete_sensor_simulation(sensor_id, location_id):
     url = current_app.config["SIMULATOR_SERVICE_BASE_URL"] + \
         "/api/locations/" + location_id + "/sensors/" + sensor_id
-    status_code = requests.delete(url).status_code
+    status_code = http.delete(url).status_code
     return (status_code == HTTPStatus.OK or status_code == HTTPStatus.NOT_FOUND)
+
+
+def delete_simulation_with_retry(sensor_id, location_id):
+    """Returns None once deleted, or the last error after all attempts"""
+    error = None
+    for _ in range(SENSOR_DELETE_ATTEMPTS):
+        try:
+            if delete_sensor_simulation(sensor_id, location_id):
+                return None
+            error = "Could not delete sensor simulation"
+        except CircuitOpenError as err:
+            # Every retry would fail just as fast while the breaker is open
+            print("Could not delete sensor simulation: ",
+                  err)  # TODO: Implement logging
+            return "Simulator unavailable"
+        except requests.RequestException as err:
+            print("Could not delete sensor simulation: ",
+                  err)  # TODO: Implement logging
+            error = "Could not delete sensor simulation due to an error"
+    return error
+
+
+def delete_sensors(sensor_ids, location_id):
+    """
+    Deletes the sensors' simulations concurrently, then the sensors
+    themselves in partition batches, retrying each step up to
+    SENSOR_DELETE_ATTEMPTS times. Returns a result per sensor.
+    """
+    max_workers = current_app.config["BATCH_MAX_WORKERS"]
+    errors = dict(zip(sensor_ids, map_concurrently(
+        lambda sensor_id: delete_simulation_with_retry(
+            sensor_id, location_id),
+        sensor_ids,
+        max_workers,
+    )))
+
+    def delete_batch(batch):
+        error = None
+        for _ in range(SENSOR_DELETE_ATTEMPTS):
+            try:
+                Sensor.delete_batch(batch, location_id)
+                return None
+            except exceptions.CosmosHttpResponseError as err:
+                print("Could not delete sensors: ",
+                      err)  # TODO: Implement logging
+                error = "Could not delete sensor due to an error"
+        return error
+
+    batches = chunked(
+        [sensor_id for sensor_id in sensor_ids if errors[sensor_id] is None],
+        BATCH_LIMIT,
+    )
+    for batch, error in zip(
+        batches, map_concurrently(delete_batch, batches, max_workers)
+    ):
+        for sensor_id in batch:
+            errors[sensor_id] = error
+    return [
+        {"id": sensor_id, "deleted": True}
+        if errors[sensor_id] is None
+        else {"id": sensor_id, "deleted": False, "error": errors[sensor_id]}
+        for sensor_id in sensor_ids
+    ]
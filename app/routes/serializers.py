@@ -0,0 +1,53 @@
+from marshmallow import EXCLUDE, fields
+
+
+class FastSerializer:
+    """
+    Serializes trusted documents (items this app wrote to Cosmos, or data
+    store replies) straight to output dicts, skipping the schema.load ->
+    schema.dump round trip. The key mapping is compiled once from the
+    schema's declared fields, so it stays in sync with the schema.
+
+    Stored values are already in dumped form (string UUIDs and ISO
+    datetimes), so they are passed through unchanged. Documents missing
+    any of the fields still take the round trip, which fills in defaults
+    (a location without sensors gets an empty list). Writes must still
+    validate with the full schema.
+    """
+    def __init__(self, schema):
+        if isinstance(schema, type):
+            schema = schema()
+        self._schema = schema
+        self._fields = [
+            (field.data_key or name, self._compile(field))
+            for name, field in schema.dump_fields.items()
+        ]
+
+    @classmethod
+    def _compile(cls, field):
+        if isinstance(field, fields.Nested):
+            nested = cls(field.schema)
+            if field.many:
+                return nested.dump_many
+            return nested.dump
+        if isinstance(field, fields.List):
+            inner = cls._compile(field.inner)
+            if inner is None:
+                return None
+            return lambda values: [inner(value) for value in values]
+        return None
+
+    def dump(self, document):
+        output = {}
+        for key, convert in self._fields:
+            if key not in document:
+                return self._schema.dump(
+                    self._schema.load(document, unknown=EXCLUDE))
+            value = document[key]
+            if convert is not None and value is not None:
+                value = convert(value)
+            output[key] = value
+        return output
+
+    def dump_many(self, documents):
+        return [self.dump(document) for document in documents]
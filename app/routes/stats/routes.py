@@ -0,0 +1,28 @@
+from http import HTTPStatus
+from flask import jsonify, Blueprint
+
+from app.models import cache, http, swr
+from app.routes.traffic.stream import traffic_broadcaster
+from app.routes.traffic.utils import data_store_flight
+from app.routes.traffic.view_cache import traffic_cache_stats
+
+stats_bp = Blueprint("stats", __name__, url_prefix="/api/stats")
+
+
+@stats_bp.route("", methods=["GET"])
+def stats():
+    """
+    GET: Returns per-worker runtime counters for this process
+    """
+    return (
+        jsonify({
+            "http": http.stats(),
+            "circuit_breakers": http.breaker_stats(),
+            "cache": cache.cache.stats(),
+            "data_store_coalescing": data_store_flight.stats(),
+            "traffic_cache": traffic_cache_stats.stats(),
+            "traffic_stream": traffic_broadcaster.stats(),
+            "stale_while_revalidate": swr.stats(),
+        }),
+        HTTPStatus.OK,
+    )
@@ -0,0 +1,49 @@
+import numpy as np
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+def history_arrays(history):
+    """Splits trafficHistory points into time and count arrays"""
+    times = np.fromiter(
+        (point["time"] for point in history), dtype=np.int64,
+        count=len(history))
+    counts = np.fromiter(
+        (point["trafficCount"] for point in history), dtype=np.int64,
+        count=len(history))
+    return times, counts
+
+
+def peak_traffic(history):
+    """
+    Busiest sample in the history, the earliest one on ties. None for an
+    empty history
+    """
+    if not history:
+        return None
+    times, counts = history_arrays(history)
+    peak = int(np.argmax(counts))
+    return {"time": int(times[peak]), "count": int(counts[peak])}
+
+
+def traffic_stats(history, percentiles=DEFAULT_PERCENTILES):
+    """Summary statistics over the samples of a history"""
+    if not history:
+        return {
+            "samples": 0, "min": None, "max": None, "mean": None,
+            "peakTraffic": None, "percentiles": {},
+        }
+    times, counts = history_arrays(history)
+    peak = int(np.argmax(counts))
+    values = np.percentile(counts, percentiles) if percentiles else []
+    return {
+        "samples": int(counts.size),
+        "min": int(counts.min()),
+        "max": int(counts[peak]),
+        "mean": float(counts.mean()),
+        "peakTraffic": {"time": int(times[peak]), "count": int(counts[peak])},
+        "percentiles": {
+            "{:g}".format(percentile): float(value)
+            for percentile, value in zip(percentiles, values)
+        },
+    }
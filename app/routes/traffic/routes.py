@@ -1,53 +1,66 @@
 from http import HTTPStatus
+import queue
 
-from flask import request, jsonify, Blueprint
+import requests
+from flask import (current_app, json, request, jsonify, Blueprint, Response,
+                   stream_with_context)
 from marshmallow import ValidationError
 
 from app.models import cache
+from app.models.circuit_breaker import CircuitOpenError
+from app.routes.utils import map_concurrently
 
 from .schemas import (
+    BatchTrafficCountInputSchema,
     TrafficCountInputSchema,
-    TrafficCountSchema,
     PeakTrafficInputSchema,
-    PeakTrafficSchema,
-    TrafficHistorySchema,
     TrafficHistoryInputSchema,
+    TrafficStatsInputSchema,
+    TrafficStreamInputSchema,
+    traffic_count_serializer,
+    peak_traffic_serializer,
+    traffic_history_serializer,
 )
-from .utils import DatastoreEndpointEnum, get_from_data_store
+from .aggregates import DEFAULT_PERCENTILES, peak_traffic, traffic_stats
+from .stream import traffic_broadcaster
+from .utils import (TRAFFIC_HISTORY_INTERVAL, DatastoreEndpointEnum,
+                    assemble_traffic_history, cached_traffic_history,
+                    check_history_window, data_store_is_stale,
+                    get_from_data_store, history_bucket_count,
+                    traffic_count_cache_key)
+from .view_cache import quantize, quantized_query_args, traffic_cached
+
+# X-Served-By values: computed from cached history or from the data store
+SERVED_BY_CACHE = "cache"
+SERVED_BY_DATA_STORE = "data-store"
 
 traffic_bp = Blueprint("traffic", __name__,
                        url_prefix="/api/locations/<location_id>/")
+batch_traffic_bp = Blueprint("batch_traffic", __name__, url_prefix="/api/")
+
+
+@traffic_bp.errorhandler(requests.RequestException)
+def data_store_unavailable(error):
+    print("Could not reach data store: ", error)  # TODO: Implement logging
+    if isinstance(error, CircuitOpenError):
+        return ("Data store unavailable", HTTPStatus.SERVICE_UNAVAILABLE)
+    return ("Could not reach data store", HTTPStatus.BAD_GATEWAY)
+
+
+@traffic_bp.after_request
+def mark_stale_responses(response):
+    if data_store_is_stale():
+        response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
 
 
 @traffic_bp.route("traffic_count", methods=["GET"])
-@cache.cached(timeout=60)
 def get_traffic_count(location_id):
-    input_schema = TrafficCountInputSchema()
     try:
-        args = input_schema.load({
-            **request.args,
+        args = TrafficCountInputSchema().load({
+            **quantized_query_args(("time",), ("time",)),
             "location_id": location_id,
         })
-        response = get_from_data_store(
-            DatastoreEndpointEnum.TRAFFIC_COUNT.value,
-            location_id,
-            input_schema.dump(args),
-        )
-        if response.status_code == HTTPStatus.OK:
-            output_schema = TrafficCountSchema()
-            output = output_schema.load({
-                **response.json(),
-                "locationId": location_id,
-                "time": args["time"],
-            })
-            return (
-                jsonify(output_schema.dump(output)),
-                HTTPStatus.OK,
-            )
-        return (
-            response.text,
-            response.status_code
-        )
     except ValidationError as error:
         print("ValidationError: Cannot get traffic: ",
               error.messages)  # TODO: Implement logging
@@ -55,35 +68,40 @@ def get_traffic_count(location_id):
             "Cannot get traffic for requested location. Invalid request",
             HTTPStatus.BAD_REQUEST,
         )
+    return traffic_count_response(location_id, args)
+
+
+@traffic_cached()
+def traffic_count_response(location_id, args):
+    response = get_from_data_store(
+        DatastoreEndpointEnum.TRAFFIC_COUNT.value,
+        location_id,
+        TrafficCountInputSchema().dump(args),
+    )
+    if response.status_code == HTTPStatus.OK:
+        return (
+            jsonify(traffic_count_serializer.dump({
+                **response.json(),
+                "locationId": location_id,
+                "time": response.time or args["time"],
+            })),
+            HTTPStatus.OK,
+        )
+    return (
+        response.text,
+        response.status_code
+    )
 
 
 @traffic_bp.route("peak_traffic", methods=["GET"])
-@cache.cached(timeout=60)
 def get_peak_traffic(location_id):
-    input_schema = PeakTrafficInputSchema()
     try:
-        args = input_schema.load({
-            **request.args,
+        args = PeakTrafficInputSchema().load({
+            **quantized_query_args(("start_time", "end_time")),
             "location_id": location_id,
         })
-        response = get_from_data_store(
-            DatastoreEndpointEnum.PEAK_TRAFFIC.value,
-            location_id,
-            input_schema.dump(args),
-        )
-        if response.status_code == HTTPStatus.OK:
-            output_schema = PeakTrafficSchema()
-            output = output_schema.load({
-                **response.json(), "locationId": location_id,
-            })
-            return (
-                jsonify(output_schema.dump(output)),
-                HTTPStatus.OK,
-            )
-        return (
-            response.text,
-            response.status_code
-        )
+        if args["start_time"] > args["end_time"]:
+            raise ValidationError("start_time must not be after end_time")
     except ValidationError as error:
         print("ValidationError: Cannot get traffic: ",
               error.messages)  # TODO: Implement logging
@@ -91,30 +109,75 @@ def get_peak_traffic(location_id):
             "Cannot get traffic for requested location. Invalid request",
             HTTPStatus.BAD_REQUEST,
         )
+    return peak_traffic_response(location_id, args)
+
+
+@traffic_cached()
+def peak_traffic_response(location_id, args):
+    # Computed locally when the history for the window is fully cached,
+    # windows too long to assemble from buckets go to the data store
+    history = None
+    if (
+        history_bucket_count(args["start_time"], args["end_time"])
+        <= current_app.config["TRAFFIC_HISTORY_MAX_BUCKETS"]
+    ):
+        history = cached_traffic_history(
+            location_id,
+            args["start_time"],
+            args["end_time"],
+            TRAFFIC_HISTORY_INTERVAL,
+        )
+    peak = peak_traffic(history["trafficHistory"]) if history else None
+    if peak is not None:
+        return (
+            jsonify(peak_traffic_serializer.dump({
+                "fetchedAt": history["fetchedAt"],
+                "peakTraffic": peak,
+                "locationId": location_id,
+            })),
+            HTTPStatus.OK,
+            {"X-Served-By": SERVED_BY_CACHE},
+        )
+    response = get_from_data_store(
+        DatastoreEndpointEnum.PEAK_TRAFFIC.value,
+        location_id,
+        PeakTrafficInputSchema().dump(args),
+    )
+    if response.status_code == HTTPStatus.OK:
+        return (
+            jsonify(peak_traffic_serializer.dump({
+                **response.json(), "locationId": location_id,
+            })),
+            HTTPStatus.OK,
+            {"X-Served-By": SERVED_BY_DATA_STORE},
+        )
+    return (
+        response.text,
+        response.status_code
+    )
 
 
 @traffic_bp.route("traffic_history", methods=["GET"])
-@cache.cached(timeout=60)
 def get_traffic_history(location_id):
     input_schema = TrafficHistoryInputSchema()
     try:
         args = input_schema.load({
             **request.args,
             "location_id": location_id,
-            "time_interval": 10,
+            "time_interval": TRAFFIC_HISTORY_INTERVAL,
         })
-        response = get_from_data_store(
-            DatastoreEndpointEnum.TRAFFIC_HISTORY.value,
+        check_history_window(args["start_time"], args["end_time"])
+        response = assemble_traffic_history(
             location_id,
-            input_schema.dump(args),
+            args["start_time"],
+            args["end_time"],
+            args["time_interval"],
         )
         if response.status_code == HTTPStatus.OK:
-            output_schema = TrafficHistorySchema()
-            output = output_schema.load({
-                **response.json(), "locationId": location_id,
-            })
             return (
-                jsonify(output_schema.dump(output)),
+                jsonify(traffic_history_serializer.dump({
+                    **response.json(), "locationId": location_id,
+                })),
                 HTTPStatus.OK,
             )
         return (
@@ -128,3 +191,229 @@ def get_traffic_history(location_id):
             "Cannot get traffic for requested location. Invalid request",
             HTTPStatus.BAD_REQUEST,
         )
+
+
+@traffic_bp.route("traffic_stats", methods=["GET"])
+def get_traffic_stats(location_id):
+    """
+    GET: Returns min, max, mean, peak and percentiles (?percentiles=50,95)
+    of the traffic samples between start_time and end_time
+    """
+    input_schema = TrafficStatsInputSchema()
+    try:
+        data = {**request.args.to_dict(), "location_id": location_id}
+        if "percentiles" in request.args:
+            data["percentiles"] = [
+                percentile
+                for value in request.args.getlist("percentiles")
+                for percentile in value.split(",")
+                if percentile
+            ]
+        args = input_schema.load(data)
+        check_history_window(args["start_time"], args["end_time"])
+    except ValidationError as error:
+        print("ValidationError: Cannot get traffic stats: ",
+              error.messages)  # TODO: Implement logging
+        return (
+            "Cannot get traffic for requested location. Invalid request",
+            HTTPStatus.BAD_REQUEST,
+        )
+    served_by = SERVED_BY_CACHE
+    history = cached_traffic_history(
+        location_id,
+        args["start_time"],
+        args["end_time"],
+        TRAFFIC_HISTORY_INTERVAL,
+    )
+    if history is None:
+        served_by = SERVED_BY_DATA_STORE
+        response = assemble_traffic_history(
+            location_id,
+            args["start_time"],
+            args["end_time"],
+            TRAFFIC_HISTORY_INTERVAL,
+        )
+        if response.status_code != HTTPStatus.OK:
+            return (response.text, response.status_code)
+        history = response.json()
+    return (
+        jsonify({
+            "locationId": location_id,
+            "startTime": args["start_time"],
+            "endTime": args["end_time"],
+            "fetchedAt": history["fetchedAt"],
+            **traffic_stats(
+                history["trafficHistory"],
+                args.get("percentiles", DEFAULT_PERCENTILES),
+            ),
+        }),
+        HTTPStatus.OK,
+        {"X-Served-By": served_by},
+    )
+
+
+@batch_traffic_bp.route("traffic_count", methods=["GET"])
+def get_batch_traffic_count():
+    """
+    GET: Returns traffic counts for every id in ?location_ids=a,b,...
+    Cached counts are read in one multi-get and only the misses are fetched
+    from the data store, concurrently.
+    """
+    input_schema = BatchTrafficCountInputSchema()
+    try:
+        data = request.args.to_dict()
+        data["location_ids"] = [
+            location_id
+            for value in request.args.getlist("location_ids")
+            for location_id in value.split(",")
+            if location_id
+        ]
+        args = input_schema.load(data)
+    except ValidationError as error:
+        print("ValidationError: Cannot get batch traffic: ",
+              error.messages)  # TODO: Implement logging
+        return (
+            "Cannot get traffic for requested locations. Invalid request",
+            HTTPStatus.BAD_REQUEST,
+        )
+    query_time = quantize(
+        args["time"], current_app.config["TRAFFIC_TIME_RESOLUTION"])
+    location_ids = list(dict.fromkeys(
+        str(location_id) for location_id in args["location_ids"]))
+    cached_counts = cache.get_many(*[
+        traffic_count_cache_key(location_id, query_time)
+        for location_id in location_ids
+    ])
+    results = {}
+    misses = []
+    for location_id, cached_count in zip(location_ids, cached_counts):
+        if cached_count is not None:
+            results[location_id] = {
+                "locationId": location_id,
+                "status": HTTPStatus.OK,
+                "data": cached_count,
+            }
+        else:
+            misses.append(location_id)
+
+    def fetch(location_id):
+        params = TrafficCountInputSchema().dump({
+            "time": query_time,
+            "location_id": location_id,
+        })
+        try:
+            response = get_from_data_store(
+                DatastoreEndpointEnum.TRAFFIC_COUNT.value,
+                location_id,
+                params,
+            )
+        except CircuitOpenError as error:
+            print("Could not reach data store: ", error)
+            return {
+                "locationId": location_id,
+                "status": HTTPStatus.SERVICE_UNAVAILABLE,
+                "error": "Data store unavailable",
+            }
+        except requests.RequestException as error:
+            print("Could not reach data store: ", error)
+            return {
+                "locationId": location_id,
+                "status": HTTPStatus.BAD_GATEWAY,
+                "error": "Could not reach data store",
+            }
+        if response.status_code != HTTPStatus.OK:
+            return {
+                "locationId": location_id,
+                "status": response.status_code,
+                "error": response.text,
+            }
+        result = {
+            "locationId": location_id,
+            "status": HTTPStatus.OK,
+            "data": traffic_count_serializer.dump({
+                **response.json(),
+                "locationId": location_id,
+                "time": response.time or query_time,
+            }),
+        }
+        if response.stale:
+            result["stale"] = True
+        return result
+
+    fetched = map_concurrently(
+        fetch, misses, current_app.config["BATCH_MAX_WORKERS"])
+    fetched_counts = {
+        traffic_count_cache_key(result["locationId"], query_time):
+            result["data"]
+        for result in fetched
+        if result["status"] == HTTPStatus.OK and not result.get("stale")
+    }
+    if fetched_counts:
+        cache.set_many(fetched_counts, timeout=60)
+    for result in fetched:
+        results[result["locationId"]] = result
+    return (
+        jsonify({
+            "time": query_time,
+            "results": [results[location_id] for location_id in location_ids],
+        }),
+        HTTPStatus.OK,
+    )
+
+
+@batch_traffic_bp.route("traffic_stream", methods=["GET"])
+def stream_traffic_counts():
+    """
+    GET: Server-Sent Events stream of traffic count updates for every id in
+    ?location_ids=a,b,... Counts are polled once per worker per location,
+    however many clients are subscribed.
+    """
+    if current_app.config["WORKER_MODE"] != "async":
+        # A sync worker would be held by the stream until gunicorn's
+        # timeout kills it
+        return (
+            "Traffic streams are only served with WORKER_MODE=async",
+            HTTPStatus.SERVICE_UNAVAILABLE,
+        )
+    input_schema = TrafficStreamInputSchema()
+    try:
+        args = input_schema.load({
+            "location_ids": [
+                location_id
+                for value in request.args.getlist("location_ids")
+                for location_id in value.split(",")
+                if location_id
+            ],
+        })
+    except ValidationError as error:
+        print("ValidationError: Cannot stream traffic: ",
+              error.messages)  # TODO: Implement logging
+        return (
+            "Cannot stream traffic for requested locations. Invalid request",
+            HTTPStatus.BAD_REQUEST,
+        )
+    location_ids = list(dict.fromkeys(
+        str(location_id) for location_id in args["location_ids"]))
+    app = current_app._get_current_object()
+    subscription = traffic_broadcaster.subscribe(app, location_ids)
+    heartbeat = app.config["TRAFFIC_STREAM_HEARTBEAT"]
+
+    def events():
+        try:
+            while True:
+                try:
+                    update = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ": heartbeat\n\n"
+                    continue
+                yield "event: traffic_count\ndata: {}\n\n".format(
+                    json.dumps(update))
+        finally:
+            traffic_broadcaster.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
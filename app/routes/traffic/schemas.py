@@ -1,5 +1,7 @@
 import time
-from marshmallow import fields, Schema
+from marshmallow import fields, validate, Schema
+
+from app.routes.serializers import FastSerializer
 
 
 class BaseTrafficSchema(Schema):
@@ -17,6 +19,23 @@ class TrafficCountInputSchema(Schema):
     location_id = fields.UUID(required=False)
 
 
+class BatchTrafficCountInputSchema(Schema):
+    time = fields.Int(missing=lambda: int(time.time()), required=False)
+    location_ids = fields.List(
+        fields.UUID(),
+        required=True,
+        validate=validate.Length(min=1, max=100),
+    )
+
+
+class TrafficStreamInputSchema(Schema):
+    location_ids = fields.List(
+        fields.UUID(),
+        required=True,
+        validate=validate.Length(min=1, max=100),
+    )
+
+
 class PeakTrafficNestedSchema(Schema):
     time = fields.Int(required=True)
     count = fields.Int(required=True)
@@ -48,3 +67,18 @@ class TrafficHistoryInputSchema(Schema):
     end_time = fields.Int(required=True)
     location_id = fields.UUID(required=False)
     time_interval = fields.Int()
+
+
+class TrafficStatsInputSchema(Schema):
+    start_time = fields.Int(required=True)
+    end_time = fields.Int(required=True)
+    location_id = fields.UUID(required=False)
+    percentiles = fields.List(
+        fields.Float(validate=validate.Range(min=0, max=100)),
+        validate=validate.Length(max=20),
+    )
+
+
+traffic_count_serializer = FastSerializer(TrafficCountSchema)
+peak_traffic_serializer = FastSerializer(PeakTrafficSchema)
+traffic_history_serializer = FastSerializer(TrafficHistorySchema)
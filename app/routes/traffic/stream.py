@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+import time
+from http import HTTPStatus
+
+import requests
+from flask import current_app
+
+from app.models import cache
+
+from .schemas import TrafficCountInputSchema, traffic_count_serializer
+from .utils import (DatastoreEndpointEnum, get_from_data_store,
+                    traffic_count_cache_key)
+from .view_cache import quantize
+
+
+class Subscription:
+    """
+    Updates for one stream client. The queue is bounded: a client that
+    falls behind loses its oldest updates rather than slowing the poller.
+    """
+    def __init__(self, location_ids, size):
+        self.location_ids = location_ids
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = 0
+
+    def put(self, update):
+        while True:
+            try:
+                self.queue.put_nowait(update)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        """Next update, raises queue.Empty after timeout seconds"""
+        return self.queue.get(timeout=timeout)
+
+
+class TrafficBroadcaster:
+    """
+    Fans live traffic counts out to stream subscribers
+
+    Each location with at least one subscriber in this worker gets a single
+    poller thread that fetches its count every TRAFFIC_STREAM_INTERVAL
+    seconds and publishes it to every subscriber when it changes. The
+    poller stops once the location has no subscribers left.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._subscribers = {}
+        self._pollers = {}
+        self._latest = {}
+        self._stats = {"polls": 0, "published": 0}
+
+    def _reset_after_fork(self):
+        # Poller threads do not survive gunicorn's fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._subscribers = {}
+            self._pollers = {}
+            self._latest = {}
+
+    def subscribe(self, app, location_ids):
+        subscription = Subscription(
+            location_ids, app.config["TRAFFIC_STREAM_QUEUE_SIZE"])
+        with self._lock:
+            self._reset_after_fork()
+            for location_id in location_ids:
+                self._subscribers.setdefault(
+                    location_id, set()).add(subscription)
+                if location_id in self._latest:
+                    subscription.put(self._latest[location_id])
+                if location_id not in self._pollers:
+                    poller = threading.Thread(
+                        target=self._poll,
+                        args=(app, location_id),
+                        name="traffic-poller-{}".format(location_id),
+                        daemon=True,
+                    )
+                    self._pollers[location_id] = poller
+                    poller.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for location_id in subscription.location_ids:
+                subscribers = self._subscribers.get(location_id, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self._subscribers.pop(location_id, None)
+
+    def _poll(self, app, location_id):
+        while True:
+            with self._lock:
+                if not self._subscribers.get(location_id):
+                    self._pollers.pop(location_id, None)
+                    self._latest.pop(location_id, None)
+                    return
+            with app.app_context():
+                update = self._fetch(location_id)
+            if update is not None:
+                self._publish(location_id, update)
+            time.sleep(app.config["TRAFFIC_STREAM_INTERVAL"])
+
+    def _fetch(self, location_id):
+        """
+        Count at the current quantized time, read from and written to the
+        same cache entries as the batch traffic_count endpoint
+        """
+        now = quantize(int(time.time()),
+                       current_app.config["TRAFFIC_TIME_RESOLUTION"])
+        with self._lock:
+            self._stats["polls"] += 1
+        key = traffic_count_cache_key(location_id, now)
+        cached_count = cache.get(key)
+        if cached_count is not None:
+            return cached_count
+        try:
+            response = get_from_data_store(
+                DatastoreEndpointEnum.TRAFFIC_COUNT.value,
+                location_id,
+                TrafficCountInputSchema().dump({
+                    "time": now,
+                    "location_id": location_id,
+                }),
+            )
+        except requests.RequestException as error:
+            print("Could not poll traffic count: ",
+                  error)  # TODO: Implement logging
+            return None
+        if response.status_code != HTTPStatus.OK:
+            print("Could not poll traffic count: ",
+                  response.text)  # TODO: Implement logging
+            return None
+        count = traffic_count_serializer.dump({
+            **response.json(),
+            "locationId": location_id,
+            "time": response.time or now,
+        })
+        if not response.stale:
+            cache.set(key, count, timeout=60)
+        return count
+
+    def _publish(self, location_id, update):
+        with self._lock:
+            latest = self._latest.get(location_id)
+            if (
+                latest is not None
+                and latest["trafficCount"] == update["trafficCount"]
+            ):
+                return
+            self._latest[location_id] = update
+            subscribers = list(self._subscribers.get(location_id, ()))
+            self._stats["published"] += 1
+        for subscription in subscribers:
+            subscription.put(update)
+
+    def stats(self):
+        with self._lock:
+            subscriptions = {
+                subscription
+                for subscribers in self._subscribers.values()
+                for subscription in subscribers
+            }
+            return {
+                **self._stats,
+                "pollers": len(self._pollers),
+                "subscribers": len(subscriptions),
+                "dropped": sum(
+                    subscription.dropped for subscription in subscriptions),
+            }
+
+
+traffic_broadcaster = TrafficBroadcaster()
@@ -1,9 +1,20 @@
 
+from app.models import cache, http
 from app.models.sensor import Sensor
+from app.models.single_flight import SingleFlight
 from app.routes.locations.utils import get_location
+from app.routes.utils import map_concurrently
 from enum import Enum
-from flask import current_app
+from http import HTTPStatus
+from flask import current_app, g
+from marshmallow import ValidationError
 import requests
+import time
+
+data_store_flight = SingleFlight()
+# Seconds between history samples requested from the data store
+TRAFFIC_HISTORY_INTERVAL = 10
+LAST_GOOD_PREFIX = "lastGood:"
 
 
 class DatastoreEndpointEnum(Enum):
@@ -16,6 +27,11 @@ class DatastoreEndpointEnum(Enum):
     TRAFFIC_HISTORY = "/traffic_history"
 
 
+# Endpoints whose last good reply is kept per location rather than per
+# request, as they are mostly asked about the current time
+LIVE_ENDPOINTS = (DatastoreEndpointEnum.TRAFFIC_COUNT.value,)
+
+
 def get_sensor_ids(location_id):
     location = get_location(location_id)
     if not location:
@@ -26,8 +42,260 @@ def get_sensor_ids(location_id):
     ]
 
 
+class DatastoreResponse:
+    """
+    Parsed data store reply that can be shared between coalesced callers
+    """
+    def __init__(self, status_code, text, data=None, stale=False, time=None):
+        self.status_code = status_code
+        self.text = text
+        self.data = data
+        # Last good reply, served because the data store is unavailable
+        self.stale = stale
+        # Time the reply is for, when it is not the requested one
+        self.time = time
+
+    def json(self):
+        return self.data
+
+
+def data_store_key(endpoint, location_id, args):
+    normalized = "&".join(
+        "{}={}".format(key, args[key]) for key in sorted(args)
+    )
+    return "{}:{}:{}".format(location_id, endpoint, normalized)
+
+
+def last_good_key(endpoint, location_id, args):
+    if endpoint in LIVE_ENDPOINTS:
+        return "{}{}:{}".format(LAST_GOOD_PREFIX, location_id, endpoint)
+    return LAST_GOOD_PREFIX + data_store_key(endpoint, location_id, args)
+
+
+def traffic_count_cache_key(location_id, time):
+    return "trafficCount:{}:{}".format(location_id, time)
+
+
 def get_from_data_store(endpoint, location_id, args):
+    """
+    Concurrent identical requests wait on a single upstream call. If the
+    data store fails (or its circuit is open) the last good reply for the
+    same request is served instead, marked stale, when there is one. For
+    LIVE_ENDPOINTS that is the latest reply for the location, whatever
+    time it was for.
+    """
     url = current_app.config["DATA_STORE_BASE_URL"] + \
         "/api/locations/" + location_id + endpoint
-    # Datastore expects unix timestamps rather than ISO format strings
-    return requests.get(url, params=args)
+    key = data_store_key(endpoint, location_id, args)
+    good_key = last_good_key(endpoint, location_id, args)
+
+    def last_good(error):
+        last = cache.get(good_key)
+        if last is None:
+            return None
+        print("Serving last good data store reply: ",
+              error)  # TODO: Implement logging
+        reply_time = last["time"]
+        if reply_time == args.get("time"):
+            reply_time = None
+        return DatastoreResponse(
+            HTTPStatus.OK, "", last["data"], stale=True, time=reply_time)
+
+    def fetch():
+        # Datastore expects unix timestamps rather than ISO format strings
+        try:
+            response = http.get(url, params=args)
+        except requests.RequestException as error:
+            stale_response = last_good(error)
+            if stale_response is None:
+                raise
+            return stale_response
+        if response.status_code == HTTPStatus.OK:
+            data = response.json()
+            cache.set(
+                good_key, {"time": args.get("time"), "data": data},
+                timeout=current_app.config["DATA_STORE_LAST_GOOD_TIMEOUT"],
+            )
+            return DatastoreResponse(response.status_code, "", data)
+        if response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            stale_response = last_good(response.text)
+            if stale_response is not None:
+                return stale_response
+        return DatastoreResponse(response.status_code, response.text)
+
+    response = data_store_flight.do(key, fetch)
+    if response.stale:
+        # Keeps the reply out of response caches, see data_store_is_stale
+        g.data_store_stale = True
+    return response
+
+
+def data_store_is_stale():
+    """Whether this request was answered with a stale data store reply"""
+    return g.get("data_store_stale", False)
+
+
+def traffic_history_bucket_key(location_id, interval, bucket_start):
+    return "trafficHistory:{}:{}:{}".format(location_id, interval, bucket_start)
+
+
+def contiguous_runs(bucket_starts, bucket_size):
+    """Groups sorted bucket starts into runs of adjacent buckets"""
+    runs = []
+    for bucket_start in bucket_starts:
+        if runs and runs[-1][-1] + bucket_size == bucket_start:
+            runs[-1].append(bucket_start)
+        else:
+            runs.append([bucket_start])
+    return runs
+
+
+def history_bucket_count(start_time, end_time):
+    bucket_size = current_app.config["TRAFFIC_HISTORY_BUCKET"]
+    first_bucket = start_time - start_time % bucket_size
+    return max((end_time - first_bucket) // bucket_size + 1, 0)
+
+
+def check_history_window(start_time, end_time):
+    """
+    Raises ValidationError unless the window is ordered and spans at most
+    TRAFFIC_HISTORY_MAX_BUCKETS buckets, which bounds the cache keys (and
+    upstream calls) a single request can cost
+    """
+    if start_time > end_time:
+        raise ValidationError("start_time must not be after end_time")
+    max_buckets = current_app.config["TRAFFIC_HISTORY_MAX_BUCKETS"]
+    if history_bucket_count(start_time, end_time) > max_buckets:
+        raise ValidationError(
+            "Window must not span more than {} buckets of {} seconds".format(
+                max_buckets, current_app.config["TRAFFIC_HISTORY_BUCKET"]))
+
+
+def read_history_buckets(location_id, start_time, end_time, interval):
+    """
+    Returns the starts of the buckets covering the window and the cached
+    bucket for each start (None when missing)
+    """
+    bucket_size = current_app.config["TRAFFIC_HISTORY_BUCKET"]
+    first_bucket = start_time - start_time % bucket_size
+    bucket_starts = list(range(first_bucket, end_time + 1, bucket_size))
+    keys = [
+        traffic_history_bucket_key(location_id, interval, bucket_start)
+        for bucket_start in bucket_starts
+    ]
+    return bucket_starts, dict(zip(bucket_starts, cache.get_many(*keys)))
+
+
+def history_from_buckets(buckets, start_time, end_time):
+    """None if there are no buckets, i.e. the window is empty"""
+    if not buckets:
+        return None
+    history = sorted(
+        (
+            point
+            for bucket in buckets
+            for point in bucket["trafficHistory"]
+            if start_time <= point["time"] <= end_time
+        ),
+        key=lambda point: point["time"],
+    )
+    return {
+        # Report the age of the oldest bucket used
+        "fetchedAt": min(bucket["fetchedAt"] for bucket in buckets),
+        "trafficHistory": history,
+    }
+
+
+def assemble_traffic_history(location_id, start_time, end_time, interval):
+    """
+    Assembles traffic history from fixed, epoch aligned buckets of
+    TRAFFIC_HISTORY_BUCKET seconds. Only buckets missing from the cache are
+    fetched, one upstream call per contiguous run. Buckets that are entirely
+    in the past never change, so they are kept for TRAFFIC_HISTORY_TIMEOUT;
+    the current bucket only for TRAFFIC_HISTORY_CURRENT_TIMEOUT.
+    Returns a DatastoreResponse.
+    """
+    bucket_size = current_app.config["TRAFFIC_HISTORY_BUCKET"]
+    bucket_starts, buckets = read_history_buckets(
+        location_id, start_time, end_time, interval)
+    missing = [
+        bucket_start
+        for bucket_start in bucket_starts
+        if buckets[bucket_start] is None
+    ]
+
+    def fetch(run):
+        return get_from_data_store(
+            DatastoreEndpointEnum.TRAFFIC_HISTORY.value,
+            location_id,
+            {
+                "start_time": run[0],
+                "end_time": run[-1] + bucket_size - 1,
+                "location_id": location_id,
+                "time_interval": interval,
+            },
+        )
+
+    runs = contiguous_runs(missing, bucket_size)
+    now = int(time.time())
+    fetched_buckets = {}
+    fetched_timeouts = {}
+    for run, response in zip(runs, map_concurrently(
+        fetch, runs, current_app.config["BATCH_MAX_WORKERS"]
+    )):
+        if response.status_code != HTTPStatus.OK:
+            return response
+        if response.stale:
+            g.data_store_stale = True
+        data = response.json()
+        for bucket_start in run:
+            buckets[bucket_start] = {
+                "fetchedAt": data["fetchedAt"],
+                "trafficHistory": [],
+            }
+        for point in data["trafficHistory"]:
+            bucket_start = point["time"] - point["time"] % bucket_size
+            if bucket_start in buckets:
+                buckets[bucket_start]["trafficHistory"].append(point)
+        if response.stale:
+            # Only good for this request, never cache it as a bucket
+            continue
+        for bucket_start in run:
+            key = traffic_history_bucket_key(
+                location_id, interval, bucket_start)
+            fetched_buckets[key] = buckets[bucket_start]
+            fetched_timeouts[key] = (
+                current_app.config["TRAFFIC_HISTORY_TIMEOUT"]
+                if bucket_start + bucket_size <= now
+                else current_app.config["TRAFFIC_HISTORY_CURRENT_TIMEOUT"]
+            )
+    for timeout in set(fetched_timeouts.values()):
+        cache.set_many({
+            key: bucket
+            for key, bucket in fetched_buckets.items()
+            if fetched_timeouts[key] == timeout
+        }, timeout=timeout)
+
+    return DatastoreResponse(HTTPStatus.OK, "", history_from_buckets(
+        [buckets[bucket_start] for bucket_start in bucket_starts],
+        start_time,
+        end_time,
+    ))
+
+
+def cached_traffic_history(location_id, start_time, end_time, interval):
+    """
+    Traffic history for the window using only cached buckets, or None if
+    any bucket in the window is missing or the window is empty
+    """
+    bucket_starts, buckets = read_history_buckets(
+        location_id, start_time, end_time, interval)
+    if not bucket_starts:
+        return None
+    if any(buckets[bucket_start] is None for bucket_start in bucket_starts):
+        return None
+    return history_from_buckets(
+        [buckets[bucket_start] for bucket_start in bucket_starts],
+        start_time,
+        end_time,
+    )
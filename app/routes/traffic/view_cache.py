@@ -0,0 +1,129 @@
+import functools
+import hashlib
+import threading
+import time
+from http import HTTPStatus
+
+from flask import current_app, make_response, request
+
+from app.models import swr
+
+from .utils import data_store_is_stale
+
+
+class HitCounter:
+    """Cache hits and misses, counted per endpoint"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def count(self, endpoint, hit):
+        with self._lock:
+            counts = self._counts.setdefault(endpoint, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    **counts,
+                    "hit_rate": counts["hits"] / (
+                        counts["hits"] + counts["misses"]),
+                }
+                for endpoint, counts in self._counts.items()
+            }
+
+
+traffic_cache_stats = HitCounter()
+
+
+def quantize(timestamp, resolution):
+    """Rounds a unix timestamp down to a multiple of resolution seconds"""
+    if resolution <= 1:
+        return timestamp
+    return timestamp - timestamp % resolution
+
+
+def quantized_query_args(time_args=(), now_args=()):
+    """
+    request.args as a dict, with the timestamps in time_args rounded down to
+    TRAFFIC_TIME_RESOLUTION. Args in now_args default to the current time.
+    Views must load these rather than request.args so that every request
+    sharing a cache entry asks the data store the same question.
+    """
+    resolution = current_app.config["TRAFFIC_TIME_RESOLUTION"]
+    args = request.args.to_dict()
+    for name in now_args:
+        args.setdefault(name, str(int(time.time())))
+    for name in time_args:
+        if name in args:
+            try:
+                args[name] = str(quantize(int(args[name]), resolution))
+            except ValueError:
+                pass  # Left for the view's schema to reject
+    return args
+
+
+def view_cache_key(name, args):
+    normalized = "&".join(
+        "{}={}".format(arg, args[arg]) for arg in sorted(args))
+    return "view/{}:{}".format(
+        name, hashlib.sha1(normalized.encode()).hexdigest())
+
+
+def cache_entry(response):
+    """
+    What is cached of a response, None unless it succeeded with fresh data
+    store replies
+    """
+    if response.status_code != HTTPStatus.OK or data_store_is_stale():
+        return None
+    return {
+        "body": response.get_data(),
+        "content_type": response.content_type,
+        "headers": {
+            name: value
+            for name, value in response.headers.items()
+            if name.startswith("X-")
+        },
+    }
+
+
+def traffic_cached(timeout=60):
+    """
+    Caches successful responses of a traffic view, a plain function of the
+    location id and its parsed, quantized args (see quantized_query_args),
+    keyed on those args. Routes parse the request and call the decorated
+    function. Expired entries are served stale and refreshed in the
+    background by calling the function again with the same args, so the
+    entry is refreshed for the time it was keyed on. See
+    StaleWhileRevalidate.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(location_id, args):
+            key = view_cache_key(view.__name__, args)
+            app = current_app._get_current_object()
+
+            def refresh():
+                with app.app_context():
+                    return cache_entry(
+                        make_response(view(location_id, args)))
+
+            cached = swr.get(key, refresh, timeout)
+            if cached is not None:
+                traffic_cache_stats.count(request.endpoint, hit=True)
+                response = current_app.response_class(
+                    cached["body"],
+                    content_type=cached["content_type"],
+                    headers=cached["headers"],
+                )
+                response.headers["X-Cache"] = "HIT"
+                return response
+            traffic_cache_stats.count(request.endpoint, hit=False)
+            response = make_response(view(location_id, args))
+            if swr.set(key, cache_entry(response), timeout) is not None:
+                response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
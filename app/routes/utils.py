@@ -0,0 +1,66 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, json, jsonify, stream_with_context, Response
+
+
+def map_concurrently(fn, items, max_workers):
+    """
+    Runs fn over items on a bounded thread pool, each call inside the
+    current app context. Results are returned in input order.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    app = current_app._get_current_object()
+    # So that the request units the calls consume count towards the request
+    request_charge = g.get("request_charge")
+
+    def run(item):
+        with app.app_context():
+            g.request_charge = request_charge
+            return fn(item)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(run, items))
+
+
+def chunked(items, size):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def encode_cursor(continuation_token):
+    return base64.urlsafe_b64encode(continuation_token.encode()).decode()
+
+
+def paginated(items, continuation_token):
+    """
+    Wraps a page of already serialized items, advertising the next page's
+    cursor in the X-Next-Cursor header
+    """
+    response = jsonify(items)
+    if continuation_token:
+        response.headers["X-Next-Cursor"] = encode_cursor(continuation_token)
+    return response
+
+
+def stream_json_list(items, serializer):
+    """
+    Streams items as a JSON array, serializing one document at a time so
+    memory stays flat regardless of the container size
+    """
+    def generate():
+        yield "["
+        first = True
+        for item in items:
+            if not first:
+                yield ","
+            first = False
+            yield json.dumps(serializer.dump(item))
+        yield "]"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/json",
+    )
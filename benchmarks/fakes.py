@@ -0,0 +1,275 @@
+"""
+In-process stand-ins for Cosmos, memcached, the data store and the
+simulator, each with a configurable latency and call counters
+
+NOTE: Importing this module swaps azure.cosmos.CosmosClient for a client
+that never connects, because app.models connects to Cosmos on import. It
+must therefore be imported before anything imports app.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import azure.cosmos
+
+
+class OfflineCosmosClient:
+    """Hands out placeholder containers, replaced once the app is built"""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_database_client(self, database_id):
+        return self
+
+    def get_container_client(self, container_id):
+        return None
+
+
+azure.cosmos.CosmosClient = OfflineCosmosClient
+for name in ("ACCOUNT_URI", "ACCOUNT_KEY", "DATABASE_ID"):
+    os.environ.setdefault(name, "offline")
+
+from tests.fakes import (InMemoryContainer,  # noqa: E402
+                         InMemoryMemcachedClient)
+
+QUERY_CONDITION = re.compile(r"c\.(\w+) = '([^']*)'")
+
+
+class UpstreamCalls:
+    """Thread safe call counts, per upstream and operation"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def add(self, upstream, operation):
+        with self._lock:
+            self._counts[(upstream, operation)] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        calls = {}
+        for (upstream, operation), count in sorted(counts.items()):
+            calls.setdefault(upstream, {})[operation] = count
+        return calls
+
+
+class Latency:
+    """Sleeps for `mean` seconds, give or take `jitter` of it"""
+    def __init__(self, mean, jitter=0.25, seed=0):
+        self.mean = mean
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.mean <= 0:
+            return
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(self.mean * factor)
+
+
+def latent_call(self, operation, method, *args, **kwargs):
+    """
+    Counts the call and waits out the latency before running method under
+    the fake's lock. Calls the fake makes to itself (set_multi calling
+    set, ...) are part of the outer call.
+    """
+    if getattr(self._local, "inside", False):
+        return method(*args, **kwargs)
+    self.calls.add(self.upstream, operation)
+    self.latency.wait()
+    with self._lock:
+        self._local.inside = True
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._local.inside = False
+
+
+class LatentContainer(InMemoryContainer):
+    """
+    InMemoryContainer that answers after a delay and counts its calls.
+    Unlike its parent it understands the `c.<field> = '<value>'`
+    conditions DatabaseClient puts in its queries.
+    """
+    upstream = "cosmos"
+
+    def __init__(self, calls, latency, **kwargs):
+        self.calls = calls
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        super().__init__(**kwargs)
+
+    _call = latent_call
+
+    def read_item(self, *args, **kwargs):
+        return self._call(
+            "read_item", super().read_item, *args, **kwargs)
+
+    def upsert_item(self, *args, **kwargs):
+        return self._call(
+            "upsert_item", super().upsert_item, *args, **kwargs)
+
+    def replace_item(self, *args, **kwargs):
+        return self._call(
+            "replace_item", super().replace_item, *args, **kwargs)
+
+    def delete_item(self, *args, **kwargs):
+        return self._call(
+            "delete_item", super().delete_item, *args, **kwargs)
+
+    def query_items(self, query, partition_key=None, **kwargs):
+        operation = (
+            "query_items" if partition_key is not None
+            else "cross_partition_query")
+        items = self._call(
+            operation, super().query_items, query, partition_key, **kwargs)
+        conditions = QUERY_CONDITION.findall(query)
+        return [
+            item for item in items
+            if all(str(item.get(field)) == value
+                   for field, value in conditions)
+        ]
+
+
+class LatentMemcachedClient(InMemoryMemcachedClient):
+    """InMemoryMemcachedClient that answers after a delay, counting calls"""
+    upstream = "memcached"
+
+    def __init__(self, calls, latency):
+        super().__init__()
+        self.calls = calls
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    _call = latent_call
+
+    def get(self, *args, **kwargs):
+        return self._call("get", super().get, *args, **kwargs)
+
+    def get_multi(self, *args, **kwargs):
+        return self._call("get_multi", super().get_multi, *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._call("set", super().set, *args, **kwargs)
+
+    def set_multi(self, *args, **kwargs):
+        return self._call("set_multi", super().set_multi, *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self._call("add", super().add, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call("delete", super().delete, *args, **kwargs)
+
+    def delete_multi(self, *args, **kwargs):
+        return self._call(
+            "delete_multi", super().delete_multi, *args, **kwargs)
+
+
+def traffic_count_at(location_id, at):
+    """Deterministic, slowly varying count for a location at a time"""
+    phase = sum(location_id.encode()) % 60
+    return 20 + (at // 60 + phase) % 40
+
+
+def data_store_reply(path, query):
+    """Reply of the data store's traffic endpoints, None if unknown"""
+    now = int(time.time())
+    location_id, endpoint = path.split("/")[3:5]
+    args = {
+        key: int(values[0]) for key, values in query.items()
+        if key != "location_id"
+    }
+    if endpoint == "traffic_count":
+        return {
+            "fetchedAt": now,
+            "trafficCount": traffic_count_at(
+                location_id, args.get("time", now)),
+        }
+    if endpoint in ("traffic_history", "peak_traffic"):
+        interval = max(args.get("time_interval", 10), 1)
+        history = [
+            {"time": at, "trafficCount": traffic_count_at(location_id, at)}
+            for at in range(args["start_time"], args["end_time"] + 1, interval)
+        ]
+        if endpoint == "traffic_history":
+            return {"fetchedAt": now, "trafficHistory": history}
+        peak = max(history, key=lambda point: point["trafficCount"])
+        return {
+            "fetchedAt": now,
+            "peakTraffic": {
+                "time": peak["time"],
+                "count": peak["trafficCount"],
+            },
+        }
+    return None
+
+
+class FakeUpstreamServer:
+    """
+    Data store (traffic_count, traffic_history and peak_traffic) and
+    simulator (sensor PUT/DELETE) on a local port, in a background thread
+    """
+    def __init__(self, name, calls, latency):
+        self.name = name
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so the app's pooled connections get reused
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self):
+                url = urlsplit(self.path)
+                calls.add(server.name, "{} {}".format(
+                    self.command, url.path.rsplit("/", 1)[-1]
+                    if self.command == "GET" else "sensor"))
+                latency.wait()
+                if self.command == "GET":
+                    try:
+                        data = data_store_reply(url.path, parse_qs(url.query))
+                    except (KeyError, ValueError):
+                        data = None
+                    status = 200 if data is not None else 404
+                else:
+                    data = {}
+                    status = 200
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_PUT = do_DELETE = reply
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_port)
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
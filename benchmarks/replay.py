@@ -0,0 +1,217 @@
+"""
+Replays an access log recorded with ACCESS_LOG_PATH
+
+    python -m benchmarks.replay access.log --url http://localhost:8080
+    python -m benchmarks.replay access.log --wsgi app.wsgi:app \\
+        [--speed 4] [--concurrency 16] [--output replay.json]
+
+Requests are sent at their recorded pace divided by --speed (0 sends them
+as fast as --concurrency allows). Only GET and HEAD requests are replayed
+by default, as writes are logged without their bodies. Latency and X-Cache
+hit rates are reported per route, next to the recorded ones.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import json
+import threading
+import time
+
+import requests
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from benchmarks.report import percentile, summarize
+
+
+def read_log(path, methods):
+    """Entries of an access log, oldest first, limited to methods"""
+    entries = []
+    with open(path) as log:
+        for line in log:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry["m"] in methods:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+class HttpTarget:
+    """A running instance, through a connection pool of --concurrency"""
+    def __init__(self, url, concurrency):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def send(self, entry):
+        url = self.url + entry["p"]
+        if entry.get("q"):
+            url += "?" + entry["q"]
+        response = self.session.request(entry["m"], url, timeout=30)
+        return response.status_code, response.headers.get("X-Cache")
+
+
+class WsgiTarget:
+    """The app in this process, given as module:attribute"""
+    def __init__(self, spec):
+        module, _, attribute = spec.partition(":")
+        self.app = getattr(importlib.import_module(module), attribute)
+        self._local = threading.local()
+
+    def send(self, entry):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client(self.app, Response)
+        response = client.open(
+            entry["p"], method=entry["m"], query_string=entry.get("q"))
+        return response.status_code, response.headers.get("X-Cache")
+
+
+def replay(entries, target, speed, concurrency):
+    """
+    Sends every entry at its scheduled time. Returns the samples and how
+    long the replay took. A sample's lag is how late it was sent, which
+    grows once --concurrency cannot keep up with the recorded rate.
+    """
+    lock = threading.Lock()
+    samples = []
+    first = entries[0]["t"]
+    started = time.perf_counter()
+
+    def send(entry, due):
+        lag = time.perf_counter() - due
+        sent = time.perf_counter()
+        try:
+            status, cache = target.send(entry)
+        except Exception as error:
+            # Anything raised here would otherwise vanish with the future,
+            # and the request would be missing from the report
+            print("Replay request failed: ", repr(error))
+            status, cache = 599, None
+        latency = time.perf_counter() - sent
+        with lock:
+            samples.append({
+                "route": "{} {}".format(entry["m"], entry.get("r", entry["p"])),
+                "status": status,
+                "recorded_status": entry.get("s"),
+                "latency": latency,
+                "recorded_latency": entry.get("ms", 0) / 1000,
+                "lag": max(lag, 0),
+                "cache": cache,
+                "recorded_cache": entry.get("x"),
+            })
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            due = started
+            if speed > 0:
+                due += (entry["t"] - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(send, entry, due)
+    return samples, time.perf_counter() - started
+
+
+def recorded_summary(samples):
+    return summarize([{
+        "latency": sample["recorded_latency"],
+        "status": sample["recorded_status"] or 0,
+        "cache": sample["recorded_cache"],
+    } for sample in samples])
+
+
+def report(samples, elapsed):
+    lags = sorted(sample["lag"] for sample in samples)
+    routes = {}
+    for sample in samples:
+        routes.setdefault(sample["route"], []).append(sample)
+    return {
+        **summarize(samples, elapsed),
+        "duration": round(elapsed, 3),
+        "lag_ms": {
+            "p95": round(percentile(lags, 95) * 1000, 3),
+            "max": round(lags[-1] * 1000, 3),
+        },
+        "status_mismatches": sum(
+            sample["status"] != sample["recorded_status"]
+            for sample in samples),
+        "routes": {
+            route: {
+                **summarize(route_samples),
+                "recorded": recorded_summary(route_samples),
+            }
+            for route, route_samples in sorted(routes.items())
+        },
+    }
+
+
+def print_report(result):
+    print("{} requests in {}s, {} req/s, {} errors, {} status "
+          "mismatches".format(
+              result["requests"], result["duration"], result["throughput"],
+              result["errors"], result["status_mismatches"]))
+    print("send lag ms: p95 {p95} max {max}".format(**result["lag_ms"]))
+    for route, summary in result["routes"].items():
+        latency = summary["latency_ms"]
+        recorded = summary["recorded"]
+        print(route)
+        print("  {} requests, p50 {} p95 {} p99 {} ms (recorded p50 {} "
+              "p95 {} p99 {}), cache hit rate {} (recorded {})".format(
+                  summary["requests"],
+                  latency["p50"], latency["p95"], latency["p99"],
+                  recorded["latency_ms"]["p50"],
+                  recorded["latency_ms"]["p95"],
+                  recorded["latency_ms"]["p99"],
+                  summary["cache_hit_rate"], recorded["cache_hit_rate"]))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("log", help="Access log written via ACCESS_LOG_PATH")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running instance")
+    target.add_argument("--wsgi",
+                        help="WSGI app to call in-process, as module:attr")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="Replay speed factor, 0 for no pacing")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--methods", default="GET,HEAD",
+                        help="Comma separated methods to replay")
+    parser.add_argument("--limit", type=int,
+                        help="Replay only the first LIMIT requests")
+    parser.add_argument("--output", help="Also save the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    entries = read_log(options.log, set(options.methods.upper().split(",")))
+    if options.limit is not None:
+        entries = entries[:options.limit]
+    if not entries:
+        print("Nothing to replay in", options.log)
+        return
+    if options.url:
+        target = HttpTarget(options.url, options.concurrency)
+    else:
+        target = WsgiTarget(options.wsgi)
+    samples, elapsed = replay(
+        entries, target, options.speed, options.concurrency)
+    result = report(samples, elapsed)
+    print_report(result)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump({"log": options.log, "options": vars(options),
+                       **result}, output_file, indent=2)
+        print("Report saved to", options.output)
+
+
+if __name__ == "__main__":
+    main()
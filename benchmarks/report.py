@@ -0,0 +1,36 @@
+"""Latency and cache summaries shared by the benchmark and replay tools"""
+import math
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(latencies, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(math.ceil(len(latencies) * percent / 100) - 1, 0)
+    return latencies[index]
+
+
+def summarize(samples, elapsed=None):
+    latencies = sorted(sample["latency"] for sample in samples)
+    cached = [sample for sample in samples if sample["cache"]]
+    summary = {
+        "requests": len(samples),
+        "errors": sum(sample["status"] >= 400 for sample in samples),
+        "latency_ms": {
+            **{
+                "p{}".format(percent):
+                    round(percentile(latencies, percent) * 1000, 3)
+                for percent in PERCENTILES
+            },
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        # Share of X-Cache: HIT among the responses that carry X-Cache
+        "cache_hit_rate": round(
+            sum(sample["cache"] == "HIT" for sample in cached) / len(cached),
+            3,
+        ) if cached else None,
+    }
+    if elapsed is not None:
+        summary["throughput"] = round(len(samples) / elapsed, 1)
+    return summary
@@ -0,0 +1,217 @@
+"""
+Benchmarks the app in-process against local stand-ins for its upstreams
+
+    python -m benchmarks.run [--scenario traffic] [--requests 2000]
+                             [--concurrency 8] [--baseline old.json]
+
+Every scenario starts from the same seeded data and empty caches, runs
+--warmup unmeasured requests, then --requests measured ones. Results are
+printed and saved as JSON (under benchmarks/results/ by default) so that
+runs can be compared across commits with --baseline.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime as dt
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+from benchmarks.fakes import (FakeUpstreamServer, LatentContainer,
+                              LatentMemcachedClient, Latency, UpstreamCalls)
+from benchmarks.report import summarize
+from benchmarks.scenarios import SCENARIOS, Dataset, next_request
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class Bench:
+    """The app wired to fresh fakes, rebuilt before every scenario"""
+    def __init__(self, options):
+        self.options = options
+        self.calls = UpstreamCalls()
+        self.data_store = FakeUpstreamServer(
+            "data_store", self.calls, Latency(options.data_store_latency))
+        self.simulator = FakeUpstreamServer(
+            "simulator", self.calls, Latency(options.simulator_latency))
+        os.environ["DATA_STORE_BASE_URL"] = self.data_store.url
+        os.environ["SIMULATOR_SERVICE_BASE_URL"] = self.simulator.url
+        os.environ.setdefault("MEMCACHED_ADDR", "127.0.0.1:11211")
+        os.environ.setdefault("MEMCACHED_USERNAME", "")
+        os.environ.setdefault("MEMCACHED_PASSWORD", "")
+        # Neither debug nor development mode, as in production
+        os.environ["FLASK_ENV"] = "production"
+
+        from app import create_app
+        from app.models import cache, db
+        self.app = create_app()
+        self.db = db
+        with self.app.app_context():
+            self.backend = cache.cache
+
+    def reset(self, dataset):
+        """Fresh containers seeded with dataset, and empty caches"""
+        options = self.options
+        latency = Latency(options.cosmos_latency, seed=options.seed)
+        locations = LatentContainer(
+            self.calls, latency, id="locations", partition_key="id")
+        sensors = LatentContainer(
+            self.calls, latency, id="sensors", partition_key="locationId")
+        self.db.containers["LOCATIONS"] = locations
+        self.db.containers["SENSORS"] = sensors
+        dataset.seed(locations, sensors)
+        self.backend._client = LatentMemcachedClient(
+            self.calls, Latency(options.memcached_latency, seed=options.seed))
+        if self.backend._l1 is not None:
+            self.backend._l1.clear()
+        self.calls.reset()
+
+    def run(self, mix, dataset, count, seed):
+        """Sends count requests from --concurrency threads"""
+        remaining = itertools.count()
+        lock = threading.Lock()
+        samples = []
+
+        def worker(number):
+            rng = random.Random(seed * 1000 + number)
+            client = self.app.test_client()
+            while True:
+                with lock:
+                    if next(remaining) >= count:
+                        return
+                request = next_request(mix, dataset, rng)
+                started = time.perf_counter()
+                response = client.open(
+                    request.path,
+                    method=request.method,
+                    query_string=request.query,
+                    json=request.body,
+                )
+                latency = time.perf_counter() - started
+                with lock:
+                    samples.append({
+                        "route": "{} {}".format(request.method, request.route),
+                        "status": response.status_code,
+                        "latency": latency,
+                        "cache": response.headers.get("X-Cache"),
+                    })
+
+        concurrency = self.options.concurrency
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(concurrency)))
+        return samples, time.perf_counter() - started
+
+    def scenario(self, name):
+        options = self.options
+        mix = SCENARIOS[name]
+        dataset = Dataset(options.locations, options.sensors)
+        self.reset(dataset)
+        self.run(mix, dataset, options.warmup, options.seed)
+        self.calls.reset()
+        samples, elapsed = self.run(
+            mix, dataset, options.requests, options.seed + 1)
+        routes = {}
+        for sample in samples:
+            routes.setdefault(sample["route"], []).append(sample)
+        return {
+            **summarize(samples, elapsed),
+            "duration": round(elapsed, 3),
+            "upstream_calls": self.calls.snapshot(),
+            "routes": {
+                route: summarize(route_samples)
+                for route, route_samples in sorted(routes.items())
+            },
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(name, result, baseline=None):
+    latency = result["latency_ms"]
+    print("{}: {} requests, {} errors, {} req/s".format(
+        name, result["requests"], result["errors"], result["throughput"]))
+    print("  latency ms: p50 {p50} p95 {p95} p99 {p99} max {max}".format(
+        **latency))
+    if baseline is not None:
+        def change(new, old):
+            return "{:+.1f}%".format((new - old) / old * 100) if old else "n/a"
+        print("  vs baseline: throughput {} p50 {} p95 {} p99 {}".format(
+            change(result["throughput"], baseline["throughput"]),
+            *(change(latency[key], baseline["latency_ms"][key])
+              for key in ("p50", "p95", "p99"))))
+    for upstream, calls in result["upstream_calls"].items():
+        print("  {} calls: {}".format(upstream, ", ".join(
+            "{} {}".format(operation, count)
+            for operation, count in calls.items())))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--scenario", action="append",
+                        choices=sorted(SCENARIOS),
+                        help="Scenario to run, repeatable (default: all)")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--locations", type=int, default=50)
+    parser.add_argument("--sensors", type=int, default=8,
+                        help="Sensors per location")
+    parser.add_argument("--cosmos-latency", type=float, default=0.01,
+                        help="Seconds per Cosmos call")
+    parser.add_argument("--memcached-latency", type=float, default=0.0005)
+    parser.add_argument("--data-store-latency", type=float, default=0.02)
+    parser.add_argument("--simulator-latency", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output",
+                        help="JSON results path (default: benchmarks/"
+                             "results/<commit>-<timestamp>.json)")
+    parser.add_argument("--baseline",
+                        help="Earlier JSON results to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["scenarios"]
+    commit = git_commit()
+    started_at = dt.datetime.utcnow().replace(microsecond=0)
+    bench = Bench(options)
+    results = {}
+    with bench.data_store, bench.simulator:
+        for name in options.scenario or sorted(SCENARIOS):
+            results[name] = bench.scenario(name)
+            print_results(name, results[name], baseline.get(name))
+
+    output = options.output or os.path.join(RESULTS_DIR, "{}-{}.json".format(
+        commit or "unknown", started_at.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump({
+            "commit": commit,
+            "started_at": started_at.isoformat(),
+            "options": {
+                key: value for key, value in vars(options).items()
+                if key not in ("output", "baseline")
+            },
+            "scenarios": results,
+        }, output_file, indent=2)
+    print("Results saved to", output)
+
+
+if __name__ == "__main__":
+    main()
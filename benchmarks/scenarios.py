@@ -0,0 +1,175 @@
+"""Seed data and the request mixes the benchmark drives"""
+import datetime as dt
+import time
+import uuid
+
+
+class Request:
+    def __init__(self, route, method, path, query=None, body=None):
+        # The route template, what results are grouped by
+        self.route = route
+        self.method = method
+        self.path = path
+        self.query = query or {}
+        self.body = body
+
+
+class Dataset:
+    """
+    Locations with their sensors. Popularity is skewed (Zipf-like), as a
+    handful of busy locations get most of the traffic.
+    """
+    def __init__(self, locations=50, sensors_per_location=8):
+        updated_at = dt.datetime.utcnow().replace(microsecond=0).isoformat()
+        self.locations = []
+        self.sensors = []
+        for index in range(locations):
+            location_id = str(uuid.uuid4())
+            sensors = [{
+                "id": str(uuid.uuid4()),
+                "name": "sensor {}".format(number),
+                "type": "camera",
+                "updatedAt": updated_at,
+                "locationId": location_id,
+            } for number in range(sensors_per_location)]
+            self.sensors.extend(sensors)
+            self.locations.append({
+                "id": location_id,
+                "locationId": location_id,
+                "name": "location {}".format(index),
+                "capacity": 100,
+                "updatedAt": updated_at,
+                "sensors": [sensor["id"] for sensor in sensors],
+            })
+        self.weights = [1 / (rank + 1) for rank in range(locations)]
+
+    def seed(self, locations_container, sensors_container):
+        for location in self.locations:
+            locations_container.items[(location["id"], location["id"])] = \
+                dict(location, _etag='"{}"'.format(uuid.uuid4()))
+        for sensor in self.sensors:
+            sensors_container.items[(sensor["id"], sensor["locationId"])] = \
+                dict(sensor, _etag='"{}"'.format(uuid.uuid4()))
+
+    def location(self, rng):
+        return rng.choices(self.locations, self.weights)[0]
+
+
+def location_list(dataset, rng):
+    return Request("/api/locations", "GET", "/api/locations")
+
+
+def location_detail(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>", "GET",
+                   "/api/locations/{}".format(location["id"]))
+
+
+def sensor_list(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/sensors", "GET",
+                   "/api/locations/{}/sensors".format(location["id"]))
+
+
+def sensor_detail(dataset, rng):
+    location = dataset.location(rng)
+    sensor_id = rng.choice(location["sensors"])
+    return Request("/api/locations/<id>/sensors/<id>", "GET",
+                   "/api/locations/{}/sensors/{}".format(
+                       location["id"], sensor_id))
+
+
+def traffic_count(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/traffic_count", "GET",
+                   "/api/locations/{}/traffic_count".format(location["id"]))
+
+
+def time_window(rng):
+    now = int(time.time())
+    return {"start_time": now - rng.choice((900, 3600, 6 * 3600)),
+            "end_time": now}
+
+
+def peak_traffic(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/peak_traffic", "GET",
+                   "/api/locations/{}/peak_traffic".format(location["id"]),
+                   time_window(rng))
+
+
+def traffic_history(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/traffic_history", "GET",
+                   "/api/locations/{}/traffic_history".format(location["id"]),
+                   time_window(rng))
+
+
+def traffic_stats(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/traffic_stats", "GET",
+                   "/api/locations/{}/traffic_stats".format(location["id"]),
+                   time_window(rng))
+
+
+def batch_traffic_count(dataset, rng):
+    locations = rng.sample(dataset.locations, min(10, len(dataset.locations)))
+    return Request("/api/traffic_count", "GET", "/api/traffic_count", {
+        "location_ids": ",".join(location["id"] for location in locations),
+    })
+
+
+def create_sensor(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>/sensors", "POST",
+                   "/api/locations/{}/sensors".format(location["id"]),
+                   body={"name": "new sensor", "type": "camera"})
+
+
+def update_location(dataset, rng):
+    location = dataset.location(rng)
+    return Request("/api/locations/<id>", "PUT",
+                   "/api/locations/{}".format(location["id"]),
+                   body={"capacity": rng.randint(50, 200)})
+
+
+def update_sensor(dataset, rng):
+    location = dataset.location(rng)
+    sensor_id = rng.choice(location["sensors"])
+    return Request("/api/locations/<id>/sensors/<id>", "PUT",
+                   "/api/locations/{}/sensors/{}".format(
+                       location["id"], sensor_id),
+                   body={"name": "renamed sensor", "type": "camera"})
+
+
+BROWSE = {
+    location_list: 20,
+    location_detail: 30,
+    sensor_list: 25,
+    sensor_detail: 25,
+}
+TRAFFIC = {
+    traffic_count: 40,
+    peak_traffic: 15,
+    traffic_history: 20,
+    traffic_stats: 10,
+    batch_traffic_count: 15,
+}
+# Mostly reads, as the dashboards generate most of the load
+MIXED = {
+    **{factory: weight * 0.4 for factory, weight in BROWSE.items()},
+    **{factory: weight * 0.5 for factory, weight in TRAFFIC.items()},
+    create_sensor: 4,
+    update_location: 4,
+    update_sensor: 2,
+}
+SCENARIOS = {
+    "browse": BROWSE,
+    "traffic": TRAFFIC,
+    "mixed": MIXED,
+}
+
+
+def next_request(mix, dataset, rng):
+    factory, = rng.choices(list(mix), list(mix.values()))
+    return factory(dataset, rng)
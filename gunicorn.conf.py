@@ -0,0 +1,22 @@
+import os
+
+# WORKER_MODE=async swaps the default sync workers for cooperative gevent
+# workers. The traffic routes only proxy memcached and the data store, so
+# with sockets patched each worker can keep hundreds of those requests in
+# flight instead of blocking on one upstream call at a time.
+# Leave --preload off so patching happens before the app is imported.
+worker_mode = os.environ.get("WORKER_MODE", "sync").lower()
+
+if worker_mode == "async":
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+else:
+    worker_class = "sync"
+
+
+# prometheus_multiproc_dir makes every worker write its metrics to files in
+# that directory, which /metrics adds up. Clear it before starting gunicorn.
+def child_exit(server, worker):
+    if "prometheus_multiproc_dir" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,168 @@
+import copy
+import uuid
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+
+from app.models.utils import (BATCH_OPERATION_DELETE, BATCH_OPERATION_UPSERT,
+                              BATCH_STORED_PROCEDURE)
+
+
+class InMemoryScripts:
+    """Emulates the partition batch stored procedure of a container"""
+    def __init__(self, container):
+        self.container = container
+        self.stored_procedures = {}
+        self.executions = 0
+
+    def create_stored_procedure(self, body):
+        if body["id"] in self.stored_procedures:
+            raise exceptions.CosmosResourceExistsError(
+                status_code=409, message="Stored procedure exists")
+        self.stored_procedures[body["id"]] = body
+        return body
+
+    def execute_stored_procedure(self, sproc, partition_key=None,
+                                 params=None):
+        if sproc not in self.stored_procedures:
+            raise exceptions.CosmosResourceNotFoundError(
+                status_code=404, message="Stored procedure not found")
+        assert sproc == BATCH_STORED_PROCEDURE["id"]
+        self.executions += 1
+        operations, = params
+        # Transactional: work on a copy and only commit if every op succeeds
+        items = copy.deepcopy(self.container.items)
+        results = []
+        for operation in operations:
+            if operation["operationType"] == BATCH_OPERATION_UPSERT:
+                item = copy.deepcopy(operation["resourceBody"])
+                if item.get(self.container.partition_key) != partition_key:
+                    raise exceptions.CosmosHttpResponseError(
+                        status_code=400, message="Partition key mismatch")
+                item.setdefault("id", str(uuid.uuid4()))
+                items[(item["id"], partition_key)] = item
+                results.append(item)
+            elif operation["operationType"] == BATCH_OPERATION_DELETE:
+                items.pop((operation["id"], partition_key), None)
+                results.append({"id": operation["id"]})
+            else:
+                raise exceptions.CosmosHttpResponseError(
+                    status_code=400, message="Unknown operation")
+        self.container.items = items
+        return copy.deepcopy(results)
+
+
+class InMemoryContainer:
+    """
+    Local stand-in for the subset of azure.cosmos.ContainerProxy used by
+    DatabaseClient. Install it with
+    monkeypatch.setitem(db.containers, container_name, InMemoryContainer())
+    """
+    def __init__(self, id="test", partition_key="locationId", items=()):
+        self.id = id
+        self.partition_key = partition_key
+        self.items = {}
+        self.scripts = InMemoryScripts(self)
+        for item in items:
+            self.upsert_item(item)
+
+    def _key(self, item_id, partition_key):
+        return (item_id, partition_key)
+
+    def read_item(self, item, partition_key):
+        item_id = item["id"] if isinstance(item, dict) else item
+        try:
+            return copy.deepcopy(self.items[self._key(item_id, partition_key)])
+        except KeyError:
+            raise exceptions.CosmosResourceNotFoundError(
+                status_code=404, message="Item not found")
+
+    def upsert_item(self, body):
+        item = copy.deepcopy(body)
+        item.setdefault("id", str(uuid.uuid4()))
+        item["_etag"] = '"{}"'.format(uuid.uuid4())
+        self.items[self._key(item["id"], item[self.partition_key])] = item
+        return copy.deepcopy(item)
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        old = item if isinstance(item, dict) else self.get(item)
+        key = self._key(old["id"], old[self.partition_key])
+        if key not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(
+                status_code=404, message="Item not found")
+        if (
+            match_condition == MatchConditions.IfNotModified
+            and self.items[key]["_etag"] != etag
+        ):
+            raise exceptions.CosmosAccessConditionFailedError(
+                status_code=412, message="Precondition failed")
+        item = copy.deepcopy(body)
+        item["_etag"] = '"{}"'.format(uuid.uuid4())
+        self.items[key] = item
+        return copy.deepcopy(item)
+
+    def delete_item(self, item, partition_key):
+        item_id = item["id"] if isinstance(item, dict) else item
+        try:
+            del self.items[self._key(item_id, partition_key)]
+        except KeyError:
+            raise exceptions.CosmosResourceNotFoundError(
+                status_code=404, message="Item not found")
+
+    def query_items(self, query, partition_key=None, **kwargs):
+        # Queries are not parsed: everything in the partition is returned
+        return [
+            copy.deepcopy(item)
+            for (_, item_partition_key), item in self.items.items()
+            if partition_key is None or item_partition_key == partition_key
+        ]
+
+    def get(self, item_id):
+        for (key_id, _), item in self.items.items():
+            if key_id == item_id:
+                return item
+        raise exceptions.CosmosResourceNotFoundError(
+            status_code=404, message="Item not found")
+
+
+class InMemoryMemcachedClient:
+    """
+    Local stand-in for bmemcached.Client. Install it on the app's backend
+    with monkeypatch.setattr(backend, "_client", InMemoryMemcachedClient())
+    """
+    def __init__(self):
+        self.items = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return copy.deepcopy(self.items.get(key))
+
+    def get_multi(self, keys):
+        self.gets += 1
+        return {
+            key: copy.deepcopy(self.items[key])
+            for key in keys if key in self.items
+        }
+
+    def set(self, key, value, time=0):
+        self.items[key] = copy.deepcopy(value)
+        return True
+
+    def set_multi(self, mapping, time=0):
+        for key, value in mapping.items():
+            self.set(key, value, time)
+        return []
+
+    def add(self, key, value, time=0):
+        if key in self.items:
+            return False
+        return self.set(key, value, time)
+
+    def delete(self, key):
+        return self.items.pop(key, None) is not None
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+        return True
@@ -0,0 +1,45 @@
+import json
+
+from flask import Flask
+
+from app.models.access_log import AccessLog
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config["ACCESS_LOG_PATH"] = path
+
+    @app.route("/api/locations/<location_id>")
+    def location(location_id):
+        return "{}", 200, {"X-Cache": "HIT"}
+
+    AccessLog().init_app(app)
+    return app.test_client()
+
+
+def test_requests_are_logged_as_compact_json_lines(tmp_path):
+    path = str(tmp_path / "access.log")
+    client = make_app(path)
+    client.get("/api/locations/a", query_string={"fields": "name"})
+    client.get("/missing")
+
+    with open(path) as log:
+        first, second = [json.loads(line) for line in log]
+    assert first["m"] == "GET"
+    assert first["p"] == "/api/locations/a"
+    assert first["q"] == "fields=name"
+    assert first["r"] == "/api/locations/<location_id>"
+    assert first["s"] == 200
+    assert first["x"] == "HIT"
+    assert first["ms"] >= 0
+    assert first["t"] <= second["t"]
+    # Empty fields are left out
+    assert second["s"] == 404
+    assert "q" not in second and "r" not in second and "x" not in second
+
+
+def test_nothing_is_logged_without_a_path(tmp_path):
+    app = Flask(__name__)
+    app.config["ACCESS_LOG_PATH"] = None
+    AccessLog().init_app(app)
+    assert not app.after_request_funcs
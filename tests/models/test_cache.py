@@ -0,0 +1,57 @@
+import time
+
+from app.models.cache import BMemcachedCache, LRUCache
+from tests.fakes import InMemoryMemcachedClient
+
+
+def make_cache(**kwargs):
+    cache = BMemcachedCache(servers=["127.0.0.1:1"], **kwargs)
+    cache._client = InMemoryMemcachedClient()
+    return cache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(threshold=2, default_timeout=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert lru.get("a") == 1
+    assert lru.get("b") is None
+    assert lru.get("c") == 3
+
+
+def test_lru_cache_expires_entries():
+    lru = LRUCache(threshold=2, default_timeout=0.01)
+    lru.set("a", {"some": "value"})
+    time.sleep(0.02)
+    assert lru.get("a") is None
+
+
+def test_hot_keys_are_served_from_l1():
+    cache = make_cache()
+    cache.set("location:1", {"id": "1"})
+    assert cache.get("location:1") == {"id": "1"}
+    assert cache.get("location:1") == {"id": "1"}
+    assert cache._client.gets == 0
+    assert cache.stats()["l1_hits"] == 2
+
+
+def test_l2_hits_populate_l1_and_deletes_write_through():
+    cache = make_cache()
+    cache._client.items["location:1"] = {"id": "1"}
+    assert cache.get("location:1") == {"id": "1"}
+    assert cache.get("location:1") == {"id": "1"}
+    assert cache._client.gets == 1
+    stats = cache.stats()
+    assert stats["l2_hits"] == 1 and stats["l1_hits"] == 1
+    cache.delete("location:1")
+    assert cache.get("location:1") is None
+    assert cache.stats()["l2_misses"] == 1
+
+
+def test_l1_hits_are_copies():
+    cache = make_cache()
+    cache.set("location:1", {"sensors": []})
+    cache.get("location:1")["sensors"].append("mutated")
+    assert cache.get("location:1") == {"sensors": []}
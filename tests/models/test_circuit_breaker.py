@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from app.models.circuit_breaker import (CLOSED, HALF_OPEN, OPEN,
+                                        CircuitBreaker, CircuitOpenError)
+from app.models.http_client import HttpClient
+
+
+class MockResponse:
+    def __init__(self, status_code=200, text=""):
+        self.status_code = status_code
+        self.text = text
+
+
+def make_http(**config):
+    app = Flask(__name__)
+    app.config.update(
+        HTTP_POOL_SIZE=4,
+        HTTP_CONNECT_TIMEOUT=1,
+        HTTP_READ_TIMEOUT=1,
+        HTTP_MAX_RETRIES=0,
+        HTTP_BACKOFF_FACTOR=0,
+        HTTP_BREAKER_FAILURE_RATE=0.5,
+        HTTP_BREAKER_MIN_CALLS=4,
+        HTTP_BREAKER_WINDOW=10,
+        HTTP_BREAKER_SLOW_CALL=1,
+        HTTP_BREAKER_RESET_TIMEOUT=30,
+        HTTP_HEDGE=False,
+        HTTP_HEDGE_MIN_DELAY=0.01,
+    )
+    app.config.update(config)
+    http = HttpClient()
+    http.init_app(app)
+    return http
+
+
+def test_breaker_opens_on_failures_and_recovers_after_a_trial_call():
+    breaker = CircuitBreaker(min_calls=4, window=10, reset_timeout=0.05)
+    for failed in (False, True, False, True):
+        breaker.before_call()
+        breaker.record(0.01, failed)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
+    # Only one trial call at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record(0.01, failed=False)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker(min_calls=2, slow_call=0.5)
+    breaker.record(0.6, failed=False)
+    breaker.record(0.7, failed=False)
+    assert breaker.state == OPEN
+
+
+def test_http_client_fails_fast_once_upstream_errors(monkeypatch):
+    http = make_http()
+    calls = []
+
+    def mock_get(session, url, *args, **kwargs):
+        calls.append(url)
+        return MockResponse(503)
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    for _ in range(4):
+        http.get("http://data-store/api")
+    with pytest.raises(CircuitOpenError):
+        http.get("http://data-store/api")
+    assert len(calls) == 4
+    # Other upstreams are unaffected
+    http.get("http://simulator/api")
+    stats = http.breaker_stats()["upstreams"]
+    assert stats["data-store"]["state"] == OPEN
+    assert stats["simulator"]["state"] == CLOSED
+
+
+def test_slow_gets_are_hedged(monkeypatch):
+    http = make_http(HTTP_HEDGE=True)
+    for _ in range(10):
+        http.breaker("http://data-store/api").record(0.01, failed=False)
+    release = threading.Event()
+    calls = []
+
+    def mock_get(session, url, *args, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            # The first attempt hangs until the hedge has answered
+            release.wait(5)
+            return MockResponse(200, "slow")
+        return MockResponse(200, "hedge")
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    try:
+        assert http.get("http://data-store/api").text == "hedge"
+    finally:
+        release.set()
+    assert len(calls) == 2
+    assert http.breaker_stats()["hedged_requests"] == 1
@@ -0,0 +1,54 @@
+import uuid
+
+from app.models import cache
+from app.models.sensor import Sensor
+from tests.test_app import app
+
+
+def test_get_by_id_uses_indexed_partition_key(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    sensor = {
+        "id": str(uuid.uuid4()),
+        "name": "a sensor name",
+        "type": "some type",
+        "locationId": loc_id,
+    }
+    index = {Sensor.index_prefix+sensor["id"]: loc_id}
+
+    def mock_read_item(container, item_id, partition_key):
+        assert partition_key == loc_id
+        return sensor
+
+    def mock_query_items(*args, **kwargs):
+        raise AssertionError("sensor lookup should not fan out")
+
+    monkeypatch.setattr(cache, "get", index.get)
+    monkeypatch.setattr(cache, "set", lambda *args, **kwargs: True)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items", mock_query_items)
+    with app.application.app_context():
+        assert Sensor.get_by_id(sensor["id"]) == sensor
+
+
+def test_get_by_id_indexes_unknown_sensors(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    sensor = {
+        "id": str(uuid.uuid4()),
+        "name": "a sensor name",
+        "type": "some type",
+        "locationId": loc_id,
+    }
+    index = {}
+
+    def mock_set(key, value, timeout=None):
+        index[key] = value
+
+    monkeypatch.setattr(cache, "get", index.get)
+    monkeypatch.setattr(cache, "set", mock_set)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items",
+                        lambda *args, **kwargs: iter([sensor]))
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item",
+                        lambda container, item_id, partition_key: sensor)
+    with app.application.app_context():
+        assert Sensor.get_by_id(sensor["id"]) == sensor
+    assert index[Sensor.index_prefix+sensor["id"]] == loc_id
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from flask import Flask
+
+from app.models.cache import BMemcachedCache
+from app.models.stale_cache import StaleWhileRevalidate
+from tests.fakes import InMemoryMemcachedClient
+
+
+def make_swr(max_staleness=30):
+    app = Flask(__name__)
+    app.config.update(
+        SWR_MAX_STALENESS=max_staleness,
+        SWR_MAX_WORKERS=2,
+        HTTP_READ_TIMEOUT=10,
+    )
+    cache = BMemcachedCache(servers=["127.0.0.1:1"], l1_threshold=0)
+    cache._client = InMemoryMemcachedClient()
+    swr = StaleWhileRevalidate(cache)
+    swr.init_app(app)
+    return swr
+
+
+def expire(swr, key):
+    entry = swr.cache.get(key)
+    entry["fresh_until"] = 0
+    swr.cache.set(key, entry)
+
+
+def test_stale_values_are_served_while_refreshed_once():
+    swr = make_swr()
+    assert swr.get_or_set("key", lambda: "v1", 60) == "v1"
+    expire(swr, "key")
+    release = threading.Event()
+    refreshes = []
+
+    def refresh():
+        release.wait(5)
+        refreshes.append(1)
+        return "v2"
+
+    assert swr.get_or_set("key", refresh, 60) == "v1"
+    assert swr.get_or_set("key", refresh, 60) == "v1"
+    release.set()
+    swr.wait(5)
+    assert refreshes == [1]
+    assert swr.get_or_set("key", refresh, 60) == "v2"
+    stats = swr.stats()
+    assert stats["stale_hits"] == 2
+    assert stats["refreshes"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_failed_refresh_keeps_the_stale_value():
+    swr = make_swr()
+    swr.set("key", "v1", 60)
+    expire(swr, "key")
+
+    def refresh():
+        raise ValueError("data store unavailable")
+
+    assert swr.get("key", refresh, 60) == "v1"
+    swr.wait(5)
+    assert swr.get("key", lambda: None, 60) == "v1"
+    swr.wait(5)
+    assert swr.stats()["refresh_errors"] == 1
+    # The refresh lock is released for the next attempt
+    assert swr.cache.get(swr.lock_prefix+"key") is None
+
+
+def test_entries_expire_after_max_staleness():
+    swr = make_swr(max_staleness=5)
+    timeouts = []
+    swr.cache._client.set = lambda key, value, time=0: timeouts.append(time)
+    swr.set("key", "v1", 60)
+    # memcached takes an absolute expiry time
+    assert abs(timeouts[0] - (time.time() + 65)) < 2
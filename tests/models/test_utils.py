@@ -0,0 +1,175 @@
+import json
+import shutil
+import subprocess
+import uuid
+
+import pytest
+from azure.cosmos import exceptions
+
+from app.models import db
+from app.models.utils import BATCH_LIMIT, BATCH_STORED_PROCEDURE
+from tests.fakes import InMemoryContainer, InMemoryScripts
+from tests.test_app import app
+
+
+def make_sensor(location_id):
+    return {
+        "id": str(uuid.uuid4()),
+        "name": "a sensor name",
+        "type": "some type",
+        "locationId": location_id,
+    }
+
+
+@pytest.fixture
+def container(app, monkeypatch):
+    container = InMemoryContainer()
+    monkeypatch.setitem(db.containers, "SENSORS", container)
+    return container
+
+
+def test_partition_batch_registers_stored_procedure_once(container):
+    loc_id = str(uuid.uuid4())
+    sensors = [make_sensor(loc_id) for _ in range(3)]
+    result = db.execute_partition_batch("SENSORS", loc_id, [{
+        "operationType": "Upsert",
+        "resourceBody": sensor,
+    } for sensor in sensors])
+    assert [item["id"] for item in result] == [s["id"] for s in sensors]
+    assert BATCH_STORED_PROCEDURE["id"] in container.scripts.stored_procedures
+
+    db.execute_partition_batch("SENSORS", loc_id, [{
+        "operationType": "Delete",
+        "id": sensor["id"],
+    } for sensor in sensors[:2]])
+    assert list(container.items) == [(sensors[2]["id"], loc_id)]
+    assert container.scripts.executions == 2
+
+
+def test_partition_batch_is_transactional(container):
+    loc_id = str(uuid.uuid4())
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        db.execute_partition_batch("SENSORS", loc_id, [
+            {"operationType": "Upsert", "resourceBody": make_sensor(loc_id)},
+            {"operationType": "Upsert",
+             "resourceBody": make_sensor(str(uuid.uuid4()))},
+        ])
+    assert container.items == {}
+
+
+class RecordingScripts(InMemoryScripts):
+    """
+    InMemoryScripts that logs each call and its status. With racing set,
+    another worker registers the stored procedure right before this one.
+    """
+    def __init__(self, container, racing=False):
+        super().__init__(container)
+        self.racing = racing
+        self.calls = []
+
+    def _record(self, name, call, *args, **kwargs):
+        try:
+            result = call(*args, **kwargs)
+        except exceptions.CosmosHttpResponseError as error:
+            self.calls.append((name, error.status_code))
+            raise
+        self.calls.append((name, 200))
+        return result
+
+    def create_stored_procedure(self, body):
+        if self.racing:
+            self.stored_procedures[body["id"]] = body
+        return self._record(
+            "create", super().create_stored_procedure, body)
+
+    def execute_stored_procedure(self, sproc, **kwargs):
+        return self._record(
+            "execute", super().execute_stored_procedure, sproc, **kwargs)
+
+
+@pytest.mark.parametrize("racing, create_status", [
+    (False, 200),
+    (True, 409),
+])
+def test_partition_batch_registers_procedure_on_404_and_retries(
+        container, racing, create_status):
+    container.scripts = RecordingScripts(container, racing=racing)
+    loc_id = str(uuid.uuid4())
+    sensor = make_sensor(loc_id)
+    result = db.execute_partition_batch("SENSORS", loc_id, [
+        {"operationType": "Upsert", "resourceBody": sensor},
+    ])
+    assert result == [sensor]
+    assert container.scripts.calls == [
+        ("execute", 404), ("create", create_status), ("execute", 200),
+    ]
+    assert container.scripts.executions == 1
+
+
+def test_partition_batch_rolls_back_when_an_operation_fails(container):
+    loc_id = str(uuid.uuid4())
+    existing = make_sensor(loc_id)
+    db.execute_partition_batch("SENSORS", loc_id, [
+        {"operationType": "Upsert", "resourceBody": existing},
+    ])
+    before = dict(container.items)
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        db.execute_partition_batch("SENSORS", loc_id, [
+            {"operationType": "Delete", "id": existing["id"]},
+            {"operationType": "Upsert", "resourceBody": make_sensor(loc_id)},
+            {"operationType": "Replace", "id": existing["id"]},
+        ])
+    assert container.items == before
+
+
+def test_partition_batch_is_bounded(container):
+    loc_id = str(uuid.uuid4())
+    with pytest.raises(ValueError):
+        db.execute_partition_batch("SENSORS", loc_id, [{
+            "operationType": "Delete", "id": str(i),
+        } for i in range(BATCH_LIMIT + 1)])
+
+
+STORED_PROCEDURE_HARNESS = """
+var calls = [];
+var collection = {
+    getSelfLink: function () { return "dbs/AbC==/colls/AbCdE=/"; },
+    getAltLink: function () { return "dbs/test/colls/sensors"; },
+    upsertDocument: function (link, body, done) {
+        calls.push(["upsert", link]);
+        done(null, body);
+        return true;
+    },
+    deleteDocument: function (link, done) {
+        calls.push(["delete", link]);
+        done(null, null);
+        return true;
+    },
+};
+function getContext() {
+    return {
+        getCollection: function () { return collection; },
+        getResponse: function () { return {setBody: function () {}}; },
+    };
+}
+%s
+partitionBatch(%s);
+console.log(JSON.stringify(calls));
+"""
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_partition_batch_deletes_documents_by_name_based_link():
+    operations = [
+        {"operationType": "Upsert", "resourceBody": {"id": "a"}},
+        {"operationType": "Delete", "id": "b"},
+    ]
+    script = STORED_PROCEDURE_HARNESS % (
+        BATCH_STORED_PROCEDURE["body"], json.dumps(operations))
+    output = subprocess.run(
+        ["node", "-e", script], check=True, capture_output=True, text=True,
+    ).stdout
+    assert json.loads(output) == [
+        ["upsert", "dbs/AbC==/colls/AbCdE=/"],
+        ["delete", "dbs/test/colls/sensors/docs/b"],
+    ]
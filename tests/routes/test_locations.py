@@ -1,3 +1,4 @@
+import gzip
 import pytest
 import json
 import uuid
@@ -5,7 +6,10 @@ import datetime as dt
 from http import HTTPStatus
 from marshmallow import ValidationError
 
+from tests.fakes import InMemoryContainer, InMemoryMemcachedClient
 from tests.test_app import app
+from app.models import cache, db
+from app.models.sensor import Sensor
 from app.routes.locations import LocationSchema
 
 
@@ -137,3 +141,311 @@ def test_can_delete_location(app, monkeypatch):
     response = app.delete("/api/locations/{}".format(some_id))
     assert response.status_code == HTTPStatus.OK
     assert response.get_data(as_text=True) == ""
+
+
+class MockPages:
+    def __init__(self, pages, continuation_token=None):
+        self.pages = iter(pages)
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.pages)
+
+
+class MockItemPaged:
+    def __init__(self, pages, next_token=None):
+        self.pages = pages
+        self.next_token = next_token
+        self.requested_tokens = []
+
+    def by_page(self, continuation_token=None):
+        self.requested_tokens.append(continuation_token)
+        return MockPages(self.pages, self.next_token)
+
+
+def make_locations(count):
+    return [{
+        "id": str(uuid.uuid4()),
+        "name": "location {}".format(i),
+        "capacity": i,
+        "updatedAt": dt.datetime(2020, 4, 1).isoformat(),
+        "sensors": [],
+    } for i in range(count)]
+
+
+def test_can_page_through_locations(app, monkeypatch):
+    locs = make_locations(2)
+    paged = MockItemPaged([locs], next_token='{"token":"next"}')
+    query_kwargs = {}
+
+    def mock_query_items(container, query, **kwargs):
+        query_kwargs.update(kwargs)
+        return paged
+
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items", mock_query_items)
+    response = app.get("/api/locations", query_string={"limit": 2})
+    assert response.status_code == HTTPStatus.OK
+    assert query_kwargs["max_item_count"] == 2
+    assert len(json.loads(response.data)) == 2
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = app.get("/api/locations", query_string={
+        "limit": 2,
+        "cursor": cursor,
+    })
+    assert response.status_code == HTTPStatus.OK
+    assert paged.requested_tokens[-1] == '{"token":"next"}'
+
+
+def test_can_stream_locations(app, monkeypatch):
+    locs = make_locations(5)
+
+    def mock_query_items(*args, **kwargs):
+        return MockItemPaged([locs[:3], locs[3:]])
+
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items", mock_query_items)
+    response = app.get("/api/locations", query_string={"stream": "true"})
+    assert response.status_code == HTTPStatus.OK
+    schema = LocationSchema(many=True, unknown="EXCLUDE")
+    assert schema.dump(schema.loads(response.data)) == schema.dump(schema.load(locs))
+
+
+def test_rejects_invalid_cursor(app):
+    response = app.get("/api/locations", query_string={"cursor": "%%%"})
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+class MockSimulatorResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_delete_location_reports_sensors_that_could_not_be_deleted(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    sensor_ids = [str(uuid.uuid4()) for _ in range(4)]
+    existing_loc = {
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": sensor_ids,
+    }
+    replaced = []
+    sensors_container = InMemoryContainer(items=[{
+        "id": sensor_id,
+        "name": "a sensor name",
+        "type": "some type",
+        "locationId": loc_id,
+    } for sensor_id in sensor_ids])
+
+    def mock_read_item(container, item_id, partition_key):
+        return existing_loc
+
+    def mock_delete_item(container, item_id, partition_key):
+        raise AssertionError("location should not be deleted")
+
+    def mock_replace_item(container, old_item, new_item):
+        replaced.append(new_item)
+        return new_item
+
+    def mock_delete(session, url, *args, **kwargs):
+        if sensor_ids[0] in url:
+            return MockSimulatorResponse(HTTPStatus.INTERNAL_SERVER_ERROR)
+        return MockSimulatorResponse(HTTPStatus.OK)
+
+    monkeypatch.setitem(db.containers, Sensor.container_name, sensors_container)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.delete_item", mock_delete_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.replace_item", mock_replace_item)
+    monkeypatch.setattr("requests.Session.delete", mock_delete)
+
+    response = app.delete("/api/locations/{}".format(loc_id))
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    results = {res["id"]: res for res in json.loads(response.data)["sensors"]}
+    assert not results[sensor_ids[0]]["deleted"]
+    assert all(results[sensor_id]["deleted"] for sensor_id in sensor_ids[1:])
+    assert [item["id"] for item in sensors_container.items.values()] == \
+        [sensor_ids[0]]
+    assert sensors_container.scripts.executions == 1
+    assert replaced[0]["sensors"] == [sensor_ids[0]]
+
+
+def test_location_update_keeps_concurrent_sensor_changes(app, monkeypatch):
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    some_id = str(uuid.uuid4())
+    first_sensor, second_sensor = str(uuid.uuid4()), str(uuid.uuid4())
+    existing_loc = {
+        "id": some_id,
+        "name": "a test location",
+        "locationId": some_id,
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 1).isoformat(),
+        "sensors": [],
+    }
+
+    class RacingContainer(InMemoryContainer):
+        """Another request adds a sensor right before the first replace"""
+        replaces = 0
+
+        def replace_item(self, item, body, **kwargs):
+            self.replaces += 1
+            if self.replaces == 1:
+                stored = self.read_item(some_id, some_id)
+                super().replace_item(
+                    stored, dict(stored, sensors=[first_sensor, second_sensor]))
+            return super().replace_item(item, body, **kwargs)
+
+    locations_container = RacingContainer(
+        partition_key="locationId", items=[existing_loc])
+    monkeypatch.setitem(db.containers, "LOCATIONS", locations_container)
+    # A stale cached copy, from before the first sensor was added
+    with app.application.app_context():
+        cache.set("location:"+some_id, dict(existing_loc))
+    locations_container.replace_item(
+        existing_loc, dict(existing_loc, sensors=[first_sensor]))
+    locations_container.replaces = 0
+
+    response = app.put(
+        "/api/locations/{}".format(some_id),
+        data=json.dumps({"name": "a new name"}),
+        content_type="application/json",
+    )
+    assert response.status_code == HTTPStatus.OK
+    stored = locations_container.read_item(some_id, some_id)
+    assert stored["name"] == "a new name"
+    assert stored["sensors"] == [first_sensor, second_sensor]
+    assert locations_container.replaces == 2
+
+
+def test_location_responses_are_cached_until_updated(app, monkeypatch):
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    some_id = str(uuid.uuid4())
+    existing_loc = {
+        "id": some_id,
+        "name": "a test location",
+        "locationId": some_id,
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 1).isoformat(),
+        "sensors": [],
+    }
+    reads = []
+
+    def mock_read_item(container, item_id, partition_key):
+        reads.append(item_id)
+        return existing_loc
+
+    def mock_replace_item(container, old_item, new_item):
+        return new_item
+
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.replace_item", mock_replace_item)
+    first = app.get("/api/locations/{}".format(some_id))
+    second = app.get("/api/locations/{}".format(some_id))
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert len(reads) == 1
+
+    app.put(
+        "/api/locations/{}".format(some_id),
+        data=json.dumps({"name": "a new name"}),
+        content_type="application/json",
+    )
+    third = app.get("/api/locations/{}".format(some_id))
+    assert third.headers["X-Cache"] == "MISS"
+    assert json.loads(third.data)["name"] == "a new name"
+
+
+def test_get_location_honours_if_none_match(app, monkeypatch):
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    some_id = str(uuid.uuid4())
+    existing_loc = {
+        "id": some_id,
+        "name": "a test location",
+        "locationId": some_id,
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 1).isoformat(),
+        "sensors": [],
+        "_etag": '"00000a00-0000-0000-0000-5e8b8c1a0000"',
+    }
+
+    def mock_read_item(container, item_id, partition_key):
+        return existing_loc
+
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    etag = '"00000a00-0000-0000-0000-5e8b8c1a0000"'
+    uncached = app.get("/api/locations/{}".format(some_id),
+                       headers={"If-None-Match": etag})
+    assert uncached.status_code == HTTPStatus.NOT_MODIFIED
+    assert uncached.data == b""
+    assert uncached.headers["ETag"] == etag
+
+    fresh = app.get("/api/locations/{}".format(some_id))
+    assert fresh.status_code == HTTPStatus.OK
+    assert fresh.headers["ETag"] == etag
+
+    cached = app.get("/api/locations/{}".format(some_id),
+                     headers={"If-None-Match": etag})
+    assert cached.status_code == HTTPStatus.NOT_MODIFIED
+    assert cached.headers["X-Cache"] == "HIT"
+
+    stale = app.get("/api/locations/{}".format(some_id),
+                    headers={"If-None-Match": '"something-else"'})
+    assert stale.status_code == HTTPStatus.OK
+    assert json.loads(stale.data)["name"] == "a test location"
+
+
+def test_large_location_lists_are_compressed_once(app, monkeypatch):
+    import app.models.compression as compression
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    loc_ids = [str(uuid.uuid4()) for _ in range(100)]
+    locs = [{
+        "id": loc_id,
+        "name": "location {}".format(i),
+        "locationId": loc_id,
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 1).isoformat(),
+        "sensors": [],
+        "_etag": '"{}"'.format(i),
+    } for i, loc_id in enumerate(loc_ids)]
+    compressed = []
+    real_compress = compression.compress
+
+    def counting_compress(body, encoding, level):
+        compressed.append(encoding)
+        return real_compress(body, encoding, level)
+
+    monkeypatch.setattr(compression, "compress", counting_compress)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items",
+                        lambda *args, **kwargs: locs)
+    plain = app.get("/api/locations")
+    assert "Content-Encoding" not in plain.headers
+    assert "Accept-Encoding" in plain.headers["Vary"]
+
+    first = app.get("/api/locations", headers={"Accept-Encoding": "gzip"})
+    second = app.get("/api/locations", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["Content-Encoding"] == "gzip"
+    assert len(first.data) < len(plain.data)
+    assert gzip.decompress(first.data) == plain.data
+    assert second.data == first.data
+    assert compressed == ["gzip"]
+
+    etag = first.headers["ETag"]
+    assert etag != plain.headers["ETag"]
+    not_modified = app.get("/api/locations", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": etag,
+    })
+    assert not_modified.status_code == HTTPStatus.NOT_MODIFIED
+    assert not_modified.headers["ETag"] == etag
@@ -0,0 +1,67 @@
+import uuid
+from http import HTTPStatus
+from types import SimpleNamespace
+
+from app.models.metrics import record_request_charge
+from tests.test_app import app
+
+
+class MockResponse:
+    status_code = 200
+
+    def json(self):
+        return {"fetchedAt": 0, "trafficCount": 1}
+
+
+def test_metrics_cover_routes_cosmos_and_upstreams(app, monkeypatch):
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items",
+                        lambda *args, **kwargs: [])
+    monkeypatch.setattr("requests.Session.get",
+                        lambda *args, **kwargs: MockResponse())
+    app.get("/api/locations")
+    app.get("/api/locations/{}/traffic_count".format(uuid.uuid4()))
+
+    response = app.get("/metrics")
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type.startswith("text/plain")
+    metrics = response.data.decode()
+    assert ('http_request_duration_seconds_count{method="GET",'
+            'route="/api/locations",status="200"}') in metrics
+    assert 'route="/api/locations/<location_id>/traffic_count"' in metrics
+    assert ('cosmos_operation_duration_seconds_count{container="LOCATIONS",'
+            'method="query_all_items"}') in metrics
+    assert 'upstream_responses_total{method="get",' in metrics
+    assert "cache_requests_total" in metrics
+
+
+def charged_query_items(*args, **kwargs):
+    # Stands in for the CosmosClient calling its raw_response_hook
+    record_request_charge(SimpleNamespace(http_response=SimpleNamespace(
+        headers={"x-ms-request-charge": "2.5"})))
+    return []
+
+
+def test_request_charge_is_attributed_to_request_and_operation(app, monkeypatch):
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items",
+                        charged_query_items)
+    app.application.debug = True
+    response = app.get("/api/locations")
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["X-Request-Charge"] == "2.50"
+    assert response.headers["X-Request-Charge-Operations"] == (
+        "query_all_items=2.50")
+
+    metrics = app.get("/metrics").data.decode()
+    assert ('cosmos_request_units_total{container="LOCATIONS",'
+            'method="query_all_items"}') in metrics
+    assert ('http_request_units_total{method="GET",'
+            'route="/api/locations"}') in metrics
+
+
+def test_request_charge_header_only_in_debug_mode(app, monkeypatch):
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.query_items",
+                        charged_query_items)
+    app.application.debug = False
+    response = app.get("/api/locations")
+    assert response.status_code == HTTPStatus.OK
+    assert "X-Request-Charge" not in response.headers
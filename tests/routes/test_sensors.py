@@ -1,12 +1,23 @@
 import pytest
 import json
+import requests
 import uuid
 from http import HTTPStatus
 
+from azure.cosmos import exceptions
 from marshmallow import ValidationError
 
+from tests.fakes import InMemoryContainer
 from tests.test_app import app
+from app.models import db
+from app.models.location import Location
+from app.models.sensor import Sensor
 from app.routes.sensors import SensorSchema
+from app.models.circuit_breaker import CircuitOpenError
+from app.routes.sensors.utils import (LOCATION_UPDATE_ATTEMPTS,
+                                      add_sensor_to_location,
+                                      delete_simulation_with_retry,
+                                      remove_sensor_from_location)
 
 
 def test_can_create_sensor(app, monkeypatch):
@@ -235,3 +246,234 @@ def test_can_delete_sensor(app, monkeypatch):
     response = app.delete("/api/locations/{}/sensors/{}".format(existing_loc["id"], existing_sensor["id"]))
     assert response.status_code == HTTPStatus.OK
     assert response.get_data(as_text=True) == ""
+
+
+class MockSimulatorResponse:
+    status_code = 200
+
+
+def test_can_bulk_create_sensors(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    existing_loc = {
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [],
+    }
+    data_in = [{
+        "name": "sensor {}".format(i),
+        "type": "some type",
+    } for i in range(5)]
+    replaced = []
+    registered = []
+
+    def mock_read_item(container, item_id, partition_key):
+        if item_id == loc_id and partition_key == loc_id:
+            return existing_loc
+        return {}
+
+    def mock_replace_item(container, old_item, new_item):
+        replaced.append(new_item)
+        return new_item
+
+    def mock_put(session, url, *args, **kwargs):
+        registered.append(url)
+        return MockSimulatorResponse()
+
+    sensors_container = InMemoryContainer()
+    monkeypatch.setitem(db.containers, Sensor.container_name, sensors_container)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.replace_item", mock_replace_item)
+    monkeypatch.setattr("requests.Session.put", mock_put)
+    response = app.post(
+        "/api/locations/{}/sensors/bulk".format(loc_id),
+        data=json.dumps(data_in),
+        content_type="application/json",
+    )
+    assert response.status_code == HTTPStatus.CREATED
+    results = json.loads(response.data)
+    assert [res["sensor"]["name"] for res in results] == \
+        [sensor["name"] for sensor in data_in]
+    assert all(res["simulationRegistered"] for res in results)
+    assert len(replaced) == 1
+    assert replaced[0]["sensors"] == [res["sensor"]["id"] for res in results]
+    assert len(registered) == len(data_in)
+    assert sensors_container.scripts.executions == 1
+    assert len(sensors_container.items) == len(data_in)
+
+
+def test_bulk_create_rejects_invalid_sensors(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    existing_loc = {
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [],
+    }
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item",
+                        lambda container, item_id, partition_key: existing_loc)
+    for data_in in ([{"name": 1}], [], {"name": "not a list"}, ["a"]):
+        response = app.post(
+            "/api/locations/{}/sensors/bulk".format(loc_id),
+            data=json.dumps(data_in),
+            content_type="application/json",
+        )
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_sensor_is_created_when_simulator_is_down(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    locations_container = InMemoryContainer(partition_key="locationId", items=[{
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [],
+    }])
+    sensors_container = InMemoryContainer()
+
+    def mock_put(session, url, *args, **kwargs):
+        raise requests.ConnectionError("simulator down")
+
+    monkeypatch.setitem(db.containers, Location.container_name,
+                        locations_container)
+    monkeypatch.setitem(db.containers, Sensor.container_name, sensors_container)
+    monkeypatch.setattr("requests.Session.put", mock_put)
+    response = app.post(
+        "/api/locations/{}/sensors".format(loc_id),
+        data=json.dumps({"name": "a sensor name", "type": "some type"}),
+        content_type="application/json",
+    )
+    assert response.status_code == HTTPStatus.CREATED
+    created = json.loads(response.data)
+    assert created["simulationRegistered"] is False
+    assert locations_container.read_item(loc_id, loc_id)["sensors"] == \
+        [created["id"]]
+
+
+def test_sensor_is_kept_when_simulator_is_down(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    sensor_id = str(uuid.uuid4())
+    locations_container = InMemoryContainer(partition_key="locationId", items=[{
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [sensor_id],
+    }])
+    sensors_container = InMemoryContainer(items=[{
+        "id": sensor_id,
+        "name": "a sensor name",
+        "type": "some type",
+        "locationId": loc_id,
+    }])
+
+    def mock_delete(session, url, *args, **kwargs):
+        raise requests.ConnectionError("simulator down")
+
+    monkeypatch.setitem(db.containers, Location.container_name,
+                        locations_container)
+    monkeypatch.setitem(db.containers, Sensor.container_name, sensors_container)
+    monkeypatch.setattr("requests.Session.delete", mock_delete)
+    response = app.delete(
+        "/api/locations/{}/sensors/{}".format(loc_id, sensor_id))
+    assert response.status_code == HTTPStatus.BAD_GATEWAY
+    assert locations_container.read_item(loc_id, loc_id)["sensors"] == \
+        [sensor_id]
+    assert sensors_container.read_item(sensor_id, loc_id)["id"] == sensor_id
+
+
+def test_simulation_delete_is_not_retried_while_circuit_is_open(
+        app, monkeypatch):
+    deletes = []
+
+    def mock_delete(session, url, *args, **kwargs):
+        deletes.append(url)
+        raise CircuitOpenError("simulator circuit open")
+
+    monkeypatch.setattr("requests.Session.delete", mock_delete)
+    with app.application.app_context():
+        error = delete_simulation_with_retry(
+            str(uuid.uuid4()), str(uuid.uuid4()))
+    assert error == "Simulator unavailable"
+    assert len(deletes) == 1
+
+
+def test_concurrent_location_updates_are_not_lost(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    locations_container = InMemoryContainer(partition_key="locationId", items=[{
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [],
+    }])
+    monkeypatch.setitem(db.containers, Location.container_name,
+                        locations_container)
+    stale_location = locations_container.read_item(loc_id, loc_id)
+    first_id, second_id = str(uuid.uuid4()), str(uuid.uuid4())
+    with app.application.app_context():
+        add_sensor_to_location(first_id, stale_location)
+        # Built from the same, now outdated, copy of the location
+        updated = add_sensor_to_location(second_id, stale_location)
+        assert updated["sensors"] == [first_id, second_id]
+        assert locations_container.read_item(loc_id, loc_id)["sensors"] == \
+            [first_id, second_id]
+
+        remove_sensor_from_location(first_id, stale_location)
+        assert locations_container.read_item(loc_id, loc_id)["sensors"] == \
+            [second_id]
+
+
+def test_location_sensor_ids_are_normalized(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    sensor_id = str(uuid.uuid4())
+    locations_container = InMemoryContainer(partition_key="locationId", items=[{
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "capacity": 10,
+        "sensors": [],
+        "extra": "not part of the schema",
+    }])
+    monkeypatch.setitem(db.containers, Location.container_name,
+                        locations_container)
+    with app.application.app_context():
+        location = add_sensor_to_location(sensor_id.upper(), dict(
+            locations_container.read_item(loc_id, loc_id)))
+        assert location["sensors"] == [sensor_id]
+        assert "extra" not in location
+        with pytest.raises(ValueError):
+            add_sensor_to_location("not-a-uuid", location)
+
+        remove_sensor_from_location(sensor_id.upper(), location)
+        assert locations_container.read_item(loc_id, loc_id)["sensors"] == []
+
+
+def test_location_update_gives_up_after_repeated_conflicts(app, monkeypatch):
+    loc_id = str(uuid.uuid4())
+    location = {
+        "id": loc_id,
+        "name": "a test location",
+        "locationId": loc_id,
+        "sensors": [],
+        "_etag": '"1"',
+    }
+    reads = []
+
+    def mock_replace_item(container, old_item, new_item, **kwargs):
+        raise exceptions.CosmosAccessConditionFailedError(
+            status_code=412, message="Precondition failed")
+
+    def mock_read_item(container, item_id, partition_key):
+        reads.append(item_id)
+        return location
+
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.replace_item", mock_replace_item)
+    monkeypatch.setattr("azure.cosmos.ContainerProxy.read_item", mock_read_item)
+    with app.application.app_context():
+        with pytest.raises(exceptions.CosmosAccessConditionFailedError):
+            add_sensor_to_location(str(uuid.uuid4()), location)
+    assert len(reads) == LOCATION_UPDATE_ATTEMPTS - 1
@@ -0,0 +1,95 @@
+import uuid
+import time
+import datetime as dt
+
+from app.routes.locations.schemas import LocationSchema, location_serializer
+from app.routes.sensors.schemas import SensorSchema, sensor_serializer
+from app.routes.traffic.schemas import (
+    TrafficCountSchema,
+    PeakTrafficSchema,
+    TrafficHistorySchema,
+    traffic_count_serializer,
+    peak_traffic_serializer,
+    traffic_history_serializer,
+)
+
+COSMOS_METADATA = {
+    "_rid": "Vt4qALBR0bcBAAAAAAAAAA==",
+    "_self": "dbs/Vt4qAA==/colls/Vt4qALBR0bc=/docs/Vt4qALBR0bcBAAAAAAAAAA==/",
+    "_etag": "\"0000d986-0000-0700-0000-5e8e5b3a0000\"",
+    "_attachments": "attachments/",
+    "_ts": 1586387770,
+}
+
+
+def round_trip(schema, document):
+    return schema.dump(schema.load(document))
+
+
+def test_location_serializer_matches_schema_round_trip():
+    loc_id = str(uuid.uuid4())
+    stored = LocationSchema().dump(LocationSchema().load({
+        "id": loc_id,
+        "locationId": loc_id,
+        "name": "a test location",
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 8, 12, 30).isoformat(),
+        "sensors": [str(uuid.uuid4()), str(uuid.uuid4())],
+    }))
+    document = {**stored, **COSMOS_METADATA}
+    schema = LocationSchema(unknown="EXCLUDE")
+    assert location_serializer.dump(document) == round_trip(schema, document)
+    many = LocationSchema(many=True, unknown="EXCLUDE")
+    assert location_serializer.dump_many([document, document]) == \
+        round_trip(many, [document, document])
+
+
+def test_location_serializer_fills_in_missing_fields():
+    loc_id = str(uuid.uuid4())
+    document = {
+        "id": loc_id,
+        "locationId": loc_id,
+        "name": "a test location",
+        "capacity": 10,
+        "updatedAt": dt.datetime(2020, 4, 8, 12, 30).isoformat(),
+        **COSMOS_METADATA,
+    }
+    schema = LocationSchema(unknown="EXCLUDE")
+    dumped = location_serializer.dump(document)
+    assert dumped == round_trip(schema, document)
+    assert dumped["sensors"] == []
+
+
+def test_sensor_serializer_matches_schema_round_trip():
+    stored = SensorSchema().dump(SensorSchema().load({
+        "id": str(uuid.uuid4()),
+        "locationId": str(uuid.uuid4()),
+        "name": "a sensor name",
+        "type": "some type",
+        "updatedAt": dt.datetime(2020, 4, 8, 12, 30).isoformat(),
+    }))
+    document = {**stored, **COSMOS_METADATA}
+    schema = SensorSchema(unknown="EXCLUDE")
+    assert sensor_serializer.dump(document) == round_trip(schema, document)
+
+
+def test_traffic_serializers_match_schema_round_trip():
+    now = int(time.time())
+    loc_id = str(uuid.uuid4())
+    count = {"time": now, "fetchedAt": now, "trafficCount": 20,
+             "locationId": loc_id}
+    assert traffic_count_serializer.dump(count) == \
+        round_trip(TrafficCountSchema(), count)
+
+    peak = {"fetchedAt": now, "locationId": loc_id,
+            "peakTraffic": {"time": now, "count": 7}}
+    assert peak_traffic_serializer.dump({**peak, "startTime": now}) == \
+        round_trip(PeakTrafficSchema(unknown="EXCLUDE"),
+                   {**peak, "startTime": now})
+
+    history = {"fetchedAt": now, "locationId": loc_id, "trafficHistory": [
+        {"time": now, "trafficCount": 20},
+        {"time": now + 10, "trafficCount": 5},
+    ]}
+    assert traffic_history_serializer.dump(history) == \
+        round_trip(TrafficHistorySchema(), history)
@@ -0,0 +1,50 @@
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+from tests.test_app import app
+from app.models import http
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_can_get_http_client_stats(app):
+    response = app.get("/api/stats")
+    assert response.status_code == HTTPStatus.OK
+    stats = response.get_json()["http"]
+    assert set(stats) == {"pools", "connections", "requests", "reused"}
+
+
+def test_http_client_reuses_pooled_connections(app):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://127.0.0.1:{}/".format(server.server_port)
+    try:
+        before = app.get("/api/stats").get_json()["http"]
+        with app.application.app_context():
+            assert http.get(url).status_code == HTTPStatus.OK
+            first = app.get("/api/stats").get_json()["http"]
+            assert http.get(url).status_code == HTTPStatus.OK
+        second = app.get("/api/stats").get_json()["http"]
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert first["requests"] == before["requests"] + 1
+    assert first["connections"] == before["connections"] + 1
+    assert second["requests"] == first["requests"] + 1
+    # The second call to the same host went over the first one's socket
+    assert second["connections"] == first["connections"]
+    assert second["reused"] == first["reused"] + 1
+    assert second["reused"] > 0
@@ -4,11 +4,16 @@ import json
 import uuid
 import datetime as dt
 import time
+import threading
 from http import HTTPStatus
 
+import requests
+from flask import has_request_context
 from marshmallow import ValidationError
 
+from tests.fakes import InMemoryMemcachedClient
 from tests.test_app import app
+from app.models import cache
 from app.routes.traffic import (
     DatastoreEndpointEnum,
     TrafficCountSchema,
@@ -50,7 +55,7 @@ def test_can_fetch_traffic_count_for_location(app, monkeypatch):
     def mock_get(endpoint, *args, **kwargs):
         return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json=response_json)
 
-    monkeypatch.setattr("requests.get", mock_get)
+    monkeypatch.setattr("requests.Session.get", mock_get)
     response = app.get(
         "/api/locations/{}/traffic_count".format(loc_id),
         query_string=data_in
@@ -87,7 +92,7 @@ def test_can_fetch_peak_traffic_for_location(app, monkeypatch):
     def mock_get(endpoint, *args, **kwargs):
         return MockResponse(DatastoreEndpointEnum.PEAK_TRAFFIC, mock_json=response_json)
 
-    monkeypatch.setattr("requests.get", mock_get)
+    monkeypatch.setattr("requests.Session.get", mock_get)
     response = app.get(
         "/api/locations/{}/peak_traffic".format(loc_id),
         query_string=data_in
@@ -126,7 +131,7 @@ def test_can_fetch_traffic_history_for_location(app, monkeypatch):
     def mock_get(endpoint, *args, **kwargs):
         return MockResponse(DatastoreEndpointEnum.PEAK_TRAFFIC, mock_json=response_json)
 
-    monkeypatch.setattr("requests.get", mock_get)
+    monkeypatch.setattr("requests.Session.get", mock_get)
     response = app.get(
         "/api/locations/{}/traffic_history".format(loc_id),
         query_string=data_in
@@ -134,3 +139,420 @@ def test_can_fetch_traffic_history_for_location(app, monkeypatch):
     assert response.status_code == HTTPStatus.OK
     schema = TrafficHistorySchema()
     assert schema.loads(response.data) == schema.load(expected_response)
+
+
+def test_concurrent_traffic_count_misses_are_coalesced(app, monkeypatch):
+    from app.routes.traffic.utils import data_store_flight
+    loc_id = str(uuid.uuid4())
+    now = int(time.time())
+    response_json = {
+        "time": now,
+        "fetchedAt": now,
+        "trafficCount": 20,
+    }
+    num_requests = 5
+    calls_before = data_store_flight.stats()["calls"]
+    coalesced_before = data_store_flight.stats()["coalesced"]
+    upstream_calls = []
+
+    def mock_get(endpoint, *args, **kwargs):
+        upstream_calls.append(kwargs["params"])
+        # hold the leader until every request has joined the flight
+        deadline = time.time() + 5
+        while (data_store_flight.stats()["calls"] - calls_before
+               < num_requests and time.time() < deadline):
+            time.sleep(0.01)
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT,
+                            mock_json=response_json)
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    responses = []
+
+    def fetch():
+        responses.append(app.get(
+            "/api/locations/{}/traffic_count".format(loc_id),
+            query_string={"time": now},
+        ))
+
+    threads = [threading.Thread(target=fetch) for _ in range(num_requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(upstream_calls) == 1
+    assert all(res.status_code == HTTPStatus.OK for res in responses)
+    coalesced = data_store_flight.stats()["coalesced"] - coalesced_before
+    assert coalesced == num_requests - 1
+
+
+def test_can_fetch_batch_traffic_count(app, monkeypatch):
+    loc_ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+    now = int(time.time())
+
+    def mock_get(session, url, *args, **kwargs):
+        if loc_ids[1] in url:
+            return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT,
+                                error=True)
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "time": now,
+            "fetchedAt": now,
+            "trafficCount": 20,
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    response = app.get(
+        "/api/traffic_count",
+        query_string={"location_ids": ",".join(loc_ids), "time": now},
+    )
+    assert response.status_code == HTTPStatus.OK
+    results = response.get_json()["results"]
+    assert [res["locationId"] for res in results] == loc_ids
+    assert results[0]["status"] == HTTPStatus.OK
+    assert results[0]["data"]["trafficCount"] == 20
+    assert results[1]["status"] == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def test_batch_traffic_count_rejects_invalid_ids(app):
+    response = app.get(
+        "/api/traffic_count",
+        query_string={"location_ids": "not-a-uuid"},
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_sliding_traffic_history_only_fetches_new_buckets(app, monkeypatch):
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", InMemoryMemcachedClient())
+    monkeypatch.setitem(app.application.config, "TRAFFIC_HISTORY_BUCKET", 60)
+    loc_id = str(uuid.uuid4())
+    fetched_ranges = []
+
+    def mock_get(session, url, *args, **kwargs):
+        params = kwargs["params"]
+        fetched_ranges.append((params["start_time"], params["end_time"]))
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_HISTORY, mock_json={
+            "fetchedAt": int(time.time()),
+            "trafficHistory": [
+                {"time": t, "trafficCount": t % 7}
+                for t in range(params["start_time"], params["end_time"] + 1,
+                               params["time_interval"])
+            ],
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    start = 1585699200  # aligned to the minute, long in the past
+    first = app.get(
+        "/api/locations/{}/traffic_history".format(loc_id),
+        query_string={"start_time": start + 30, "end_time": start + 119},
+    )
+    assert first.status_code == HTTPStatus.OK
+    assert fetched_ranges == [(start, start + 119)]
+    history = first.get_json()["trafficHistory"]
+    assert [point["time"] for point in history] == \
+        list(range(start + 30, start + 120, 10))
+
+    second = app.get(
+        "/api/locations/{}/traffic_history".format(loc_id),
+        query_string={"start_time": start + 90, "end_time": start + 179},
+    )
+    assert second.status_code == HTTPStatus.OK
+    assert fetched_ranges[1:] == [(start + 120, start + 179)]
+    history = second.get_json()["trafficHistory"]
+    assert [point["time"] for point in history] == \
+        list(range(start + 90, start + 180, 10))
+    assert [point["trafficCount"] for point in history] == \
+        [point["time"] % 7 for point in history]
+
+
+def test_traffic_history_window_is_capped(app, monkeypatch):
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", InMemoryMemcachedClient())
+    monkeypatch.setitem(
+        app.application.config, "TRAFFIC_HISTORY_MAX_BUCKETS", 24)
+    monkeypatch.setattr("requests.Session.get", lambda *args, **kwargs: (
+        pytest.fail("the data store must not be called")))
+    loc_id = str(uuid.uuid4())
+    window = {"start_time": 0, "end_time": int(time.time())}
+    for endpoint in ("traffic_history", "traffic_stats"):
+        response = app.get(
+            "/api/locations/{}/{}".format(loc_id, endpoint),
+            query_string=window,
+        )
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_peak_traffic_and_stats_are_computed_from_cached_history(app, monkeypatch):
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", InMemoryMemcachedClient())
+    monkeypatch.setitem(app.application.config, "TRAFFIC_HISTORY_BUCKET", 60)
+    loc_id = str(uuid.uuid4())
+    start = 1585699200
+    counts = [3, 9, 4, 9, 1, 6]
+    upstream_calls = []
+
+    def mock_get(session, url, *args, **kwargs):
+        upstream_calls.append(url)
+        if url.endswith(DatastoreEndpointEnum.PEAK_TRAFFIC.value):
+            return MockResponse(DatastoreEndpointEnum.PEAK_TRAFFIC, mock_json={
+                "fetchedAt": start,
+                "peakTraffic": {"time": start + 10, "count": 9},
+            })
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_HISTORY, mock_json={
+            "fetchedAt": start,
+            "trafficHistory": [
+                {"time": start + 10 * i, "trafficCount": count}
+                for i, count in enumerate(counts)
+            ],
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    window = {"start_time": start, "end_time": start + 59}
+    peak = app.get("/api/locations/{}/peak_traffic".format(loc_id),
+                   query_string=window)
+    assert peak.headers["X-Served-By"] == "data-store"
+
+    stats = app.get("/api/locations/{}/traffic_stats".format(loc_id),
+                    query_string={**window, "percentiles": "50,100"})
+    assert stats.headers["X-Served-By"] == "data-store"
+    assert stats.get_json()["peakTraffic"] == {"time": start + 10, "count": 9}
+    assert stats.get_json()["percentiles"] == {"50": 5.0, "100": 9.0}
+    assert stats.get_json()["mean"] == sum(counts) / len(counts)
+    calls = len(upstream_calls)
+
+    stats = app.get("/api/locations/{}/traffic_stats".format(loc_id),
+                    query_string=window)
+    assert stats.headers["X-Served-By"] == "cache"
+    assert stats.get_json()["min"] == 1
+    peak = app.get("/api/locations/{}/peak_traffic".format(loc_id),
+                   query_string={**window, "end_time": start + 49})
+    assert peak.headers["X-Served-By"] == "cache"
+    assert peak.get_json()["peakTraffic"] == {"time": start + 10, "count": 9}
+    assert len(upstream_calls) == calls
+
+
+def test_inverted_peak_traffic_window_is_rejected(app, monkeypatch):
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", InMemoryMemcachedClient())
+    monkeypatch.setattr("requests.Session.get", lambda *args, **kwargs: (
+        pytest.fail("the data store must not be called")))
+    response = app.get(
+        "/api/locations/{}/peak_traffic".format(uuid.uuid4()),
+        query_string={"start_time": 1585699200, "end_time": 1585695600},
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_traffic_count_cache_key_is_query_aware_and_quantized(app, monkeypatch):
+    from app.routes.traffic.view_cache import traffic_cache_stats
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", InMemoryMemcachedClient())
+    monkeypatch.setattr(traffic_cache_stats, "_counts", {})
+    loc_id = str(uuid.uuid4())
+    base = 1585699200
+    upstream_times = []
+
+    def mock_get(session, url, *args, **kwargs):
+        upstream_times.append(kwargs["params"]["time"])
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "fetchedAt": base,
+            "trafficCount": len(upstream_times),
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    url = "/api/locations/{}/traffic_count".format(loc_id)
+    first = app.get(url, query_string={"time": base + 3})
+    second = app.get(url, query_string={"time": base + 8})
+    other = app.get(url, query_string={"time": base + 13})
+    assert upstream_times == [base, base + 10]
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.data == first.data
+    assert first.get_json()["time"] == base
+    assert other.get_json()["trafficCount"] == 2
+
+    stats = app.get("/api/stats").get_json()["traffic_cache"]
+    assert stats["traffic.get_traffic_count"] == {
+        "hits": 1, "misses": 2, "hit_rate": 1 / 3,
+    }
+
+
+def test_expired_traffic_count_is_served_stale_and_refreshed(app, monkeypatch):
+    from app.models import swr
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    # Keep entries out of the per-worker L1 so they can be expired here
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_l1", None)
+    loc_id = str(uuid.uuid4())
+    base = 1585699200
+    counts = []
+    in_request = []
+
+    def mock_get(session, url, *args, **kwargs):
+        counts.append(len(counts) + 1)
+        in_request.append(has_request_context())
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "fetchedAt": base,
+            "trafficCount": counts[-1],
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    url = "/api/locations/{}/traffic_count".format(loc_id)
+    first = app.get(url, query_string={"time": base})
+    assert first.get_json()["trafficCount"] == 1
+    for key, entry in memcached.items.items():
+        if key.startswith("view/"):
+            entry["fresh_until"] = 0
+
+    stale = app.get(url, query_string={"time": base})
+    assert stale.headers["X-Cache"] == "HIT"
+    assert stale.get_json()["trafficCount"] == 1
+    swr.wait(5)
+    assert counts == [1, 2]
+    # The refresh runs in an app context, not under a made up request
+    assert in_request == [True, False]
+    refreshed = app.get(url, query_string={"time": base})
+    assert refreshed.get_json()["trafficCount"] == 2
+
+
+def test_last_good_reply_is_served_when_data_store_fails(app, monkeypatch):
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_l1", None)
+    loc_id = str(uuid.uuid4())
+    base = 1585699200
+    failing = []
+
+    def mock_get(session, url, *args, **kwargs):
+        if failing:
+            raise requests.ConnectionError("data store down")
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "fetchedAt": base,
+            "trafficCount": 7,
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    url = "/api/locations/{}/traffic_count".format(loc_id)
+    assert app.get(url, query_string={"time": base}).status_code == \
+        HTTPStatus.OK
+    for key in [key for key in memcached.items if key.startswith("view/")]:
+        del memcached.items[key]
+
+    failing.append(True)
+    stale = app.get(url, query_string={"time": base})
+    assert stale.status_code == HTTPStatus.OK
+    assert stale.get_json()["trafficCount"] == 7
+    assert "Stale" in stale.headers["Warning"]
+    assert not any(key.startswith("view/") for key in memcached.items)
+
+    later = app.get(url, query_string={"time": base + 60})
+    assert later.status_code == HTTPStatus.OK
+    assert later.get_json()["time"] == base
+    assert "Stale" in later.headers["Warning"]
+
+    unknown = app.get("/api/locations/{}/traffic_count".format(uuid.uuid4()),
+                      query_string={"time": base})
+    assert unknown.status_code == HTTPStatus.BAD_GATEWAY
+
+
+def test_traffic_stream_needs_async_workers(app, monkeypatch):
+    monkeypatch.setitem(app.application.config, "WORKER_MODE", "sync")
+    response = app.get(
+        "/api/traffic_stream?location_ids={}".format(uuid.uuid4()))
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def test_traffic_stream_shares_one_poller_per_location(app, monkeypatch):
+    from app.routes.traffic.stream import traffic_broadcaster
+    monkeypatch.setitem(app.application.config, "WORKER_MODE", "async")
+    monkeypatch.setitem(app.application.config, "TRAFFIC_STREAM_INTERVAL", 0.05)
+    loc_id = str(uuid.uuid4())
+    polls = []
+
+    def mock_get(session, url, *args, **kwargs):
+        polls.append(url)
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "fetchedAt": int(time.time()),
+            "trafficCount": len(polls),
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    url = "/api/traffic_stream?location_ids={}".format(loc_id)
+    streams = [app.get(url, buffered=False) for _ in range(3)]
+    try:
+        for stream in streams:
+            assert stream.status_code == HTTPStatus.OK
+            assert stream.mimetype == "text/event-stream"
+            event = next(iter(stream.response)).decode()
+            assert event.startswith("event: traffic_count\ndata: ")
+            data = json.loads(event.split("data: ", 1)[1])
+            assert data["locationId"] == loc_id
+        assert traffic_broadcaster.stats()["pollers"] == 1
+        assert traffic_broadcaster.stats()["subscribers"] == 3
+        time.sleep(0.2)
+        # One upstream poll per interval, not one per client
+        assert len(polls) <= 6
+    finally:
+        for stream in streams:
+            stream.close()
+    assert traffic_broadcaster.stats()["subscribers"] == 0
+    deadline = time.time() + 1
+    while traffic_broadcaster.stats()["pollers"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert traffic_broadcaster.stats()["pollers"] == 0
+
+
+def test_traffic_stream_shares_the_batch_cache(app, monkeypatch):
+    from app.routes.traffic.stream import traffic_broadcaster
+    from app.routes.traffic.utils import traffic_count_cache_key
+    from app.routes.traffic.view_cache import quantize
+    memcached = InMemoryMemcachedClient()
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_client", memcached)
+    monkeypatch.setattr(app.application.extensions["cache"][cache],
+                        "_l1", None)
+    monkeypatch.setitem(app.application.config, "WORKER_MODE", "async")
+    monkeypatch.setitem(app.application.config, "TRAFFIC_TIME_RESOLUTION", 3600)
+    loc_id = str(uuid.uuid4())
+    polls = []
+
+    def mock_get(session, url, *args, **kwargs):
+        polls.append(kwargs["params"]["time"])
+        return MockResponse(DatastoreEndpointEnum.TRAFFIC_COUNT, mock_json={
+            "fetchedAt": int(time.time()),
+            "trafficCount": 7,
+        })
+
+    monkeypatch.setattr("requests.Session.get", mock_get)
+    stream = app.get("/api/traffic_stream?location_ids={}".format(loc_id),
+                     buffered=False)
+    try:
+        event = next(iter(stream.response)).decode()
+    finally:
+        stream.close()
+    data = json.loads(event.split("data: ", 1)[1])
+    now = quantize(int(time.time()), 3600)
+    assert polls == [now]
+    assert data["time"] == now
+    with app.application.app_context():
+        assert cache.get(traffic_count_cache_key(loc_id, now)) == data
+
+    batch = app.get("/api/traffic_count", query_string={"location_ids": loc_id})
+    assert batch.get_json()["results"][0]["data"] == data
+    assert len(polls) == 1
+    deadline = time.time() + 1
+    while traffic_broadcaster.stats()["pollers"] and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_slow_stream_subscribers_drop_their_oldest_updates():
+    from app.routes.traffic.stream import Subscription
+    subscription = Subscription(["some-id"], size=2)
+    for count in range(5):
+        subscription.put({"trafficCount": count})
+    assert subscription.dropped == 3
+    assert subscription.get(timeout=0)["trafficCount"] == 3
+    assert subscription.get(timeout=0)["trafficCount"] == 4